@@ -0,0 +1,333 @@
+"""
+FamilyMeal Bot - Benchmark de handlers
+Ejecuta cada handler de FamilyMealBot con updates sintéticos contra un backend
+SQLite en memoria (con latencia simulada por consulta) y un Telegram falso, y
+muestra latencia p50/p95, consultas a la BD, llamadas a Telegram y memoria por
+llamada.
+
+Uso:
+    python bench_handlers.py --iterations 200 --latency-ms 20
+    python bench_handlers.py --cold          # sin cachés calientes
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import time
+import tracemalloc
+from collections import Counter
+from types import SimpleNamespace
+
+from telegram import Bot, Update
+from telegram.request import BaseRequest
+
+import telegram_bot_with_notifications as app
+from storage import REPOSITORY_NAMES, Storage, create_sqlite_storage
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "FamilyMeal", "username": "familymeal_bot"}
+
+
+# ========== TELEGRAM FALSO ==========
+
+class FakeTelegramRequest(BaseRequest):
+    """Responde a la Bot API sin red, contando las llamadas por método"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.sent = []
+        self._message_ids = itertools.count(1000)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if endpoint == "getMe":
+            result = BOT_USER
+        elif endpoint in ("sendMessage", "editMessageText"):
+            self.sent.append((endpoint, params.get("chat_id"), time.monotonic()))
+            result = {
+                "message_id": params.get("message_id") or next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": params.get("chat_id") or 0, "type": "private"},
+                "from": BOT_USER,
+                "text": params.get("text", ""),
+            }
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+class UpdateFactory:
+    """Updates sintéticos (mensajes y callback queries) ligados al bot falso"""
+
+    def __init__(self, bot: Bot):
+        self.bot = bot
+        self._ids = itertools.count(1)
+
+    def _user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+    def _message(self, user_id, text):
+        return {
+            "message_id": next(self._ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            "text": text,
+        }
+
+    def message(self, user_id: int, text: str):
+        return Update.de_json({"update_id": next(self._ids), "message": self._message(user_id, text)}, self.bot)
+
+    def inline_query(self, user_id: int, query: str):
+        return Update.de_json({
+            "update_id": next(self._ids),
+            "inline_query": {"id": str(next(self._ids)), "from": self._user(user_id), "query": query, "offset": ""},
+        }, self.bot)
+
+    def callback(self, user_id: int, data: str):
+        return Update.de_json({
+            "update_id": next(self._ids),
+            "callback_query": {
+                "id": str(next(self._ids)),
+                "from": self._user(user_id),
+                "chat_instance": str(user_id),
+                "data": data,
+                "message": {**self._message(user_id, "..."), "from": BOT_USER},
+            },
+        }, self.bot)
+
+
+# ========== BACKEND CON LATENCIA ==========
+
+class LatencyRepository:
+    """Envuelve un repositorio: añade latencia a cada llamada y la cuenta como un round trip"""
+
+    def __init__(self, name, repository, latency, counter):
+        self._name = name
+        self._repository = repository
+        self._latency = latency
+        self._counter = counter
+
+    def __getattr__(self, attr):
+        target = getattr(self._repository, attr)
+        if not asyncio.iscoroutinefunction(target):
+            return target
+
+        async def call(*args, **kwargs):
+            self._counter[f"{self._name}.{attr}"] += 1
+            if self._latency:
+                await asyncio.sleep(self._latency)
+            return await target(*args, **kwargs)
+        return call
+
+
+def latency_storage(storage: Storage, latency: float, counter: Counter):
+    """Storage con todos los repositorios envueltos en LatencyRepository"""
+    return Storage(
+        **{
+            name: LatencyRepository(name, getattr(storage, name), latency, counter)
+            for name in REPOSITORY_NAMES
+        },
+        close=storage.close,
+    )
+
+
+async def seed(storage: Storage, telegram_id: int, products: int, recipes: int):
+    """Una familia con inventario, recetas y la semana visible planificada"""
+    user = await storage.users.create({"telegram_id": telegram_id, "username": f"user{telegram_id}"})
+    family = await storage.users.create_family({"name": "Bench", "invite_code": "BENCH001", "created_by": user['id']})
+    await storage.members.add({"family_id": family['id'], "user_id": user['id'], "role": "admin"})
+
+    items = []
+    for i in range(products):
+        section = app.SECTIONS[i % len(app.SECTIONS)]
+        items.append(await storage.inventory.add({
+            "family_id": family['id'], "section": section, "name": f"Producto {i}",
+            "quantity": "2", "stock": i % 4,
+        }))
+
+    recipe_ids = []
+    for i in range(recipes):
+        ingredients = [
+            {"ingredient_name": item['name'], "quantity": "1", "product_id": item['id'], "section": item['section']}
+            for item in items[i % max(1, len(items)):][:4]
+        ]
+        recipe = await storage.recipes.create_with_ingredients({
+            "family_id": family['id'], "name": f"Receta {i}", "created_by": user['id'],
+            "needs_defrost": i % 2 == 0, "defrost_reminder_time": "21:30:00" if i % 2 == 0 else None,
+        }, ingredients)
+        recipe_ids.append(recipe['id'])
+
+    for i, date in enumerate(app.get_week_to_display()):
+        for j, meal_type in enumerate(app.MEALS):
+            if recipe_ids:
+                await storage.meal_plans.upsert_slot({
+                    "family_id": family['id'], "date": str(date), "meal_type": meal_type,
+                    "recipe_id": recipe_ids[(i * 2 + j) % len(recipe_ids)], "created_by": user['id'],
+                })
+    return family, items, recipe_ids
+
+
+# ========== ESCENARIOS ==========
+
+def build_scenarios(bot: app.FamilyMealBot, updates: UpdateFactory, user_id: int, family, items, recipe_ids):
+    """
+    (nombre, función que devuelve la corrutina de una llamada). Crear y unirse a una
+    familia usan un usuario nuevo en cada llamada; borrar va al final porque vacía la semana
+    """
+    in_stock = next(item for item in items if item['stock'] > 0)
+    new_users = itertools.count(user_id + 1)
+    available_days = app.get_available_days() or [(0, app.get_week_to_display()[0])]
+    day_idx, day = available_days[0]
+
+    def context(**user_data):
+        return SimpleNamespace(user_data=dict(user_data), bot=updates.bot)
+
+    recipe_flow = {
+        "recipe_name": "Receta bench",
+        "recipe_needs_defrost": True,
+        "recipe_ingredients": [
+            {"product_id": item['id'], "name": item['name'], "section": item['section'], "quantity": 1}
+            for item in items[:5]
+        ],
+    }
+    menu_slot = {"menu_date": str(day), "menu_meal_type": "Cena", "menu_day_idx": day_idx}
+
+    return [
+        ("start", lambda: bot.start(updates.message(user_id, "/start"), context())),
+        ("create_family_name", lambda: bot.create_family_name(
+            updates.message(next(new_users), "Familia bench"), context())),
+        ("join_family_code", lambda: bot.join_family_code(
+            updates.message(next(new_users), family['invite_code']), context())),
+        ("show_menu", lambda: bot.show_menu(updates.message(user_id, "📅 Menú Semanal"), context())),
+        ("show_inventory", lambda: bot.show_inventory(updates.message(user_id, "🏠 Inventario"), context())),
+        ("show_recipes", lambda: bot.show_recipes(updates.message(user_id, "📖 Recetas"), context())),
+        ("show_shopping_list", lambda: bot.show_shopping_list(updates.message(user_id, "🛒 Lista de Compra"), context())),
+        ("show_family", lambda: bot.show_family(updates.message(user_id, "👥 Mi Familia"), context())),
+        ("save_inventory_item", lambda: bot.save_inventory_item(
+            updates.message(user_id, "3"), context(inv_section="Frigo", inv_name="Yogur", inv_stock=3))),
+        ("shopping_list_page", lambda: bot.shopping_list_page(updates.callback(user_id, "shop_page_next"), context())),
+        ("inline_search", lambda: bot.inline_search(updates.inline_query(user_id, "prod 1"), context())),
+        ("ingredient_search", lambda: bot.ingredient_search(updates.message(user_id, "producto"), context())),
+        ("mark_as_bought", lambda: bot.mark_as_bought(updates.callback(user_id, f"buy_{in_stock['id']}"), context())),
+        ("select_ingredient_section", lambda: bot.select_ingredient_section(
+            updates.callback(user_id, "ing_sect_Congelador"), context(recipe_ingredients=[]))),
+        ("select_ingredient_product", lambda: bot.select_ingredient_product(
+            updates.callback(user_id, f"ing_prod_{in_stock['id']}"), context(recipe_ingredients=[]))),
+        ("save_recipe", lambda: bot.save_recipe(
+            updates.message(user_id, "21:30"), context(**recipe_flow), None, "21:30")),
+        ("select_menu_meal", lambda: bot.select_menu_meal(
+            updates.callback(user_id, "menu_meal_Cena"), context(**menu_slot))),
+        ("menu_search", lambda: bot.menu_search(updates.message(user_id, "receta 1"), context(**menu_slot))),
+        ("select_menu_recipe", lambda: bot.select_menu_recipe(
+            updates.callback(user_id, f"menu_recipe_{recipe_ids[0]}"), context(**menu_slot))),
+        ("clear_mark_cooked", lambda: bot.clear_mark_cooked(updates.callback(user_id, "clear_mark_cooked"), context())),
+        ("delete_meal_plan", lambda: bot.select_menu_recipe(
+            updates.callback(user_id, "menu_opt_delete"), context(**menu_slot))),
+        ("clear_delete", lambda: bot.clear_delete(updates.callback(user_id, "clear_delete"), context())),
+    ]
+
+
+# ========== EJECUCIÓN ==========
+
+async def run_benchmark(iterations: int, latency_ms: float, products: int, recipes: int, cold: bool,
+                        alloc_iterations: int):
+    round_trips = Counter()
+    storage = latency_storage(create_sqlite_storage(":memory:"), latency_ms / 1000, round_trips)
+    request = FakeTelegramRequest()
+    telegram_bot = Bot("123456:BENCH", request=request, get_updates_request=FakeTelegramRequest())
+    await telegram_bot.initialize()
+
+    user_id = 4242
+    family, items, recipe_ids = await seed(storage, user_id, products, recipes)
+    bot = app.FamilyMealBot(storage)
+    updates = UpdateFactory(telegram_bot)
+    scenarios = build_scenarios(bot, updates, user_id, family, items, recipe_ids)
+
+    def reset_caches():
+        bot.identity_cache.clear()
+        bot.recipe_catalog.clear()
+        bot.search_indexes.clear()
+        bot.renders.clear()
+
+    results = []
+    for name, make_call in scenarios:
+        await make_call()  # calentar (y rellenar cachés)
+
+        latencies = []
+        db_before = sum(round_trips.values())
+        tg_before = sum(request.calls.values())
+        for _ in range(iterations):
+            if cold:
+                reset_caches()
+            started = time.perf_counter()
+            await make_call()
+            latencies.append(time.perf_counter() - started)
+        db_calls = (sum(round_trips.values()) - db_before) / iterations
+        tg_calls = (sum(request.calls.values()) - tg_before) / iterations
+
+        # Memoria: pasada aparte para que tracemalloc no distorsione las latencias
+        tracemalloc.start()
+        peaks = []
+        for _ in range(alloc_iterations):
+            if cold:
+                reset_caches()
+            tracemalloc.reset_peak()
+            current, _ = tracemalloc.get_traced_memory()
+            await make_call()
+            peaks.append(tracemalloc.get_traced_memory()[1] - current)
+        tracemalloc.stop()
+
+        results.append((name, app.percentile(latencies, 50), app.percentile(latencies, 95),
+                        db_calls, tg_calls, sum(peaks) / len(peaks) / 1024))
+
+    await telegram_bot.shutdown()
+    await storage.close()
+    return results
+
+
+def print_results(results, args):
+    print(
+        f"\nBenchmark de handlers · {args.iterations} iteraciones · latencia BD {args.latency_ms}ms · "
+        f"{args.products} productos · {args.recipes} recetas · cachés {'frías' if args.cold else 'calientes'}\n"
+    )
+    header = f"{'handler':<28}{'p50 ms':>9}{'p95 ms':>9}{'BD/llamada':>12}{'TG/llamada':>12}{'KiB/llamada':>13}"
+    print(header)
+    print("-" * len(header))
+    for name, p50, p95, db_calls, tg_calls, kib in results:
+        print(f"{name:<28}{p50 * 1000:>9.2f}{p95 * 1000:>9.2f}{db_calls:>12.1f}{tg_calls:>12.1f}{kib:>13.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de latencia de los handlers de FamilyMealBot")
+    parser.add_argument("--iterations", type=int, default=100)
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="latencia simulada por consulta a la BD")
+    parser.add_argument("--products", type=int, default=60)
+    parser.add_argument("--recipes", type=int, default=20)
+    parser.add_argument("--cold", action="store_true", help="vaciar las cachés del bot antes de cada llamada")
+    parser.add_argument("--alloc-iterations", type=int, default=10)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    results = asyncio.run(run_benchmark(
+        args.iterations, args.latency_ms, args.products, args.recipes, args.cold, args.alloc_iterations
+    ))
+    print_results(results, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""
+FamilyMeal Bot - Bus de invalidación
+Avisa a todas las réplicas del bot de que los datos de una familia han cambiado,
+para que descarten lo que tengan cacheado. Cada aviso es un dict:
+{origin, family_id, entity, version}; family_id None significa "descartarlo todo".
+"""
+
+import asyncio
+import json
+import logging
+from abc import ABC, abstractmethod
+
+try:
+    import asyncpg
+except ImportError:  # solo hace falta con INVALIDATION_BUS=postgres
+    asyncpg = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHANNEL = "familymeal_invalidation"
+
+# Aviso de "descartarlo todo" (tras perder avisos)
+FLUSH_ALL = {"origin": None, "family_id": None, "entity": None, "version": None}
+
+
+class InvalidationBus(ABC):
+    """Transporte de avisos de cambio entre réplicas"""
+
+    @abstractmethod
+    async def start(self, handler):
+        """Empezar a entregar a `handler(message)` los avisos publicados"""
+
+    @abstractmethod
+    async def publish(self, message: dict):
+        """
+        Publicar un aviso sin esperar a la red; nunca lanza. Si un aviso se pierde, el bus
+        avisa a todas las réplicas de que lo descarten todo en cuanto puede volver a publicar
+        """
+
+    async def close(self):
+        pass
+
+
+class LocalBus(InvalidationBus):
+    """
+    Bus en memoria: entrega cada aviso a todos los suscriptores del mismo proceso.
+    Basta con una sola réplica, y sirve para simular varias compartiendo una instancia.
+    """
+
+    def __init__(self):
+        self._handlers = []
+
+    async def start(self, handler):
+        self._handlers.append(handler)
+
+    async def publish(self, message):
+        for handler in self._handlers:
+            try:
+                handler(message)
+            except Exception as e:
+                logger.error(f"❌ Error aplicando invalidación {message}: {e}")
+
+    async def close(self):
+        self._handlers.clear()
+
+
+class PostgresBus(InvalidationBus):
+    """
+    Bus sobre LISTEN/NOTIFY de Postgres (la propia base de datos de Supabase).
+    Mantiene una conexión dedicada y se reconecta sola. Tras una reconexión entrega
+    un aviso de "descartarlo todo" a esta réplica, porque pudo perder avisos mientras
+    estaba caída; y si fue esta réplica la que no pudo publicar, lo publica para todas.
+    Los avisos se envían en segundo plano, en orden, desde una cola.
+    """
+
+    MAX_RECONNECT_DELAY = 30
+    MAX_PENDING = 10000
+
+    def __init__(self, dsn: str, channel: str = DEFAULT_CHANNEL):
+        self.dsn = dsn
+        self.channel = channel
+        self._handler = None
+        self._conn = None
+        self._pending = asyncio.Queue(self.MAX_PENDING)
+        self._dropped = False
+        self._tasks = []
+
+    async def start(self, handler):
+        if asyncpg is None:
+            raise RuntimeError("INVALIDATION_BUS=postgres necesita el paquete asyncpg (pip install asyncpg)")
+        self._handler = handler
+        self._tasks = [asyncio.create_task(self._listen_forever()), asyncio.create_task(self._send_forever())]
+
+    async def _listen_forever(self):
+        delay = 1
+        connected_before = False
+        while True:
+            conn = None
+            try:
+                conn = await asyncpg.connect(self.dsn)
+                lost = asyncio.Event()
+                conn.add_termination_listener(lambda _: lost.set())
+                await conn.add_listener(self.channel, self._on_notify)
+                self._conn = conn
+                logger.info(f"📡 Bus de invalidación escuchando en '{self.channel}'")
+                if connected_before:
+                    self._deliver(FLUSH_ALL)
+                if self._dropped:
+                    # Las demás réplicas no recibieron nuestros avisos perdidos
+                    self._dropped = False
+                    self._enqueue(FLUSH_ALL)
+                connected_before = True
+                delay = 1
+                await lost.wait()
+                logger.warning("⚠️ Conexión del bus de invalidación perdida")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Error en el bus de invalidación: {e}")
+            finally:
+                self._conn = None
+                if conn is not None and not conn.is_closed():
+                    await conn.close()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.MAX_RECONNECT_DELAY)
+
+    def _on_notify(self, connection, pid, channel, payload):
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            logger.warning(f"⚠️ Aviso de invalidación no válido: {payload!r}")
+            return
+        self._deliver(message)
+
+    def _deliver(self, message):
+        try:
+            self._handler(message)
+        except Exception as e:
+            logger.error(f"❌ Error aplicando invalidación {message}: {e}")
+
+    def _enqueue(self, message):
+        try:
+            self._pending.put_nowait(message)
+        except asyncio.QueueFull:
+            logger.warning(f"⚠️ Cola del bus de invalidación llena, aviso perdido: {message}")
+            self._dropped = True
+
+    async def _send_forever(self):
+        # Una conexión de asyncpg no admite operaciones simultáneas: un único emisor
+        while True:
+            message = await self._pending.get()
+            conn = self._conn
+            if conn is None:
+                logger.warning(f"⚠️ Bus de invalidación desconectado, aviso perdido: {message}")
+                self._dropped = True
+                continue
+            try:
+                await conn.execute("select pg_notify($1, $2)", self.channel, json.dumps(message))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Error publicando invalidación: {e}")
+                if message is not FLUSH_ALL and self._conn is conn and not conn.is_closed():
+                    # Sigue conectado: avisar ya de que lo descarten todo
+                    self._enqueue(FLUSH_ALL)
+                else:
+                    self._dropped = True
+
+    async def publish(self, message):
+        self._enqueue(message)
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
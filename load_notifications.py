@@ -0,0 +1,195 @@
+"""
+FamilyMeal Bot - Carga sintética de notificaciones
+Llena un backend SQLite con N familias (M miembros, R recetas y una semana de
+meal_plans con recordatorio de descongelar), dispara el tick de las 22:00 de
+NotificationScheduler.check_and_send_reminders contra un Telegram falso y muestra,
+para cada N: recordatorios por segundo, duración del tick, consultas a la BD por
+recordatorio, mensajes enviados y pico de memoria.
+
+Uso:
+    python load_notifications.py --families 10,100,1000 --members 3 --recipes 6
+    python load_notifications.py --mode plan --send-rate 25   # ritmo real de Telegram
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from telegram import Bot
+
+import telegram_bot_with_notifications as app
+from bench_handlers import FakeTelegramRequest, latency_storage
+from storage import create_sqlite_storage
+
+REMINDER_TIME = "22:00:00"
+
+
+# ========== DATOS ==========
+
+async def seed_families(storage, families: int, members: int, recipes: int, start_date):
+    """N familias con miembros, un producto del congelador, recetas y 7 días x 2 comidas planificadas"""
+    telegram_ids = iter(range(1, families * members + 1))
+    week = [start_date + timedelta(days=i) for i in range(7)]
+    for f in range(families):
+        users = [
+            await storage.users.create({"telegram_id": next(telegram_ids), "username": f"load{f}_{m}"})
+            for m in range(members)
+        ]
+        family = await storage.users.create_family({
+            "name": f"Familia {f}", "invite_code": f"LOAD{f:06d}", "created_by": users[0]['id']
+        })
+        for user in users:
+            await storage.members.add({"family_id": family['id'], "user_id": user['id'], "role": "member"})
+
+        frozen = await storage.inventory.add({
+            "family_id": family['id'], "section": "Congelador", "name": "Pollo", "quantity": "2", "stock": 2
+        })
+        fresh = await storage.inventory.add({
+            "family_id": family['id'], "section": "Frigo", "name": "Nata", "quantity": "1", "stock": 1
+        })
+        recipe_ids = []
+        for r in range(recipes):
+            recipe = await storage.recipes.create_with_ingredients({
+                "family_id": family['id'], "name": f"Receta {r}", "created_by": users[0]['id'],
+                "needs_defrost": True, "defrost_reminder_time": REMINDER_TIME,
+            }, [
+                {"ingredient_name": item['name'], "quantity": "1", "product_id": item['id'], "section": item['section']}
+                for item in (frozen, fresh)
+            ])
+            recipe_ids.append(recipe['id'])
+
+        for d, date in enumerate(week):
+            for m, meal_type in enumerate(app.MEALS):
+                await storage.meal_plans.upsert_slot({
+                    "family_id": family['id'], "date": str(date), "meal_type": meal_type,
+                    "recipe_id": recipe_ids[(d * len(app.MEALS) + m) % len(recipe_ids)],
+                    "created_by": users[0]['id'], "defrost_reminder_time": REMINDER_TIME,
+                })
+
+
+async def count_outbox(storage):
+    """Filas del outbox por estado"""
+    def _count(conn):
+        return Counter(dict(conn.execute("select status, count(*) from reminder_outbox group by status").fetchall()))
+    return await storage.reminders.db.run(_count)
+
+
+async def reset_outbox(storage):
+    """Volver a dejar pendientes los recordatorios ya enviados (para repetir el tick)"""
+    def _reset(conn):
+        conn.execute("""
+            update reminder_outbox
+            set status = 'pending', attempts = 0, lease_until = null, delivered_to = '[]',
+                next_attempt_at = due_at, sent_at = null, last_error = null
+            where status != 'cancelled'
+        """)
+    await storage.reminders.db.run(_reset)
+
+
+# ========== EJECUCIÓN ==========
+
+async def run_load(families: int, members: int, recipes: int, latency_ms: float, send_rate: float,
+                   telegram_latency_ms: float):
+    workdir = tempfile.mkdtemp(prefix="familymeal_load_")
+    raw_storage = create_sqlite_storage(os.path.join(workdir, "load.db"))
+    round_trips = Counter()
+    storage = latency_storage(raw_storage, latency_ms / 1000, round_trips)
+
+    request = FakeTelegramRequest(telegram_latency_ms / 1000)
+    telegram_bot = Bot("123456:LOAD", request=request, get_updates_request=FakeTelegramRequest())
+    await telegram_bot.initialize()
+
+    # La semana empieza mañana: el tick de hoy a las 22:00 avisa de las comidas de mañana
+    today = datetime.now().date()
+    tick_at = datetime.combine(today, datetime.strptime(REMINDER_TIME, "%H:%M:%S").time())
+    await seed_families(raw_storage, families, members, recipes, today + timedelta(days=1))
+
+    scheduler = app.NotificationScheduler(SimpleNamespace(bot=telegram_bot), storage)
+    scheduler.delivery = app.DeliveryEngine(telegram_bot, rate=send_rate)
+    await scheduler.load_schedule()
+
+    # Pasada cronometrada
+    round_trips.clear()
+    request.sent.clear()
+    started = time.monotonic()
+    await scheduler.check_and_send_reminders(tick_at)
+    elapsed = time.monotonic() - started
+    reminders = (await count_outbox(raw_storage))["sent"]
+    messages = len(request.sent)
+    send_times = sorted(sent_at - started for _, _, sent_at in request.sent)
+    db_queries = sum(round_trips.values())
+
+    # Pasada aparte con tracemalloc para que no distorsione los tiempos
+    await reset_outbox(raw_storage)
+    tracemalloc.start()
+    await scheduler.check_and_send_reminders(tick_at)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    await telegram_bot.shutdown()
+    await raw_storage.close()
+    shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        "families": families,
+        "reminders": reminders,
+        "messages": messages,
+        "tick": elapsed,
+        "reminders_per_s": reminders / elapsed if elapsed else 0,
+        "first_send": send_times[0] if send_times else 0,
+        "last_send": send_times[-1] if send_times else 0,
+        "db_per_reminder": db_queries / reminders if reminders else 0,
+        "peak_mib": peak / 1024 / 1024,
+    }
+
+
+def print_results(results, args):
+    print(
+        f"\nCarga de notificaciones · modo {args.mode} · {args.members} miembros · {args.recipes} recetas · "
+        f"latencia BD {args.latency_ms}ms · Telegram {args.telegram_latency_ms}ms · ritmo {args.send_rate:g} msg/s\n"
+    )
+    header = (
+        f"{'familias':>9}{'recordat.':>11}{'mensajes':>10}{'tick s':>9}{'record./s':>11}"
+        f"{'1er envío s':>13}{'últ. envío s':>14}{'BD/record.':>12}{'pico MiB':>10}"
+    )
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(
+            f"{r['families']:>9}{r['reminders']:>11}{r['messages']:>10}{r['tick']:>9.2f}"
+            f"{r['reminders_per_s']:>11.1f}{r['first_send']:>13.3f}{r['last_send']:>14.3f}"
+            f"{r['db_per_reminder']:>12.3f}{r['peak_mib']:>10.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Carga sintética del pipeline de recordatorios de FamilyMealBot")
+    parser.add_argument("--families", default="10,100,1000", help="lista de N separados por comas")
+    parser.add_argument("--members", type=int, default=3)
+    parser.add_argument("--recipes", type=int, default=6)
+    parser.add_argument("--mode", choices=("digest", "plan"), default=app.REMINDER_MODE)
+    parser.add_argument("--latency-ms", type=float, default=5.0, help="latencia simulada por consulta a la BD")
+    parser.add_argument("--telegram-latency-ms", type=float, default=30.0, help="latencia simulada de sendMessage")
+    parser.add_argument("--send-rate", type=float, default=1000.0,
+                        help="msg/s del DeliveryEngine (Telegram permite ~30; alto para medir el pipeline)")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    app.REMINDER_MODE = args.mode
+    results = []
+    for families in (int(n) for n in args.families.split(",")):
+        results.append(asyncio.run(run_load(
+            families, args.members, args.recipes, args.latency_ms, args.send_rate, args.telegram_latency_ms
+        )))
+    print_results(results, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+"""
+FamilyMeal Bot - Métricas
+Contadores, gauges e histogramas en memoria, expuestos en formato de texto de Prometheus
+"""
+
+import asyncio
+import bisect
+import time
+from functools import wraps
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Base de las métricas: nombre, ayuda y nombres de etiquetas"""
+
+    type_name = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}: etiquetas {sorted(labels)} != {sorted(self.labelnames)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self):
+        for key, value in sorted(self._values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Counter(Metric):
+    """Valor que solo crece"""
+
+    type_name = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        if amount < 0:
+            raise ValueError(f"{self.name}: un contador no puede decrecer")
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    """Valor que sube y baja; opcionalmente calculado al exportar"""
+
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self._function = function
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def set_function(self, function):
+        """Calcular el valor (sin etiquetas) en cada exportación"""
+        self._function = function
+
+    def _samples(self):
+        if self._function is not None:
+            yield f"{self.name} {_format_value(self._function())}"
+            return
+        yield from super()._samples()
+
+
+class Histogram(Metric):
+    """Distribución de valores (latencias) en buckets acumulados"""
+
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self._values.get(key)
+        if series is None:
+            series = self._values[key] = {"buckets": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+        series["buckets"][bisect.bisect_left(self.buckets, value)] += 1
+        series["sum"] += value
+        series["count"] += 1
+
+    def time(self, **labels):
+        """Context manager que observa la duración del bloque"""
+        return _Timer(self, labels)
+
+    def get_count(self, **labels):
+        series = self._values.get(self._key(labels))
+        return series["count"] if series else 0
+
+    def _samples(self):
+        for key, series in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series["buckets"]):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, [("le", _format_value(bound))])
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(series['sum'])}"
+            yield f"{self.name}_count{labels} {series['count']}"
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+class Registry:
+    """Conjunto de métricas exportadas juntas"""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Métrica duplicada: {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames=(), function=None):
+        return self._register(Gauge(name, documentation, labelnames, function))
+
+    def histogram(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        """Texto en formato de exposición de Prometheus (version 0.0.4)"""
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+REGISTRY = Registry()
+
+
+def timed(function, latency: Histogram, errors: Counter, **labels):
+    """Envolver una corrutina para observar su duración y contar las excepciones"""
+
+    @wraps(function)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await function(*args, **kwargs)
+        except Exception:
+            errors.inc(**labels)
+            raise
+        finally:
+            latency.observe(time.perf_counter() - started, **labels)
+    return wrapper
+
+
+class InstrumentedProxy:
+    """
+    Envuelve un objeto (p. ej. un repositorio): cada llamada a uno de sus métodos
+    asíncronos se mide con `labels` + operation=<nombre del método>.
+    """
+
+    def __init__(self, target, latency: Histogram, errors: Counter, **labels):
+        self._target = target
+        self._latency = latency
+        self._errors = errors
+        self._labels = labels
+        self._wrapped = {}
+
+    def __getattr__(self, attr):
+        wrapped = self._wrapped.get(attr)
+        if wrapped is not None:
+            return wrapped
+        value = getattr(self._target, attr)
+        if not asyncio.iscoroutinefunction(value):
+            return value
+        wrapped = self._wrapped[attr] = timed(value, self._latency, self._errors, operation=attr, **self._labels)
+        return wrapped
@@ -0,0 +1,23 @@
+-- Guardar una receta y todos sus ingredientes en una sola llamada (y una sola transacción).
+-- Uso desde el bot: db.rpc("create_recipe_with_ingredients", {"p_recipe": {...}, "p_ingredients": [...]})
+
+create or replace function public.create_recipe_with_ingredients(p_recipe jsonb, p_ingredients jsonb)
+returns setof public.recipes
+language plpgsql
+as $$
+declare
+    v_recipe public.recipes;
+begin
+    insert into public.recipes (family_id, name, created_by, needs_defrost, defrost_reminder_time, created_at)
+    select r.family_id, r.name, r.created_by, coalesce(r.needs_defrost, false), r.defrost_reminder_time,
+           coalesce(r.created_at, now())
+    from jsonb_populate_record(null::public.recipes, p_recipe) as r
+    returning * into v_recipe;
+
+    insert into public.recipe_ingredients (recipe_id, ingredient_name, quantity, created_at)
+    select v_recipe.id, i.ingredient_name, i.quantity, coalesce(i.created_at, now())
+    from jsonb_populate_recordset(null::public.recipe_ingredients, coalesce(p_ingredients, '[]'::jsonb)) as i;
+
+    return next v_recipe;
+end;
+$$;
@@ -0,0 +1,39 @@
+-- Enlazar cada ingrediente de receta con su producto de inventario y su sección,
+-- para que los recordatorios de descongelar no tengan que buscar por nombre.
+
+alter table public.recipe_ingredients
+    add column if not exists product_id uuid references public.inventory(id) on delete set null,
+    add column if not exists section text;
+
+create index if not exists recipe_ingredients_recipe_id_idx on public.recipe_ingredients (recipe_id);
+
+-- Rellenar los ingredientes existentes a partir del inventario de la familia
+update public.recipe_ingredients ri
+set product_id = i.id,
+    section = i.section
+from public.recipes r, public.inventory i
+where ri.recipe_id = r.id
+  and i.family_id = r.family_id
+  and lower(i.name) = lower(ri.ingredient_name)
+  and ri.product_id is null;
+
+create or replace function public.create_recipe_with_ingredients(p_recipe jsonb, p_ingredients jsonb)
+returns setof public.recipes
+language plpgsql
+as $$
+declare
+    v_recipe public.recipes;
+begin
+    insert into public.recipes (family_id, name, created_by, needs_defrost, defrost_reminder_time, created_at)
+    select r.family_id, r.name, r.created_by, coalesce(r.needs_defrost, false), r.defrost_reminder_time,
+           coalesce(r.created_at, now())
+    from jsonb_populate_record(null::public.recipes, p_recipe) as r
+    returning * into v_recipe;
+
+    insert into public.recipe_ingredients (recipe_id, ingredient_name, quantity, product_id, section, created_at)
+    select v_recipe.id, i.ingredient_name, i.quantity, i.product_id, i.section, coalesce(i.created_at, now())
+    from jsonb_populate_recordset(null::public.recipe_ingredients, coalesce(p_ingredients, '[]'::jsonb)) as i;
+
+    return next v_recipe;
+end;
+$$;
@@ -0,0 +1,13 @@
+-- Un único meal_plan por hueco (familia, día, comida/cena), para poder asignarlo
+-- con un solo upsert y evitar duplicados cuando dos miembros eligen a la vez.
+
+-- Quitar duplicados existentes, quedándonos con el más reciente de cada hueco
+delete from public.meal_plans mp
+using public.meal_plans newer
+where mp.family_id = newer.family_id
+  and mp.date = newer.date
+  and mp.meal_type = newer.meal_type
+  and (mp.created_at, mp.id::text) < (newer.created_at, newer.id::text);
+
+alter table public.meal_plans
+    add constraint meal_plans_family_date_meal_key unique (family_id, date, meal_type);
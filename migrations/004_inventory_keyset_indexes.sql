@@ -0,0 +1,8 @@
+-- Índices para paginar el inventario por (name, id) sin OFFSET:
+-- lista de compra (toda la familia) y selector de ingredientes (por sección).
+
+create index if not exists inventory_family_name_idx
+    on public.inventory (family_id, name, id);
+
+create index if not exists inventory_family_section_name_idx
+    on public.inventory (family_id, section, name, id);
@@ -0,0 +1,59 @@
+-- Cocinar comidas del menú: marcarlas como cocinadas y descontar del inventario las
+-- unidades de todos sus ingredientes enlazados, en una sola sentencia (sin leer y
+-- escribir producto a producto). Sirve para una comida (p_start = p_end y p_meal_type)
+-- o para un rango de días. Solo cuenta las comidas que aún no estaban cocinadas.
+-- El stock nunca baja de 0; los productos que llegan a 0 aparecen en la lista de compra.
+-- Cantidades: la misma regla que storage.parse_quantity (QUANTITY_PATTERN): un número con
+-- coma o punto decimal cuenta por su parte entera; cualquier otra cosa ("2 kg", "-1"), 1.
+
+create or replace function public.cook_meal_plans(
+    p_family_id uuid,
+    p_start date,
+    p_end date,
+    p_meal_type text default null,
+    p_cooked_at timestamptz default now()
+)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_result jsonb;
+begin
+    with cooked as (
+        update public.meal_plans
+        set is_cooked = true, cooked_at = p_cooked_at
+        where family_id = p_family_id
+          and date between p_start and p_end
+          and (p_meal_type is null or meal_type = p_meal_type)
+          and is_cooked is not true
+        returning recipe_id
+    ),
+    consumed as (
+        select ri.product_id,
+               sum(
+                   case when ri.quantity::text ~ '^[ \t\r\n]*([0-9]+)([.,][0-9]+)?[ \t\r\n]*$'
+                        then floor(replace(ri.quantity::text, ',', '.')::numeric)::int
+                        else 1
+                   end
+               ) as units
+        from cooked c
+        join public.recipe_ingredients ri on ri.recipe_id = c.recipe_id
+        where ri.product_id is not null
+        group by ri.product_id
+    ),
+    updated as (
+        update public.inventory i
+        set stock = greatest(i.stock - c.units, 0)
+        from consumed c
+        where i.id = c.product_id
+          and i.family_id = p_family_id
+        returning i.id, i.name, i.section, i.stock
+    )
+    select jsonb_build_object(
+        'cooked', (select count(*) from cooked),
+        'products', coalesce((select jsonb_agg(to_jsonb(u)) from updated u), '[]'::jsonb)
+    ) into v_result;
+
+    return v_result;
+end;
+$$;
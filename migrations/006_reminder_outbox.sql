@@ -0,0 +1,50 @@
+-- Outbox de recordatorios: cada recordatorio de descongelar es una fila con su hora
+-- (due_at) y una clave de idempotencia (un recordatorio por meal_plan y hora). El
+-- scheduler la reclama por lotes con claim_reminders(), que la marca como 'sending'
+-- con un lease; dos réplicas (o dos ticks solapados) nunca reclaman la misma fila.
+-- delivered_to guarda los chats ya avisados, para que un reintento no los repita.
+-- Estados: pending → sending → sent | failed | expired | cancelled
+
+create table if not exists public.reminder_outbox (
+    id uuid primary key default gen_random_uuid(),
+    idempotency_key text not null unique,
+    family_id uuid not null references public.families(id) on delete cascade,
+    meal_plan_id uuid not null references public.meal_plans(id) on delete cascade,
+    due_at timestamp not null,
+    next_attempt_at timestamp not null,
+    status text not null default 'pending',
+    attempts int not null default 0,
+    lease_until timestamp,
+    delivered_to jsonb not null default '[]'::jsonb,
+    last_error text,
+    sent_at timestamp,
+    created_at timestamptz not null default now()
+);
+
+create index if not exists reminder_outbox_due_idx
+    on public.reminder_outbox (next_attempt_at)
+    where status in ('pending', 'sending');
+create index if not exists reminder_outbox_meal_plan_idx
+    on public.reminder_outbox (meal_plan_id);
+
+create or replace function public.claim_reminders(
+    p_now timestamp,
+    p_lease_until timestamp,
+    p_limit int default 100
+)
+returns setof public.reminder_outbox
+language sql
+as $$
+    update public.reminder_outbox o
+    set status = 'sending', lease_until = p_lease_until, attempts = o.attempts + 1
+    where o.id in (
+        select id
+        from public.reminder_outbox
+        where next_attempt_at <= p_now
+          and (status = 'pending' or (status = 'sending' and lease_until < p_now))
+        order by next_attempt_at
+        limit p_limit
+        for update skip locked
+    )
+    returning o.*;
+$$;
@@ -0,0 +1,28 @@
+-- Modo resumen (REMINDER_MODE=digest): al reclamar el primer recordatorio de una
+-- familia, reclamar también los demás pendientes de esa familia que tocan antes de
+-- p_until (el resto del día), para mandarlos todos en un único mensaje por miembro.
+-- Los que esperan un reintento (attempts > 0) solo si ya les toca en p_now: el resumen
+-- no se salta su espera. Mismo lease y mismo bloqueo que claim_reminders (migrations/006).
+
+create or replace function public.claim_family_reminders(
+    p_family_ids uuid[],
+    p_now timestamp,
+    p_until timestamp,
+    p_lease_until timestamp
+)
+returns setof public.reminder_outbox
+language sql
+as $$
+    update public.reminder_outbox o
+    set status = 'sending', lease_until = p_lease_until, attempts = o.attempts + 1
+    where o.id in (
+        select id
+        from public.reminder_outbox
+        where family_id = any(p_family_ids)
+          and status = 'pending'
+          and next_attempt_at < p_until
+          and (attempts = 0 or next_attempt_at <= p_now)
+        for update skip locked
+    )
+    returning o.*;
+$$;
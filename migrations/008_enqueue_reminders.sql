@@ -0,0 +1,30 @@
+-- Encolar recordatorios en una sola transacción (migrations/006):
+--  * una clave nueva se inserta como 'pending';
+--  * una clave ya cancelada vuelve a 'pending' desde cero: upsert_slot conserva el id
+--    del meal_plan, así que volver a poner la misma receta reutiliza la clave;
+--  * una clave enviada, fallida o caducada no se toca (nunca se envía dos veces);
+--  * los pendientes de esos meal_plans con otra clave (hora cambiada) se cancelan.
+
+create or replace function public.enqueue_reminders(p_reminders jsonb)
+returns void
+language plpgsql
+as $$
+begin
+    insert into public.reminder_outbox as o
+        (idempotency_key, family_id, meal_plan_id, due_at, next_attempt_at)
+    select r.idempotency_key, r.family_id, r.meal_plan_id, r.due_at, r.due_at
+    from jsonb_to_recordset(p_reminders)
+        as r(idempotency_key text, family_id uuid, meal_plan_id uuid, due_at timestamp)
+    on conflict (idempotency_key) do update
+    set status = 'pending', attempts = 0, next_attempt_at = excluded.next_attempt_at,
+        delivered_to = '[]'::jsonb, lease_until = null, last_error = null, sent_at = null
+    where o.status = 'cancelled';
+
+    update public.reminder_outbox o
+    set status = 'cancelled'
+    from jsonb_to_recordset(p_reminders) as r(idempotency_key text, meal_plan_id uuid)
+    where o.meal_plan_id = r.meal_plan_id
+      and o.status = 'pending'
+      and o.idempotency_key <> r.idempotency_key;
+end;
+$$;
@@ -0,0 +1,1207 @@
+"""
+FamilyMeal Bot - Capa de persistencia
+Un repositorio por agregado (usuarios/familias, miembros, inventario, recetas y
+menú semanal) con dos implementaciones: Supabase (PostgREST) y SQLite embebido.
+"""
+
+import asyncio
+import json
+import logging
+import re
+import sqlite3
+import uuid
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+
+import httpx
+from postgrest import AsyncPostgrestClient
+from postgrest.constants import DEFAULT_POSTGREST_CLIENT_HEADERS
+
+logger = logging.getLogger(__name__)
+
+# Columnas del catálogo de recetas que se cachean en memoria
+RECIPE_CATALOG_FIELDS = ("id", "name", "needs_defrost", "defrost_reminder_time")
+
+# Cantidad de un ingrediente: un número, con coma o punto decimal, y nada más. Es la
+# misma expresión que usa cook_meal_plans (migrations/005); SQLite llama a parse_quantity
+QUANTITY_PATTERN = re.compile(r"^[ \t\r\n]*([0-9]+)([.,][0-9]+)?[ \t\r\n]*$")
+
+
+def parse_quantity(quantity):
+    """Cantidad de un ingrediente como número de unidades (su parte entera; 1 si no es un número)"""
+    match = QUANTITY_PATTERN.match(str(quantity))
+    return int(match.group(1)) if match else 1
+
+
+# ========== INTERFACES ==========
+
+class UserRepository(ABC):
+    """Usuarios y familias"""
+
+    @abstractmethod
+    async def get_by_telegram_id(self, telegram_id: int):
+        """Usuario con ese telegram_id, o None"""
+
+    @abstractmethod
+    async def create(self, user_data: dict):
+        """Crear usuario y devolverlo"""
+
+    @abstractmethod
+    async def create_family(self, family_data: dict):
+        """Crear familia y devolverla"""
+
+    @abstractmethod
+    async def get_family_by_invite_code(self, invite_code: str):
+        """Familia con ese código de invitación, o None"""
+
+
+class MemberRepository(ABC):
+    """Pertenencia de usuarios a familias"""
+
+    @abstractmethod
+    async def add(self, member_data: dict):
+        """Añadir un usuario a una familia"""
+
+    @abstractmethod
+    async def get_family_for_user(self, user_id: str):
+        """Familia {id, name, invite_code} del usuario, o None"""
+
+    @abstractmethod
+    async def list_members(self, family_id: str):
+        """Miembros de la familia: [{role, username, telegram_id}]"""
+
+
+class InventoryRepository(ABC):
+    """Productos del inventario"""
+
+    @abstractmethod
+    async def list_in_stock(self, family_id: str, section: str = None):
+        """Productos con stock > 0 (de una sección o de todas)"""
+
+    @abstractmethod
+    async def list_out_of_stock(self, family_id: str):
+        """Productos con stock = 0"""
+
+    @abstractmethod
+    async def list_products(self, family_id: str):
+        """Todos los productos de la familia (id, name, section, stock)"""
+
+    @abstractmethod
+    async def page_in_stock(self, family_id: str, section: str = None, after: tuple = None, limit: int = 20):
+        """Página de productos con stock > 0 ordenados por (name, id), a partir del cursor `after`"""
+
+    @abstractmethod
+    async def page_out_of_stock(self, family_id: str, after: tuple = None, limit: int = 20):
+        """Página de productos con stock = 0 ordenados por (name, id), a partir del cursor `after`"""
+
+    @abstractmethod
+    async def get(self, item_id: str):
+        """Producto por id, o None"""
+
+    @abstractmethod
+    async def add(self, item_data: dict):
+        """Añadir producto y devolverlo"""
+
+    @abstractmethod
+    async def set_stock(self, item_id: str, stock: int):
+        """Fijar el stock de un producto"""
+
+
+class RecipeRepository(ABC):
+    """Recetas y sus ingredientes"""
+
+    @abstractmethod
+    async def list_catalog(self, family_id: str):
+        """Recetas de la familia (solo RECIPE_CATALOG_FIELDS)"""
+
+    @abstractmethod
+    async def get(self, recipe_id: str):
+        """Receta por id (solo RECIPE_CATALOG_FIELDS), o None"""
+
+    @abstractmethod
+    async def create_with_ingredients(self, recipe_data: dict, ingredients: list):
+        """Crear receta e ingredientes de forma atómica y devolver la receta"""
+
+    @abstractmethod
+    async def list_ingredients(self, recipe_id: str):
+        """Ingredientes: [{ingredient_name, quantity, section, inventory: {section}}]"""
+
+
+class MealPlanRepository(ABC):
+    """Menú semanal"""
+
+    @abstractmethod
+    async def list_range(self, family_id: str, start: str, end: str):
+        """Comidas entre dos fechas, con recipes: {name, needs_defrost}"""
+
+    @abstractmethod
+    async def list_range_ingredients(self, family_id: str, start: str, end: str):
+        """
+        Ingredientes de las comidas sin cocinar entre dos fechas, en una sola consulta:
+        [{ingredient_name, quantity, product_id, section, inventory: {id, name, section, stock}}]
+        (una fila por ingrediente y comida)
+        """
+
+    @abstractmethod
+    async def upsert_slot(self, plan_data: dict):
+        """Guardar la comida de un hueco (family_id, date, meal_type) y devolverla"""
+
+    @abstractmethod
+    async def delete_slot(self, family_id: str, date: str, meal_type: str):
+        """Borrar la comida de un hueco; devuelve las filas borradas"""
+
+    @abstractmethod
+    async def delete_range(self, family_id: str, start: str, end: str):
+        """Borrar las comidas entre dos fechas; devuelve las filas borradas"""
+
+    @abstractmethod
+    async def cook_range(self, family_id: str, start: str, end: str, cooked_at: str, meal_type: str = None):
+        """
+        Marcar como cocinadas las comidas sin cocinar entre dos fechas (o solo las de un
+        meal_type) y descontar del stock las unidades de sus ingredientes, de forma atómica.
+        Devuelve {cooked: nº de comidas, products: [{id, name, section, stock}] actualizados}
+        """
+
+    @abstractmethod
+    async def list_with_reminders(self, from_date: str):
+        """Comidas desde una fecha con recordatorio: [{id, family_id, date, defrost_reminder_time}]"""
+
+    @abstractmethod
+    async def get_for_reminders(self, plan_ids: list):
+        """
+        Comidas por id con families: {id, name, members: [telegram_id]} y
+        recipes: {name, needs_defrost, recipe_ingredients}, todo en una consulta
+        """
+
+
+class ReminderOutboxRepository(ABC):
+    """
+    Outbox de recordatorios (migrations/006). Las horas son ISO sin zona horaria
+    (hora local del bot), p. ej. "2024-05-06T22:00:00".
+    """
+
+    @abstractmethod
+    async def enqueue(self, reminders: list):
+        """
+        Encolar [{idempotency_key, family_id, meal_plan_id, due_at}]. Una clave cancelada
+        vuelve a 'pending' desde cero; las demás claves ya encoladas se ignoran. Los
+        pendientes de esos meal_plans con otra clave se cancelan
+        """
+
+    @abstractmethod
+    async def cancel(self, meal_plan_ids: list):
+        """Cancelar los recordatorios pendientes de esos meal_plans"""
+
+    @abstractmethod
+    async def claim_due(self, now: str, lease_until: str, limit: int = 100):
+        """
+        Reclamar hasta `limit` recordatorios que ya tocan (pendientes o con el lease
+        caducado): pasan a 'sending' hasta lease_until y suman un intento
+        """
+
+    @abstractmethod
+    async def claim_for_families(self, family_ids: list, now: str, until: str, lease_until: str):
+        """
+        Reclamar también los pendientes de esas familias que tocan antes de `until`,
+        para enviarlos juntos en un resumen (los que esperan un reintento, solo si ya
+        toca en `now`)
+        """
+
+    @abstractmethod
+    async def renew_lease(self, reminder_ids: list, lease_until: str):
+        """Alargar el lease de los recordatorios que siguen en 'sending'"""
+
+    @abstractmethod
+    async def finish(self, reminder_id: str, status: str, delivered_to: list,
+                     next_attempt_at: str = None, error: str = None):
+        """Cerrar un intento: 'sent', 'failed', 'expired', 'cancelled' o 'pending' (reintento)"""
+
+
+class Storage:
+    """Conjunto de repositorios de un backend"""
+
+    def __init__(self, users: UserRepository, members: MemberRepository, inventory: InventoryRepository,
+                 recipes: RecipeRepository, meal_plans: MealPlanRepository, reminders: ReminderOutboxRepository,
+                 close=None):
+        self.users = users
+        self.members = members
+        self.inventory = inventory
+        self.recipes = recipes
+        self.meal_plans = meal_plans
+        self.reminders = reminders
+        self._close = close
+
+    async def close(self):
+        if self._close:
+            await self._close()
+
+
+REPOSITORY_NAMES = ("users", "members", "inventory", "recipes", "meal_plans", "reminders")
+
+
+class LazyStorage(Storage):
+    """
+    Storage que crea el backend real (cliente de Supabase, fichero SQLite) en la primera
+    consulta, para que el arranque no espere a montarlo.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._backend = None
+        super().__init__(*(_LazyRepository(self, name) for name in REPOSITORY_NAMES), close=self._close_backend)
+
+    def backend(self) -> Storage:
+        if self._backend is None:
+            self._backend = self._factory()
+            logger.info("🔌 Backend de datos creado")
+        return self._backend
+
+    async def _close_backend(self):
+        if self._backend is not None:
+            await self._backend.close()
+
+
+class _LazyRepository:
+    """Repositorio que delega en el del backend, creándolo al primer uso"""
+
+    def __init__(self, owner: LazyStorage, name: str):
+        self._owner = owner
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(getattr(self._owner.backend(), self._name), attr)
+
+
+# ========== SUPABASE ==========
+
+def _quote(value):
+    """Valor entre comillas para los filtros or/and de PostgREST (admite comas y paréntesis)"""
+    escaped = str(value).replace("\\", "\\\\").replace('"', '\\"')
+    return f'"{escaped}"'
+
+
+class AsyncDatabase(AsyncPostgrestClient):
+    """
+    Cliente PostgREST asíncrono para Supabase.
+    Reutiliza un único pool de conexiones keep-alive (HTTP/2) para que las
+    consultas de distintos usuarios se solapen sin bloquear el event loop.
+    """
+
+    def __init__(self, url: str, key: str, pool_size: int = 20, timeout: float = 10,
+                 keepalive_expiry: float = 60):
+        self.pool_size = pool_size
+        self.keepalive_expiry = keepalive_expiry
+        headers = {
+            **DEFAULT_POSTGREST_CLIENT_HEADERS,
+            "apikey": key,
+            "Authorization": f"Bearer {key}",
+        }
+        super().__init__(f"{url.rstrip('/')}/rest/v1", headers=headers, timeout=timeout)
+
+    def create_session(self, base_url, headers, timeout, verify=True):
+        return httpx.AsyncClient(
+            base_url=base_url,
+            headers=headers,
+            timeout=timeout,
+            verify=verify,
+            follow_redirects=True,
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=self.pool_size,
+                max_keepalive_connections=self.pool_size,
+                keepalive_expiry=self.keepalive_expiry,
+            ),
+        )
+
+
+class SupabaseUserRepository(UserRepository):
+
+    def __init__(self, db: AsyncDatabase):
+        self.db = db
+
+    async def get_by_telegram_id(self, telegram_id):
+        response = await self.db.table("users").select("*").eq("telegram_id", telegram_id).execute()
+        return response.data[0] if response.data else None
+
+    async def create(self, user_data):
+        response = await self.db.table("users").insert(user_data).execute()
+        return response.data[0]
+
+    async def create_family(self, family_data):
+        response = await self.db.table("families").insert(family_data).execute()
+        return response.data[0]
+
+    async def get_family_by_invite_code(self, invite_code):
+        response = await self.db.table("families").select("*").eq("invite_code", invite_code).execute()
+        return response.data[0] if response.data else None
+
+
+class SupabaseMemberRepository(MemberRepository):
+
+    def __init__(self, db: AsyncDatabase):
+        self.db = db
+
+    async def add(self, member_data):
+        response = await self.db.table("family_members").insert(member_data).execute()
+        return response.data[0]
+
+    async def get_family_for_user(self, user_id):
+        response = await self.db.table("family_members")\
+            .select("family_id, families(id, name, invite_code)")\
+            .eq("user_id", user_id)\
+            .execute()
+        if response.data and response.data[0].get('families'):
+            return response.data[0]['families']
+        return None
+
+    async def list_members(self, family_id):
+        response = await self.db.table("family_members")\
+            .select("role, users(username, telegram_id)")\
+            .eq("family_id", family_id)\
+            .execute()
+        return [
+            {
+                "role": member['role'],
+                "username": (member.get('users') or {}).get('username'),
+                "telegram_id": (member.get('users') or {}).get('telegram_id'),
+            }
+            for member in response.data
+        ]
+
+
+class SupabaseInventoryRepository(InventoryRepository):
+
+    def __init__(self, db: AsyncDatabase):
+        self.db = db
+
+    async def list_in_stock(self, family_id, section=None):
+        query = self.db.table("inventory")\
+            .select("id, name, section, stock")\
+            .eq("family_id", family_id)\
+            .gt("stock", 0)
+        if section:
+            query = query.eq("section", section)
+        response = await query.execute()
+        return response.data
+
+    async def list_out_of_stock(self, family_id):
+        response = await self.db.table("inventory")\
+            .select("id, name, section, stock")\
+            .eq("family_id", family_id)\
+            .eq("stock", 0)\
+            .execute()
+        return response.data
+
+    async def list_products(self, family_id):
+        response = await self.db.table("inventory")\
+            .select("id, name, section, stock")\
+            .eq("family_id", family_id)\
+            .execute()
+        return response.data
+
+    async def page_in_stock(self, family_id, section=None, after=None, limit=20):
+        query = self.db.table("inventory")\
+            .select("id, name, section, stock")\
+            .eq("family_id", family_id)\
+            .gt("stock", 0)
+        if section:
+            query = query.eq("section", section)
+        return await self._page(query, after, limit)
+
+    async def page_out_of_stock(self, family_id, after=None, limit=20):
+        query = self.db.table("inventory")\
+            .select("id, name, section, stock")\
+            .eq("family_id", family_id)\
+            .eq("stock", 0)
+        return await self._page(query, after, limit)
+
+    @staticmethod
+    async def _page(query, after, limit):
+        # Keyset: (name, id) > after, sin OFFSET (migrations/004)
+        if after:
+            name, item_id = after
+            query = query.or_(f"name.gt.{_quote(name)},and(name.eq.{_quote(name)},id.gt.{item_id})")
+        response = await query.order("name").order("id").limit(limit).execute()
+        return response.data
+
+    async def get(self, item_id):
+        response = await self.db.table("inventory").select("*").eq("id", item_id).execute()
+        return response.data[0] if response.data else None
+
+    async def add(self, item_data):
+        response = await self.db.table("inventory").insert(item_data).execute()
+        return response.data[0]
+
+    async def set_stock(self, item_id, stock):
+        response = await self.db.table("inventory").update({"stock": stock}).eq("id", item_id).execute()
+        return response.data[0] if response.data else None
+
+
+class SupabaseRecipeRepository(RecipeRepository):
+
+    def __init__(self, db: AsyncDatabase):
+        self.db = db
+
+    async def list_catalog(self, family_id):
+        response = await self.db.table("recipes")\
+            .select(", ".join(RECIPE_CATALOG_FIELDS))\
+            .eq("family_id", family_id)\
+            .execute()
+        return response.data
+
+    async def get(self, recipe_id):
+        response = await self.db.table("recipes")\
+            .select(", ".join(RECIPE_CATALOG_FIELDS))\
+            .eq("id", recipe_id)\
+            .execute()
+        return response.data[0] if response.data else None
+
+    async def create_with_ingredients(self, recipe_data, ingredients):
+        # Receta + ingredientes en una sola llamada atómica (migrations/001, 002)
+        response = await self.db.rpc("create_recipe_with_ingredients", {
+            "p_recipe": recipe_data,
+            "p_ingredients": ingredients
+        }).execute()
+        return response.data[0]
+
+    async def list_ingredients(self, recipe_id):
+        response = await self.db.table("recipe_ingredients")\
+            .select("ingredient_name, quantity, section, inventory(section)")\
+            .eq("recipe_id", recipe_id)\
+            .execute()
+        return response.data
+
+
+class SupabaseMealPlanRepository(MealPlanRepository):
+
+    def __init__(self, db: AsyncDatabase):
+        self.db = db
+
+    async def list_range(self, family_id, start, end):
+        response = await self.db.table("meal_plans")\
+            .select("date, meal_type, meal_text, is_cooked, recipes(name, needs_defrost)")\
+            .eq("family_id", family_id)\
+            .gte("date", start)\
+            .lte("date", end)\
+            .execute()
+        return response.data
+
+    async def list_range_ingredients(self, family_id, start, end):
+        response = await self.db.table("meal_plans")\
+            .select("recipes(recipe_ingredients(ingredient_name, quantity, product_id, section, "
+                    "inventory(id, name, section, stock)))")\
+            .eq("family_id", family_id)\
+            .gte("date", start)\
+            .lte("date", end)\
+            .or_("is_cooked.is.null,is_cooked.is.false")\
+            .execute()
+        return [
+            ingredient
+            for plan in response.data
+            for ingredient in (plan.get('recipes') or {}).get('recipe_ingredients') or []
+        ]
+
+    async def upsert_slot(self, plan_data):
+        # Un único upsert sobre el hueco (family_id, date, meal_type) (migrations/003)
+        response = await self.db.table("meal_plans")\
+            .upsert(plan_data, on_conflict="family_id,date,meal_type")\
+            .execute()
+        return response.data[0]
+
+    async def delete_slot(self, family_id, date, meal_type):
+        response = await self.db.table("meal_plans")\
+            .delete()\
+            .eq("family_id", family_id)\
+            .eq("date", date)\
+            .eq("meal_type", meal_type)\
+            .execute()
+        return response.data
+
+    async def delete_range(self, family_id, start, end):
+        response = await self.db.table("meal_plans")\
+            .delete()\
+            .eq("family_id", family_id)\
+            .gte("date", start)\
+            .lte("date", end)\
+            .execute()
+        return response.data
+
+    async def cook_range(self, family_id, start, end, cooked_at, meal_type=None):
+        # Comidas + stock en una sola sentencia (migrations/005)
+        response = await self.db.rpc("cook_meal_plans", {
+            "p_family_id": family_id,
+            "p_start": start,
+            "p_end": end,
+            "p_meal_type": meal_type,
+            "p_cooked_at": cooked_at
+        }).execute()
+        return response.data
+
+    async def list_with_reminders(self, from_date):
+        response = await self.db.table("meal_plans")\
+            .select("id, family_id, date, defrost_reminder_time")\
+            .gte("date", from_date)\
+            .not_.is_("defrost_reminder_time", "null")\
+            .execute()
+        return response.data
+
+    async def get_for_reminders(self, plan_ids):
+        response = await self.db.table("meal_plans")\
+            .select(
+                "*, families(id, name, family_members(users(telegram_id))), recipes(name, needs_defrost, "
+                "recipe_ingredients(ingredient_name, quantity, section, inventory(section)))"
+            )\
+            .in_("id", plan_ids)\
+            .execute()
+        for plan in response.data:
+            family = plan.get('families')
+            if family is not None:
+                family['members'] = [
+                    (member.get('users') or {}).get('telegram_id') for member in family.pop('family_members') or []
+                ]
+        return response.data
+
+
+class SupabaseReminderOutboxRepository(ReminderOutboxRepository):
+
+    def __init__(self, db: AsyncDatabase):
+        self.db = db
+
+    async def enqueue(self, reminders):
+        if not reminders:
+            return
+        # Insertar, reactivar las canceladas y cancelar las de otra hora en una transacción (migrations/008)
+        await self.db.rpc("enqueue_reminders", {"p_reminders": reminders}).execute()
+
+    async def cancel(self, meal_plan_ids):
+        await self.db.table("reminder_outbox")\
+            .update({"status": "cancelled"})\
+            .in_("meal_plan_id", meal_plan_ids)\
+            .eq("status", "pending")\
+            .execute()
+
+    async def claim_due(self, now, lease_until, limit=100):
+        # Reclamar y marcar en una sola sentencia, con skip locked (migrations/006)
+        response = await self.db.rpc("claim_reminders", {
+            "p_now": now,
+            "p_lease_until": lease_until,
+            "p_limit": limit
+        }).execute()
+        return response.data
+
+    async def claim_for_families(self, family_ids, now, until, lease_until):
+        # Mismo bloqueo que claim_reminders (migrations/007)
+        response = await self.db.rpc("claim_family_reminders", {
+            "p_family_ids": family_ids,
+            "p_now": now,
+            "p_until": until,
+            "p_lease_until": lease_until
+        }).execute()
+        return response.data
+
+    async def renew_lease(self, reminder_ids, lease_until):
+        await self.db.table("reminder_outbox")\
+            .update({"lease_until": lease_until})\
+            .in_("id", reminder_ids)\
+            .eq("status", "sending")\
+            .execute()
+
+    async def finish(self, reminder_id, status, delivered_to, next_attempt_at=None, error=None):
+        changes = {"status": status, "delivered_to": delivered_to, "lease_until": None, "last_error": error}
+        if next_attempt_at:
+            changes["next_attempt_at"] = next_attempt_at
+        if status == "sent":
+            changes["sent_at"] = datetime.now().isoformat(timespec="seconds")
+        await self.db.table("reminder_outbox")\
+            .update(changes)\
+            .eq("id", reminder_id)\
+            .execute()
+
+
+def create_supabase_storage(url: str, key: str, pool_size: int = 20, timeout: float = 10,
+                            keepalive_expiry: float = 60):
+    """Repositorios sobre Supabase, compartiendo un pool de conexiones"""
+    db = AsyncDatabase(url, key, pool_size, timeout, keepalive_expiry)
+    return Storage(
+        users=SupabaseUserRepository(db),
+        members=SupabaseMemberRepository(db),
+        inventory=SupabaseInventoryRepository(db),
+        recipes=SupabaseRecipeRepository(db),
+        meal_plans=SupabaseMealPlanRepository(db),
+        reminders=SupabaseReminderOutboxRepository(db),
+        close=db.aclose,
+    )
+
+
+# ========== SQLITE ==========
+
+SQLITE_SCHEMA = """
+create table if not exists users (
+    id text primary key,
+    telegram_id integer not null unique,
+    email text,
+    username text,
+    created_at text
+);
+
+create table if not exists families (
+    id text primary key,
+    name text not null,
+    invite_code text unique,
+    created_by text references users(id),
+    created_at text
+);
+
+create table if not exists family_members (
+    id text primary key,
+    family_id text not null references families(id) on delete cascade,
+    user_id text not null references users(id) on delete cascade,
+    role text,
+    joined_at text,
+    unique (family_id, user_id)
+);
+create index if not exists family_members_user_idx on family_members (user_id);
+
+create table if not exists inventory (
+    id text primary key,
+    family_id text not null references families(id) on delete cascade,
+    section text not null,
+    name text not null,
+    quantity text,
+    stock integer not null default 0,
+    created_at text
+);
+create index if not exists inventory_family_section_idx on inventory (family_id, section, stock);
+create index if not exists inventory_family_stock_idx on inventory (family_id, stock);
+create index if not exists inventory_family_name_idx on inventory (family_id, name, id);
+create index if not exists inventory_family_section_name_idx on inventory (family_id, section, name, id);
+
+create table if not exists recipes (
+    id text primary key,
+    family_id text not null references families(id) on delete cascade,
+    name text not null,
+    created_by text references users(id),
+    needs_defrost integer not null default 0,
+    defrost_reminder_time text,
+    created_at text
+);
+create index if not exists recipes_family_idx on recipes (family_id);
+
+create table if not exists recipe_ingredients (
+    id text primary key,
+    recipe_id text not null references recipes(id) on delete cascade,
+    ingredient_name text not null,
+    quantity text,
+    product_id text references inventory(id) on delete set null,
+    section text,
+    created_at text
+);
+create index if not exists recipe_ingredients_recipe_idx on recipe_ingredients (recipe_id);
+
+create table if not exists meal_plans (
+    id text primary key,
+    family_id text not null references families(id) on delete cascade,
+    date text not null,
+    meal_type text not null,
+    recipe_id text references recipes(id) on delete set null,
+    meal_text text,
+    is_cooked integer not null default 0,
+    cooked_at text,
+    created_by text references users(id),
+    defrost_reminder_time text,
+    created_at text,
+    unique (family_id, date, meal_type)
+);
+create index if not exists meal_plans_reminder_idx on meal_plans (date, defrost_reminder_time);
+
+create table if not exists reminder_outbox (
+    id text primary key,
+    idempotency_key text not null unique,
+    family_id text not null references families(id) on delete cascade,
+    meal_plan_id text not null references meal_plans(id) on delete cascade,
+    due_at text not null,
+    next_attempt_at text not null,
+    status text not null default 'pending',
+    attempts integer not null default 0,
+    lease_until text,
+    delivered_to text not null default '[]',
+    last_error text,
+    sent_at text,
+    created_at text
+);
+create index if not exists reminder_outbox_due_idx on reminder_outbox (status, next_attempt_at);
+create index if not exists reminder_outbox_meal_plan_idx on reminder_outbox (meal_plan_id);
+"""
+
+# Columnas booleanas (SQLite las guarda como 0/1)
+SQLITE_BOOLEAN_COLUMNS = ("needs_defrost", "is_cooked")
+
+
+def _row_to_dict(row):
+    if row is None:
+        return None
+    data = dict(row)
+    for column in SQLITE_BOOLEAN_COLUMNS:
+        if column in data and data[column] is not None:
+            data[column] = bool(data[column])
+    return data
+
+
+def _new_id():
+    return str(uuid.uuid4())
+
+
+class SQLiteDatabase:
+    """
+    Conexión SQLite (modo WAL) usada desde un único hilo dedicado, para no
+    bloquear el event loop y no compartir la conexión entre hilos.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._conn = None
+
+    async def run(self, fn, *args):
+        """Ejecutar fn(conn, *args) en el hilo de SQLite"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._call, fn, args)
+
+    def _call(self, fn, args):
+        if self._conn is None:
+            self._conn = self._connect()
+        return fn(self._conn, *args)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("pragma journal_mode = wal")
+        conn.execute("pragma synchronous = normal")
+        conn.execute("pragma foreign_keys = on")
+        conn.create_function("parse_quantity", 1, parse_quantity, deterministic=True)
+        conn.executescript(SQLITE_SCHEMA)
+        logger.info(f"🗄️ SQLite abierto en {self.path}")
+        return conn
+
+    async def close(self):
+        def _close(conn):
+            conn.close()
+        if self._conn is not None:
+            await self.run(_close)
+            self._conn = None
+        self._executor.shutdown(wait=False)
+
+
+@contextmanager
+def transaction(conn):
+    """BEGIN / COMMIT, con ROLLBACK si algo falla"""
+    conn.execute("begin")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("rollback")
+        raise
+    conn.execute("commit")
+
+
+def _fetch_all(conn, sql, params=()):
+    return [_row_to_dict(row) for row in conn.execute(sql, params).fetchall()]
+
+
+def _fetch_one(conn, sql, params=()):
+    return _row_to_dict(conn.execute(sql, params).fetchone())
+
+
+def _insert(conn, table, data):
+    data = {"id": _new_id(), **data}
+    columns = ", ".join(data)
+    placeholders = ", ".join("?" for _ in data)
+    return _fetch_one(conn, f"insert into {table} ({columns}) values ({placeholders}) returning *",
+                      tuple(data.values()))
+
+
+class SQLiteUserRepository(UserRepository):
+
+    def __init__(self, db: SQLiteDatabase):
+        self.db = db
+
+    async def get_by_telegram_id(self, telegram_id):
+        return await self.db.run(_fetch_one, "select * from users where telegram_id = ?", (telegram_id,))
+
+    async def create(self, user_data):
+        return await self.db.run(_insert, "users", user_data)
+
+    async def create_family(self, family_data):
+        return await self.db.run(_insert, "families", family_data)
+
+    async def get_family_by_invite_code(self, invite_code):
+        return await self.db.run(_fetch_one, "select * from families where invite_code = ?", (invite_code,))
+
+
+class SQLiteMemberRepository(MemberRepository):
+
+    def __init__(self, db: SQLiteDatabase):
+        self.db = db
+
+    async def add(self, member_data):
+        return await self.db.run(_insert, "family_members", member_data)
+
+    async def get_family_for_user(self, user_id):
+        return await self.db.run(_fetch_one, """
+            select f.id, f.name, f.invite_code
+            from family_members m join families f on f.id = m.family_id
+            where m.user_id = ?
+            limit 1
+        """, (user_id,))
+
+    async def list_members(self, family_id):
+        return await self.db.run(_fetch_all, """
+            select m.role, u.username, u.telegram_id
+            from family_members m left join users u on u.id = m.user_id
+            where m.family_id = ?
+        """, (family_id,))
+
+
+class SQLiteInventoryRepository(InventoryRepository):
+
+    def __init__(self, db: SQLiteDatabase):
+        self.db = db
+
+    async def list_in_stock(self, family_id, section=None):
+        if section:
+            return await self.db.run(_fetch_all, """
+                select id, name, section, stock from inventory
+                where family_id = ? and section = ? and stock > 0
+            """, (family_id, section))
+        return await self.db.run(_fetch_all, """
+            select id, name, section, stock from inventory
+            where family_id = ? and stock > 0
+        """, (family_id,))
+
+    async def list_out_of_stock(self, family_id):
+        return await self.db.run(_fetch_all, """
+            select id, name, section, stock from inventory
+            where family_id = ? and stock = 0
+        """, (family_id,))
+
+    async def list_products(self, family_id):
+        return await self.db.run(_fetch_all, """
+            select id, name, section, stock from inventory where family_id = ?
+        """, (family_id,))
+
+    async def page_in_stock(self, family_id, section=None, after=None, limit=20):
+        where, params = "family_id = ? and stock > 0", [family_id]
+        if section:
+            where, params = where + " and section = ?", params + [section]
+        return await self._page(where, params, after, limit)
+
+    async def page_out_of_stock(self, family_id, after=None, limit=20):
+        return await self._page("family_id = ? and stock = 0", [family_id], after, limit)
+
+    async def _page(self, where, params, after, limit):
+        if after:
+            where, params = where + " and (name, id) > (?, ?)", params + list(after)
+        return await self.db.run(_fetch_all, f"""
+            select id, name, section, stock from inventory
+            where {where}
+            order by name, id
+            limit ?
+        """, (*params, limit))
+
+    async def get(self, item_id):
+        return await self.db.run(_fetch_one, "select * from inventory where id = ?", (item_id,))
+
+    async def add(self, item_data):
+        return await self.db.run(_insert, "inventory", item_data)
+
+    async def set_stock(self, item_id, stock):
+        return await self.db.run(_fetch_one, "update inventory set stock = ? where id = ? returning *",
+                                 (stock, item_id))
+
+
+class SQLiteRecipeRepository(RecipeRepository):
+
+    def __init__(self, db: SQLiteDatabase):
+        self.db = db
+
+    async def list_catalog(self, family_id):
+        return await self.db.run(_fetch_all, f"""
+            select {", ".join(RECIPE_CATALOG_FIELDS)} from recipes where family_id = ?
+        """, (family_id,))
+
+    async def get(self, recipe_id):
+        return await self.db.run(_fetch_one, f"""
+            select {", ".join(RECIPE_CATALOG_FIELDS)} from recipes where id = ?
+        """, (recipe_id,))
+
+    async def create_with_ingredients(self, recipe_data, ingredients):
+        def _create(conn):
+            with transaction(conn):
+                recipe = _insert(conn, "recipes", recipe_data)
+                conn.executemany("""
+                    insert into recipe_ingredients
+                        (id, recipe_id, ingredient_name, quantity, product_id, section, created_at)
+                    values (?, ?, ?, ?, ?, ?, ?)
+                """, [
+                    (_new_id(), recipe['id'], ing['ingredient_name'], ing['quantity'],
+                     ing.get('product_id'), ing.get('section'), ing.get('created_at'))
+                    for ing in ingredients
+                ])
+            return recipe
+        return await self.db.run(_create)
+
+    async def list_ingredients(self, recipe_id):
+        rows = await self.db.run(_fetch_all, """
+            select ri.ingredient_name, ri.quantity, ri.section, i.section as product_section
+            from recipe_ingredients ri left join inventory i on i.id = ri.product_id
+            where ri.recipe_id = ?
+        """, (recipe_id,))
+        return [_embed_product_section(row) for row in rows]
+
+
+def _embed_product_section(row):
+    """Dar a un ingrediente la forma de PostgREST: inventory: {section}"""
+    product_section = row.pop('product_section', None)
+    row['inventory'] = {"section": product_section} if product_section else None
+    return row
+
+
+class SQLiteMealPlanRepository(MealPlanRepository):
+
+    def __init__(self, db: SQLiteDatabase):
+        self.db = db
+
+    async def list_range(self, family_id, start, end):
+        rows = await self.db.run(_fetch_all, """
+            select mp.date, mp.meal_type, mp.meal_text, mp.is_cooked,
+                   r.name as recipe_name, r.needs_defrost
+            from meal_plans mp left join recipes r on r.id = mp.recipe_id
+            where mp.family_id = ? and mp.date between ? and ?
+        """, (family_id, start, end))
+        for row in rows:
+            recipe_name = row.pop('recipe_name')
+            needs_defrost = row.pop('needs_defrost')
+            row['recipes'] = {"name": recipe_name, "needs_defrost": needs_defrost} if recipe_name else None
+        return rows
+
+    async def list_range_ingredients(self, family_id, start, end):
+        rows = await self.db.run(_fetch_all, """
+            select ri.ingredient_name, ri.quantity, ri.product_id, ri.section,
+                   i.name as product_name, i.section as product_section, i.stock as product_stock
+            from meal_plans mp
+            join recipe_ingredients ri on ri.recipe_id = mp.recipe_id
+            left join inventory i on i.id = ri.product_id
+            where mp.family_id = ? and mp.date between ? and ? and not mp.is_cooked
+        """, (family_id, start, end))
+        for row in rows:
+            name, section, stock = row.pop('product_name'), row.pop('product_section'), row.pop('product_stock')
+            row['inventory'] = {"id": row['product_id'], "name": name, "section": section, "stock": stock} \
+                if name is not None else None
+        return rows
+
+    async def upsert_slot(self, plan_data):
+        data = {"id": _new_id(), **plan_data}
+        columns = ", ".join(data)
+        placeholders = ", ".join("?" for _ in data)
+        updates = ", ".join(
+            f"{column} = excluded.{column}"
+            for column in data if column not in ("id", "family_id", "date", "meal_type")
+        )
+        return await self.db.run(_fetch_one, f"""
+            insert into meal_plans ({columns}) values ({placeholders})
+            on conflict (family_id, date, meal_type) do update set {updates}
+            returning *
+        """, tuple(data.values()))
+
+    async def delete_slot(self, family_id, date, meal_type):
+        return await self.db.run(_fetch_all, """
+            delete from meal_plans where family_id = ? and date = ? and meal_type = ? returning *
+        """, (family_id, date, meal_type))
+
+    async def delete_range(self, family_id, start, end):
+        return await self.db.run(_fetch_all, """
+            delete from meal_plans where family_id = ? and date between ? and ? returning *
+        """, (family_id, start, end))
+
+    async def cook_range(self, family_id, start, end, cooked_at, meal_type=None):
+        def _cook(conn):
+            with transaction(conn):
+                # Descontar primero (aún se ven las comidas sin cocinar) y luego marcarlas
+                products = _fetch_all(conn, """
+                    update inventory set stock = max(inventory.stock - consumed.units, 0)
+                    from (
+                        select ri.product_id, sum(parse_quantity(ri.quantity)) as units
+                        from meal_plans mp
+                        join recipe_ingredients ri on ri.recipe_id = mp.recipe_id
+                        where mp.family_id = ? and mp.date between ? and ?
+                          and (? is null or mp.meal_type = ?) and not mp.is_cooked
+                          and ri.product_id is not null
+                        group by ri.product_id
+                    ) as consumed
+                    where inventory.id = consumed.product_id and inventory.family_id = ?
+                    returning inventory.id, inventory.name, inventory.section, inventory.stock
+                """, (family_id, start, end, meal_type, meal_type, family_id))
+                cooked = conn.execute("""
+                    update meal_plans set is_cooked = 1, cooked_at = ?
+                    where family_id = ? and date between ? and ?
+                      and (? is null or meal_type = ?) and not is_cooked
+                """, (cooked_at, family_id, start, end, meal_type, meal_type)).rowcount
+            return {"cooked": cooked, "products": products}
+        return await self.db.run(_cook)
+
+    async def list_with_reminders(self, from_date):
+        return await self.db.run(_fetch_all, """
+            select id, family_id, date, defrost_reminder_time from meal_plans
+            where date >= ? and defrost_reminder_time is not null
+        """, (from_date,))
+
+    async def get_for_reminders(self, plan_ids):
+        def _load(conn):
+            placeholders = ", ".join("?" for _ in plan_ids)
+            plans = _fetch_all(conn, f"""
+                select mp.*, f.name as family_name, r.name as recipe_name, r.needs_defrost
+                from meal_plans mp
+                join families f on f.id = mp.family_id
+                left join recipes r on r.id = mp.recipe_id
+                where mp.id in ({placeholders})
+            """, tuple(plan_ids))
+
+            recipe_ids = list({plan['recipe_id'] for plan in plans if plan['recipe_id']})
+            ingredients = {}
+            if recipe_ids:
+                placeholders = ", ".join("?" for _ in recipe_ids)
+                for row in _fetch_all(conn, f"""
+                    select ri.recipe_id, ri.ingredient_name, ri.quantity, ri.section,
+                           i.section as product_section
+                    from recipe_ingredients ri left join inventory i on i.id = ri.product_id
+                    where ri.recipe_id in ({placeholders})
+                """, tuple(recipe_ids)):
+                    ingredients.setdefault(row.pop('recipe_id'), []).append(_embed_product_section(row))
+
+            members = {}
+            family_ids = list({plan['family_id'] for plan in plans})
+            if family_ids:
+                placeholders = ", ".join("?" for _ in family_ids)
+                for row in _fetch_all(conn, f"""
+                    select m.family_id, u.telegram_id
+                    from family_members m join users u on u.id = m.user_id
+                    where m.family_id in ({placeholders})
+                """, tuple(family_ids)):
+                    members.setdefault(row['family_id'], []).append(row['telegram_id'])
+
+            for plan in plans:
+                plan['families'] = {
+                    "id": plan['family_id'],
+                    "name": plan.pop('family_name'),
+                    "members": members.get(plan['family_id'], []),
+                }
+                recipe_name = plan.pop('recipe_name')
+                needs_defrost = plan.pop('needs_defrost')
+                plan['recipes'] = {
+                    "name": recipe_name,
+                    "needs_defrost": needs_defrost,
+                    "recipe_ingredients": ingredients.get(plan['recipe_id'], []),
+                } if recipe_name else None
+            return plans
+        return await self.db.run(_load)
+
+
+def _decode_outbox(row):
+    row['delivered_to'] = json.loads(row['delivered_to'])
+    return row
+
+
+class SQLiteReminderOutboxRepository(ReminderOutboxRepository):
+
+    def __init__(self, db: SQLiteDatabase):
+        self.db = db
+
+    async def enqueue(self, reminders):
+        def _enqueue(conn):
+            created_at = datetime.now().isoformat()
+            with transaction(conn):
+                conn.executemany("""
+                    insert into reminder_outbox
+                        (id, idempotency_key, family_id, meal_plan_id, due_at, next_attempt_at, created_at)
+                    values (?, ?, ?, ?, ?, ?, ?)
+                    on conflict (idempotency_key) do update
+                    set status = 'pending', attempts = 0, next_attempt_at = excluded.next_attempt_at,
+                        delivered_to = '[]', lease_until = null, last_error = null, sent_at = null
+                    where reminder_outbox.status = 'cancelled'
+                """, [
+                    (_new_id(), reminder['idempotency_key'], reminder['family_id'], reminder['meal_plan_id'],
+                     reminder['due_at'], reminder['due_at'], created_at)
+                    for reminder in reminders
+                ])
+                conn.executemany("""
+                    update reminder_outbox set status = 'cancelled'
+                    where meal_plan_id = ? and status = 'pending' and idempotency_key != ?
+                """, [(reminder['meal_plan_id'], reminder['idempotency_key']) for reminder in reminders])
+        if reminders:
+            await self.db.run(_enqueue)
+
+    async def cancel(self, meal_plan_ids):
+        placeholders = ", ".join("?" for _ in meal_plan_ids)
+        await self.db.run(_fetch_all, f"""
+            update reminder_outbox set status = 'cancelled'
+            where meal_plan_id in ({placeholders}) and status = 'pending'
+        """, tuple(meal_plan_ids))
+
+    async def claim_due(self, now, lease_until, limit=100):
+        # Una sola sentencia: con un único escritor nadie más puede reclamar entre medias
+        rows = await self.db.run(_fetch_all, """
+            update reminder_outbox
+            set status = 'sending', lease_until = ?, attempts = attempts + 1
+            where id in (
+                select id from reminder_outbox
+                where next_attempt_at <= ?
+                  and (status = 'pending' or (status = 'sending' and lease_until < ?))
+                order by next_attempt_at
+                limit ?
+            )
+            returning *
+        """, (lease_until, now, now, limit))
+        return [_decode_outbox(row) for row in rows]
+
+    async def claim_for_families(self, family_ids, now, until, lease_until):
+        placeholders = ", ".join("?" for _ in family_ids)
+        rows = await self.db.run(_fetch_all, f"""
+            update reminder_outbox
+            set status = 'sending', lease_until = ?, attempts = attempts + 1
+            where family_id in ({placeholders}) and status = 'pending' and next_attempt_at < ?
+              and (attempts = 0 or next_attempt_at <= ?)
+            returning *
+        """, (lease_until, *family_ids, until, now))
+        return [_decode_outbox(row) for row in rows]
+
+    async def renew_lease(self, reminder_ids, lease_until):
+        placeholders = ", ".join("?" for _ in reminder_ids)
+        await self.db.run(_fetch_all, f"""
+            update reminder_outbox set lease_until = ?
+            where id in ({placeholders}) and status = 'sending'
+        """, (lease_until, *reminder_ids))
+
+    async def finish(self, reminder_id, status, delivered_to, next_attempt_at=None, error=None):
+        sent_at = datetime.now().isoformat(timespec="seconds") if status == "sent" else None
+        await self.db.run(_fetch_all, """
+            update reminder_outbox
+            set status = ?, delivered_to = ?, lease_until = null, last_error = ?,
+                next_attempt_at = coalesce(?, next_attempt_at), sent_at = coalesce(?, sent_at)
+            where id = ?
+        """, (status, json.dumps(delivered_to), error, next_attempt_at, sent_at, reminder_id))
+
+
+def create_sqlite_storage(path: str):
+    """Repositorios sobre un fichero SQLite local (o ':memory:')"""
+    db = SQLiteDatabase(path)
+    return Storage(
+        users=SQLiteUserRepository(db),
+        members=SQLiteMemberRepository(db),
+        inventory=SQLiteInventoryRepository(db),
+        recipes=SQLiteRecipeRepository(db),
+        meal_plans=SQLiteMealPlanRepository(db),
+        reminders=SQLiteReminderOutboxRepository(db),
+        close=db.close,
+    )
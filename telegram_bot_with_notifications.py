@@ -4,15 +4,33 @@ Con inventario, recetas, MENÚ SEMANAL completo, lista de compra y notificacione
 """
 
 import os
+import re
+import hmac
+import secrets
+import json
+import time
+import signal
+import asyncio
+import heapq
+import pickle
+import inspect
 import logging
+import unicodedata
+from collections import OrderedDict
 from datetime import datetime, timedelta, time as time_type
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
+from telegram import InlineQueryResultArticle, InputTextMessageContent
+from telegram.constants import MessageLimit
+from telegram.error import RetryAfter, TimedOut, NetworkError
+from telegram.ext import BaseUpdateProcessor
+from telegram.request import HTTPXRequest
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, ConversationHandler, ContextTypes, filters
-from supabase import create_client, Client
+from telegram.ext import InlineQueryHandler, PersistenceInput, PicklePersistence
 import uuid
 from dotenv import load_dotenv
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.cron import CronTrigger
+from storage import RECIPE_CATALOG_FIELDS, LazyStorage, create_sqlite_storage, create_supabase_storage, parse_quantity
+from invalidation import DEFAULT_CHANNEL, LocalBus, PostgresBus
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, REGISTRY, InstrumentedProxy, timed
 
 load_dotenv()
 
@@ -24,19 +42,368 @@ logger = logging.getLogger(__name__)
 
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
-supabase: Client = create_client(SUPABASE_URL or "", SUPABASE_KEY or "")
+
+# Backend de datos: "supabase" (por defecto) o "sqlite" (fichero local, sin red)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "supabase").lower()
+SQLITE_PATH = os.getenv("SQLITE_PATH", "familymeal.db")
+
+# Arranque en caliente: estado de las conversaciones (user_data) y cachés por familia
+# guardados en disco al parar (y periódicamente) y recargados al arrancar.
+# En Railway las rutas deben estar en un volumen para sobrevivir a un redeploy.
+STATE_PATH = os.getenv("STATE_PATH", "familymeal_state.pickle")
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "60"))
+CACHE_SNAPSHOT_PATH = os.getenv("CACHE_SNAPSHOT_PATH", "familymeal_cache.pickle")
+CACHE_SNAPSHOT_INTERVAL = float(os.getenv("CACHE_SNAPSHOT_INTERVAL", "300"))
+CACHE_SNAPSHOT_MAX_AGE = float(os.getenv("CACHE_SNAPSHOT_MAX_AGE", "900"))
+PREFETCH_FAMILIES = int(os.getenv("PREFETCH_FAMILIES", "50"))
+
+# Bus de invalidación de cachés entre réplicas: "local" (una réplica) o "postgres"
+# (LISTEN/NOTIFY sobre DATABASE_URL, la cadena de conexión directa de Supabase)
+INVALIDATION_BUS = os.getenv("INVALIDATION_BUS", "local").lower()
+DATABASE_URL = os.getenv("DATABASE_URL")
+INVALIDATION_CHANNEL = os.getenv("INVALIDATION_CHANNEL", DEFAULT_CHANNEL)
+
+# Pool de conexiones HTTP hacia PostgREST (Supabase)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_TIMEOUT = float(os.getenv("DB_TIMEOUT", "10"))
+DB_KEEPALIVE_EXPIRY = float(os.getenv("DB_KEEPALIVE_EXPIRY", "60"))
+
+# Caché de identidad (usuario + familia por telegram_id)
+IDENTITY_CACHE_TTL = float(os.getenv("IDENTITY_CACHE_TTL", "300"))
+IDENTITY_CACHE_SIZE = int(os.getenv("IDENTITY_CACHE_SIZE", "5000"))
+
+# Catálogo de recetas en memoria (número máximo de familias cacheadas)
+RECIPE_CACHE_FAMILIES = int(os.getenv("RECIPE_CACHE_FAMILIES", "500"))
+
+# Mensajes renderizados (menú, inventario, lista de compra) cacheados por familia
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", "2000"))
+
+# Vida máxima (s) de catálogos, índices de búsqueda y renders: tope por si se pierde un aviso de invalidación
+CACHE_TTL = float(os.getenv("CACHE_TTL", "3600"))
+
+
+# Modo de recepción de updates: "polling" (por defecto) o "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # URL pública base, ej: https://tu-app.railway.app
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8080"))
+
+# Tipos de update que consumen los handlers
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY, Update.INLINE_QUERY]
+
+# Máximo de updates procesándose a la vez (en orden dentro de cada chat/usuario)
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "64"))
+
+# Filas por página en los listados con botones (lista de compra y selectores)
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", "10"))
+
+# Resultados de la búsqueda inline (@bot texto); Telegram admite hasta 50
+INLINE_RESULTS = int(os.getenv("INLINE_RESULTS", "20"))
+
+# Envío de notificaciones (límites de flood de Telegram: ~30 msg/s en total, ~1 msg/s por chat)
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "25"))
+SEND_PER_CHAT_INTERVAL = float(os.getenv("SEND_PER_CHAT_INTERVAL", "1.0"))
+SEND_MAX_CONCURRENCY = int(os.getenv("SEND_MAX_CONCURRENCY", "20"))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))
+
+# Outbox de recordatorios (migrations/006): lotes reclamados por tick, lease de cada lote,
+# sondeo de rescate (filas de una réplica caída; los reintentos ya despiertan solos) y
+# ventana de recuperación de los recordatorios que no se enviaron a su hora
+REMINDER_BATCH_SIZE = int(os.getenv("REMINDER_BATCH_SIZE", "100"))
+REMINDER_LEASE = float(os.getenv("REMINDER_LEASE", "300"))
+REMINDER_POLL_INTERVAL = float(os.getenv("REMINDER_POLL_INTERVAL", "1800"))
+REMINDER_CATCHUP_HOURS = float(os.getenv("REMINDER_CATCHUP_HOURS", "12"))
+REMINDER_MAX_ATTEMPTS = int(os.getenv("REMINDER_MAX_ATTEMPTS", "5"))
+REMINDER_RETRY_DELAY = float(os.getenv("REMINDER_RETRY_DELAY", "60"))
+
+# "digest": un único mensaje por familia y día con todas sus comidas a descongelar
+# (se envía al llegar la hora del primer recordatorio); "plan": un mensaje por comida
+REMINDER_MODE = os.getenv("REMINDER_MODE", "digest").lower()
+
+# Puerto de /metrics y /healthz en modo polling (en modo webhook se sirven en PORT)
+METRICS_PORT = int(os.getenv("METRICS_PORT")) if os.getenv("METRICS_PORT") else None
+
+
+# ========== CAPA DE DATOS ==========
+
+def create_storage():
+    """Crear los repositorios del backend configurado en STORAGE_BACKEND"""
+    if STORAGE_BACKEND == "sqlite":
+        return create_sqlite_storage(SQLITE_PATH)
+    return create_supabase_storage(
+        SUPABASE_URL or "", SUPABASE_KEY or "",
+        pool_size=DB_POOL_SIZE, timeout=DB_TIMEOUT, keepalive_expiry=DB_KEEPALIVE_EXPIRY
+    )
+
+
+def create_bus():
+    """Crear el bus de invalidación configurado en INVALIDATION_BUS"""
+    if INVALIDATION_BUS == "postgres":
+        return PostgresBus(DATABASE_URL or "", INVALIDATION_CHANNEL)
+    return LocalBus()
+
+
+# ========== MÉTRICAS ==========
+
+HANDLER_LATENCY = REGISTRY.histogram(
+    "familymeal_handler_duration_seconds", "Duración de los handlers del bot", ["handler"])
+HANDLER_ERRORS = REGISTRY.counter(
+    "familymeal_handler_errors_total", "Excepciones no capturadas en los handlers", ["handler"])
+DB_LATENCY = REGISTRY.histogram(
+    "familymeal_db_query_duration_seconds", "Duración de las llamadas a la capa de datos", ["table", "operation"])
+DB_ERRORS = REGISTRY.counter(
+    "familymeal_db_query_errors_total", "Llamadas fallidas a la capa de datos", ["table", "operation"])
+TELEGRAM_LATENCY = REGISTRY.histogram(
+    "familymeal_telegram_request_duration_seconds", "Duración de las peticiones a la Bot API", ["method"])
+TELEGRAM_REQUESTS = REGISTRY.counter(
+    "familymeal_telegram_requests_total", "Peticiones a la Bot API por resultado (ok, código HTTP o error)",
+    ["method", "outcome"])
+SCHEDULER_TICK_LATENCY = REGISTRY.histogram(
+    "familymeal_scheduler_tick_duration_seconds", "Duración de cada disparo de recordatorios")
+REMINDERS_SENT = REGISTRY.counter(
+    "familymeal_reminders_total", "Mensajes de recordatorio por resultado (sent, failed, retried)", ["outcome"])
+INVALIDATIONS = REGISTRY.counter(
+    "familymeal_invalidations_total", "Avisos de cambio publicados y recibidos de otras réplicas",
+    ["direction", "entity"])
+REMINDERS_SCHEDULED = REGISTRY.gauge(
+    "familymeal_reminders_scheduled", "Recordatorios pendientes en la agenda en memoria")
+REMINDER_OUTBOX = REGISTRY.counter(
+    "familymeal_reminder_outbox_total",
+    "Recordatorios del outbox cerrados por estado (sent, failed, expired, cancelled, pending)", ["status"])
+
+# Tabla principal detrás de cada repositorio (etiqueta `table`)
+REPOSITORY_TABLES = {
+    "users": "users",
+    "members": "family_members",
+    "inventory": "inventory",
+    "recipes": "recipes",
+    "meal_plans": "meal_plans",
+    "reminders": "reminder_outbox",
+}
+
+
+def instrument_storage(storage):
+    """Medir cada llamada a los repositorios, etiquetada por tabla y operación"""
+    for name, table in REPOSITORY_TABLES.items():
+        setattr(storage, name, InstrumentedProxy(getattr(storage, name), DB_LATENCY, DB_ERRORS, table=table))
+    return storage
+
+
+def instrument_handlers(bot):
+    """Medir los handlers (métodos async que reciben update y context) antes de registrarlos"""
+    for name, method in inspect.getmembers(bot, inspect.iscoroutinefunction):
+        params = inspect.signature(method).parameters
+        if name.startswith("_") or "update" not in params or "context" not in params:
+            continue
+        setattr(bot, name, timed(method, HANDLER_LATENCY, HANDLER_ERRORS, handler=name))
+    return bot
+
+
+class MeteredRequest(HTTPXRequest):
+    """HTTPXRequest que cuenta y mide cada llamada a la Bot API"""
+    
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, **kwargs)
+        except Exception:
+            TELEGRAM_REQUESTS.inc(method=endpoint, outcome="error")
+            raise
+        finally:
+            TELEGRAM_LATENCY.observe(time.perf_counter() - started, method=endpoint)
+        TELEGRAM_REQUESTS.inc(method=endpoint, outcome="ok" if code == 200 else str(code))
+        return code, payload
+
+
+# ========== CACHÉS ==========
+
+class TTLCache:
+    """Caché LRU acotada con caducidad opcional (TTL en segundos)"""
+    
+    def __init__(self, maxsize: int, ttl: float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+    
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+    
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+    
+    def pop(self, key):
+        self._data.pop(key, None)
+    
+    def clear(self):
+        self._data.clear()
+    
+    def dump(self):
+        """Entradas vigentes, de la menos a la más usada: [(clave, valor, segundos de vida o None)]"""
+        now = time.monotonic()
+        return [
+            (key, value, None if expires_at is None else expires_at - now)
+            for key, (value, expires_at) in self._data.items()
+            if expires_at is None or expires_at > now
+        ]
+    
+    def load(self, entries):
+        """Restaurar entradas de dump() (las ya caducadas se descartan)"""
+        now = time.monotonic()
+        for key, value, remaining in entries:
+            if remaining is not None and remaining <= 0:
+                continue
+            self._data[key] = (value, None if remaining is None else now + remaining)
+            self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+    
+    def __len__(self):
+        return len(self._data)
+
+
+class RenderCache:
+    """
+    Salidas ya renderizadas por familia y vista. Cada familia lleva un contador de versión
+    por entidad (inventory, meal_plans...); una salida sirve mientras no cambie la versión
+    de las entidades de las que depende. Las escrituras llaman a touch().
+    """
+    
+    def __init__(self, maxsize: int, ttl: float = None):
+        self._entries = TTLCache(maxsize, ttl)
+        self._versions = {}
+    
+    def version(self, family_id, entities):
+        """Versión actual de las entidades; tomarla ANTES de consultar para no cachear datos viejos"""
+        return tuple(self._versions.get((family_id, entity), 0) for entity in entities)
+    
+    def get(self, family_id, view, entities):
+        entry = self._entries.get((family_id, view))
+        if entry is None or entry[0] != self.version(family_id, entities):
+            return None
+        return entry[1]
+    
+    def set(self, family_id, view, version, value):
+        self._entries.set((family_id, view), (version, value))
+    
+    def touch(self, family_id, *entities):
+        """Los datos de estas entidades han cambiado: invalidar lo renderizado con ellos"""
+        for entity in entities:
+            key = (family_id, entity)
+            self._versions[key] = self._versions.get(key, 0) + 1
+    
+    def clear(self):
+        self._entries.clear()
+
+
+# ========== BÚSQUEDA ==========
+
+def normalize(text: str):
+    """Minúsculas y sin tildes, para comparar nombres sin importar acentos ni mayúsculas"""
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(char for char in decomposed if not unicodedata.combining(char)).casefold()
+
+
+class SearchIndex:
+    """
+    Índice de prefijos sobre los nombres de las recetas y productos de una familia.
+    Cada palabra del nombre (normalizada) aporta sus prefijos; una búsqueda devuelve las
+    entradas que tienen todas las palabras de la consulta como prefijo de alguna palabra.
+    """
+    
+    MAX_PREFIX = 12
+    
+    def __init__(self):
+        self._entries = {}   # (kind, id) -> (nombre normalizado, fila)
+        self._prefixes = {}  # prefijo -> {(kind, id)}
+    
+    @staticmethod
+    def words(text: str):
+        return re.findall(r"\w+", normalize(text))
+    
+    def _prefixes_of(self, name: str):
+        return {word[:n] for word in self.words(name) for n in range(1, min(len(word), self.MAX_PREFIX) + 1)}
+    
+    def add(self, kind: str, row: dict):
+        """Añadir (o reemplazar) una receta o producto"""
+        key = (kind, str(row['id']))
+        self.remove(kind, row['id'])
+        self._entries[key] = (normalize(row['name']), row)
+        for prefix in self._prefixes_of(row['name']):
+            self._prefixes.setdefault(prefix, set()).add(key)
+    
+    def remove(self, kind: str, item_id):
+        key = (kind, str(item_id))
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for prefix in self._prefixes_of(entry[1]['name']):
+            keys = self._prefixes[prefix]
+            keys.discard(key)
+            if not keys:
+                del self._prefixes[prefix]
+    
+    def search(self, query: str, kind: str = None, limit: int = 20):
+        """[(kind, fila)] que casan con la consulta; primero los que empiezan por ella"""
+        words = self.words(query)
+        if not words:
+            return []
+        
+        keys = None
+        for word in words:
+            matches = self._prefixes.get(word[:self.MAX_PREFIX], set())
+            if len(word) > self.MAX_PREFIX:
+                matches = {
+                    key for key in matches
+                    if any(name_word.startswith(word) for name_word in self.words(self._entries[key][0]))
+                }
+            keys = matches if keys is None else keys & matches
+            if not keys:
+                return []
+        
+        phrase = " ".join(words)
+        ranked = sorted(
+            (not self._entries[key][0].startswith(phrase), self._entries[key][0], key)
+            for key in keys if kind is None or key[0] == kind
+        )
+        return [(key[0], self._entries[key][1]) for _, _, key in ranked[:limit]]
+    
+    def __len__(self):
+        return len(self._entries)
 
 # Estados de conversación
 (CREATE_FAMILY_NAME, JOIN_FAMILY_CODE,
  ADD_INVENTORY_SECTION, ADD_INVENTORY_NAME, ADD_INVENTORY_STOCK,
  CREATE_RECIPE_NAME, SELECT_INGREDIENT_SECTION, SELECT_INGREDIENT_PRODUCT, 
  ADD_INGREDIENT_QUANTITY, SET_DEFROST_TIME,
- SELECT_MENU_DAY, SELECT_MENU_MEAL, SELECT_MENU_RECIPE) = range(13)
+ SELECT_MENU_DAY, SELECT_MENU_MEAL, SELECT_MENU_RECIPE,
+ SEARCH_INGREDIENT, SEARCH_MENU_RECIPE) = range(15)
 
 DAYS = ['Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes', 'Sábado', 'Domingo']
 MEALS = ['Comida', 'Cena']
 SECTIONS = ['Despensa', 'Frigo', 'Congelador']
 
+# Teclado principal (los objetos de telegram son inmutables: se construye una vez)
+MAIN_KEYBOARD = ReplyKeyboardMarkup([
+    [KeyboardButton("📅 Menú Semanal"), KeyboardButton("📖 Recetas")],
+    [KeyboardButton("🏠 Inventario"), KeyboardButton("🛒 Lista de Compra")],
+    [KeyboardButton("👥 Mi Familia")]
+], resize_keyboard=True)
+
 
 def get_week_to_display():
     """
@@ -68,18 +435,93 @@ def get_available_days():
     return available
 
 
+def ingredient_section(ingredient):
+    """Sección actual de un ingrediente: la de su producto enlazado o la guardada con la receta"""
+    product = ingredient.get('inventory')
+    if product and product.get('section'):
+        return product['section']
+    return ingredient.get('section')
+
+
+def shopping_needs(ingredients):
+    """
+    Sumar por producto las cantidades que pide el menú y compararlas con el stock.
+    Devuelve solo lo que falta: [{product_id, name, section, required, stock, missing}]
+    """
+    needs = {}
+    for ingredient in ingredients:
+        product = ingredient.get('inventory')
+        if product:
+            entry = needs.setdefault(product['id'], {
+                "product_id": product['id'], "name": product['name'],
+                "section": product['section'], "stock": product.get('stock') or 0, "required": 0
+            })
+        else:
+            # Ingrediente sin producto enlazado: no hay stock con el que compararlo
+            entry = needs.setdefault(normalize(ingredient['ingredient_name']), {
+                "product_id": None, "name": ingredient['ingredient_name'],
+                "section": ingredient.get('section'), "stock": 0, "required": 0
+            })
+        entry['required'] += parse_quantity(ingredient.get('quantity'))
+    
+    missing = []
+    for entry in needs.values():
+        entry['missing'] = entry['required'] - entry['stock']
+        if entry['missing'] > 0:
+            missing.append(entry)
+    section_order = {section: i for i, section in enumerate(SECTIONS)}
+    return sorted(missing, key=lambda entry: (section_order.get(entry['section'], len(SECTIONS)), entry['name']))
+
+
+def split_message(text: str, limit: int = MessageLimit.MAX_TEXT_LENGTH):
+    """Trocear un texto en mensajes de como máximo `limit` caracteres, cortando por líneas"""
+    chunks, current = [], ""
+    for line in text.splitlines(keepends=True):
+        if len(current) + len(line) > limit and current:
+            chunks.append(current)
+            current = ""
+        while len(line) > limit:
+            chunks.append(line[:limit])
+            line = line[limit:]
+        current += line
+    chunks.append(current)
+    return [chunk for chunk in chunks if chunk.strip()] or [text]
+
+
+def keyset_page(rows, after=None, limit: int = PAGE_SIZE):
+    """Página en memoria con el mismo orden y cursor (name, id) que las consultas paginadas"""
+    ordered = sorted(rows, key=lambda row: (row['name'], str(row['id'])))
+    if after:
+        after = tuple(after)
+        ordered = [row for row in ordered if (row['name'], str(row['id'])) > after]
+    return ordered[:limit]
+
+
 class FamilyMealBot:
     
+    def __init__(self, storage, bus=None):
+        self.storage = storage
+        # Avisos de cambio entre réplicas; origin distingue los avisos propios
+        self.bus = bus or LocalBus()
+        self.origin = uuid.uuid4().hex
+        # telegram_id -> (usuario, familia)
+        self.identity_cache = TTLCache(IDENTITY_CACHE_SIZE, IDENTITY_CACHE_TTL)
+        # family_id -> {recipe_id: receta} (solo RECIPE_CATALOG_FIELDS)
+        self.recipe_catalog = TTLCache(RECIPE_CACHE_FAMILIES, CACHE_TTL)
+        # family_id -> SearchIndex de recetas y productos (se construye al primer uso)
+        self.search_indexes = TTLCache(RECIPE_CACHE_FAMILIES, CACHE_TTL)
+        # (family_id, vista) -> texto y botones ya renderizados
+        self.renders = RenderCache(RENDER_CACHE_SIZE, CACHE_TTL)
+        # NotificationScheduler, para reprogramar recordatorios al cambiar el menú
+        self.scheduler = None
+    
     # ========== /START ==========
     
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Comando /start"""
-        telegram_id = update.effective_user.id
-        username = update.effective_user.username or update.effective_user.first_name
         first_name = update.effective_user.first_name
         
-        user = await self.get_or_create_user(telegram_id, username, first_name)
-        family = await self.get_user_family(user['id'])
+        user, family = await self.get_identity(update)
         
         if family:
             await self.show_main_menu(update, context, family, first_name)
@@ -91,17 +533,10 @@ class FamilyMealBot:
     
     async def show_main_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE, family, first_name):
         """Mostrar menú principal"""
-        keyboard = [
-            [KeyboardButton("📅 Menú Semanal"), KeyboardButton("📖 Recetas")],
-            [KeyboardButton("🏠 Inventario"), KeyboardButton("🛒 Lista de Compra")],
-            [KeyboardButton("👥 Mi Familia")]
-        ]
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-        
         await update.message.reply_text(
             f"👋 ¡Hola {first_name}!\n\n📱 Familia: *{family['name']}*\n\n"
             f"Usa el menú 👇",
-            reply_markup=reply_markup,
+            reply_markup=MAIN_KEYBOARD,
             parse_mode='Markdown'
         )
     
@@ -110,9 +545,9 @@ class FamilyMealBot:
     async def get_or_create_user(self, telegram_id: int, username: str, first_name: str):
         """Buscar o crear usuario"""
         try:
-            response = supabase.table("users").select("*").eq("telegram_id", telegram_id).execute()
-            if response.data:
-                return response.data[0]
+            user = await self.storage.users.get_by_telegram_id(telegram_id)
+            if user:
+                return user
             
             user_id = str(uuid.uuid4())
             user_data = {
@@ -122,25 +557,202 @@ class FamilyMealBot:
                 "username": username,
                 "created_at": datetime.now().isoformat()
             }
-            result = supabase.table("users").insert(user_data).execute()
-            return result.data[0]
+            return await self.storage.users.create(user_data)
         except Exception as e:
             logger.error(f"Error get_or_create_user: {e}")
             raise
     
+    async def get_identity(self, update: Update):
+        """Obtener (usuario, familia) del remitente, usando la caché si está fresca"""
+        telegram_id = update.effective_user.id
+        cached = self.identity_cache.get(telegram_id)
+        if cached is not None:
+            return cached
+        
+        username = update.effective_user.username or update.effective_user.first_name
+        first_name = update.effective_user.first_name
+        
+        user = await self.get_or_create_user(telegram_id, username, first_name)
+        family = await self.get_user_family(user['id'])
+        
+        # Solo cacheamos usuarios con familia: un None puede venir de un error transitorio
+        if family:
+            self.identity_cache.set(telegram_id, (user, family))
+        return user, family
+    
     async def get_user_family(self, user_id: str):
         """Obtener familia del usuario"""
         try:
-            response = supabase.table("family_members")\
-                .select("family_id, families(id, name, invite_code)")\
-                .eq("user_id", user_id).execute()
-            if response.data and response.data[0].get('families'):
-                return response.data[0]['families']
-            return None
+            return await self.storage.members.get_family_for_user(user_id)
         except Exception as e:
             logger.error(f"Error get_user_family: {e}")
             return None
     
+    # ========== CATÁLOGO DE RECETAS ==========
+    
+    async def get_recipe_catalog(self, family_id):
+        """Recetas de la familia {id: receta}, desde la caché o cargándolas una vez"""
+        catalog = self.recipe_catalog.get(family_id)
+        if catalog is None:
+            recipes = await self.storage.recipes.list_catalog(family_id)
+            catalog = {str(recipe['id']): recipe for recipe in recipes}
+            self.recipe_catalog.set(family_id, catalog)
+        return catalog
+    
+    def add_to_recipe_catalog(self, family_id, recipe):
+        """Write-through: añadir una receta recién creada al catálogo cacheado"""
+        entry = {field: recipe.get(field) for field in RECIPE_CATALOG_FIELDS}
+        catalog = self.recipe_catalog.get(family_id)
+        if catalog is not None:
+            catalog[str(recipe['id'])] = entry
+        index = self.search_indexes.get(family_id)
+        if index is not None:
+            index.add("recipe", entry)
+    
+    # ========== PRECARGA ==========
+    
+    async def warm_up(self, families):
+        """Precargar en segundo plano catálogo, menú e inventario de las familias activas"""
+        started = time.monotonic()
+        for family in families[:PREFETCH_FAMILIES]:
+            try:
+                await self.get_recipe_catalog(family['id'])
+                await self.render_menu(family)
+                await self.render_inventory(family)
+            except Exception as e:
+                logger.error(f"❌ Error precargando la familia {family.get('id')}: {e}")
+        if families:
+            logger.info(
+                f"🔥 {min(len(families), PREFETCH_FAMILIES)} familias precargadas "
+                f"en {time.monotonic() - started:.1f}s"
+            )
+    
+    # ========== INVALIDACIÓN ==========
+    
+    async def changed(self, family_id, *entities):
+        """Tras una escritura: invalidar lo renderizado aquí y avisar a las demás réplicas"""
+        self.renders.touch(family_id, *entities)
+        for entity in entities:
+            version = self.renders.version(family_id, (entity,))[0]
+            INVALIDATIONS.inc(direction="published", entity=entity)
+            await self.bus.publish({
+                "origin": self.origin, "family_id": family_id, "entity": entity, "version": version
+            })
+    
+    def on_remote_change(self, message):
+        """Aviso de otra réplica: descartar las cachés de la familia que dependen de esa entidad"""
+        if message.get('origin') == self.origin:
+            return
+        family_id, entity = message.get('family_id'), message.get('entity')
+        INVALIDATIONS.inc(direction="received", entity=entity or "*")
+        
+        if family_id is None:
+            # Pudimos perder avisos: no fiarse de nada cacheado
+            self.recipe_catalog.clear()
+            self.search_indexes.clear()
+            self.renders.clear()
+            return
+        
+        self.renders.touch(family_id, entity)
+        if entity == "recipes":
+            self.recipe_catalog.pop(family_id)
+        if entity in ("recipes", "inventory"):
+            self.search_indexes.pop(family_id)
+    
+    # ========== BÚSQUEDA ==========
+    
+    async def get_search_index(self, family_id):
+        """Índice de búsqueda de la familia, construido una vez desde el catálogo y el inventario"""
+        index = self.search_indexes.get(family_id)
+        if index is None:
+            recipes = await self.get_recipe_catalog(family_id)
+            products = await self.storage.inventory.list_products(family_id)
+            index = SearchIndex()
+            for recipe in recipes.values():
+                index.add("recipe", recipe)
+            for product in products:
+                index.add("product", product)
+            self.search_indexes.set(family_id, index)
+        return index
+    
+    def index_product(self, family_id, product):
+        """Write-through: reflejar en el índice un producto añadido o con stock nuevo"""
+        index = self.search_indexes.get(family_id)
+        if index is not None:
+            index.add("product", {field: product.get(field) for field in ("id", "name", "section", "stock")})
+    
+    async def inline_search(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Búsqueda inline (@bot texto) de recetas y productos de la familia"""
+        inline_query = update.inline_query
+        user, family = await self.get_identity(update)
+        
+        if not family or not inline_query.query.strip():
+            await inline_query.answer([], cache_time=0, is_personal=True)
+            return
+        
+        index = await self.get_search_index(family['id'])
+        results = []
+        for kind, row in index.search(inline_query.query, limit=INLINE_RESULTS):
+            if kind == "recipe":
+                defrost = " · 🧊 descongelar" if row.get('needs_defrost') else ""
+                results.append(InlineQueryResultArticle(
+                    id=f"recipe_{row['id']}",
+                    title=f"📖 {row['name']}",
+                    description=f"Receta{defrost}",
+                    input_message_content=InputTextMessageContent(f"📖 {row['name']}")
+                ))
+            else:
+                results.append(InlineQueryResultArticle(
+                    id=f"product_{row['id']}",
+                    title=f"🏠 {row['name']}",
+                    description=f"{row['section']} · stock: {row['stock']}",
+                    input_message_content=InputTextMessageContent(
+                        f"🏠 {row['name']} ({row['section']}, stock: {row['stock']})"
+                    )
+                ))
+        
+        await inline_query.answer(results, cache_time=0, is_personal=True)
+    
+    # ========== PAGINACIÓN ==========
+    
+    def page_cursor(self, context: ContextTypes.DEFAULT_TYPE, view: str, direction: str = None):
+        """
+        Cursor (name, id) de la página a mostrar. Cada vista guarda en user_data la pila
+        de cursores de las páginas ya vistas y el de la siguiente; sin dirección vuelve a la primera.
+        """
+        pages = context.user_data.setdefault('pages', {})
+        stack, next_cursor = pages.get(view, ([None], None))
+        if direction == "next" and next_cursor:
+            stack = stack + [next_cursor]
+        elif direction == "prev" and len(stack) > 1:
+            stack = stack[:-1]
+        elif direction is None:
+            stack = [None]
+        pages[view] = (stack, None)
+        return stack[-1]
+    
+    def page_rows(self, context: ContextTypes.DEFAULT_TYPE, view: str, rows, callback_prefix: str):
+        """Recortar a PAGE_SIZE las filas (se piden PAGE_SIZE + 1) y construir la fila ⬅️/➡️"""
+        has_next = len(rows) > PAGE_SIZE
+        rows = rows[:PAGE_SIZE]
+        stack, _ = context.user_data['pages'][view]
+        next_cursor = (rows[-1]['name'], str(rows[-1]['id'])) if has_next else None
+        context.user_data['pages'][view] = (stack, next_cursor)
+        
+        nav = []
+        if len(stack) > 1:
+            nav.append(InlineKeyboardButton("⬅️ Anterior", callback_data=f"{callback_prefix}_prev"))
+        if has_next:
+            nav.append(InlineKeyboardButton("Siguiente ➡️", callback_data=f"{callback_prefix}_next"))
+        return rows, nav
+    
+    async def reply_long(self, message, text: str, reply_markup=None, **kwargs):
+        """Responder con un texto que puede superar el límite de Telegram (botones en el último trozo)"""
+        chunks = split_message(text)
+        for chunk in chunks[:-1]:
+            await message.reply_text(chunk, **kwargs)
+        await message.reply_text(chunks[-1], reply_markup=reply_markup, **kwargs)
+    
     # ========== FAMILIAS ==========
     
     async def prompt_create_or_join(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -173,8 +785,8 @@ class FamilyMealBot:
                 "created_by": user['id'],
                 "created_at": datetime.now().isoformat()
             }
-            family_response = supabase.table("families").insert(family_data).execute()
-            family_id = family_response.data[0]['id']
+            family = await self.storage.users.create_family(family_data)
+            family_id = family['id']
             
             member_data = {
                 "family_id": family_id,
@@ -182,19 +794,13 @@ class FamilyMealBot:
                 "role": "admin",
                 "joined_at": datetime.now().isoformat()
             }
-            supabase.table("family_members").insert(member_data).execute()
-            
-            keyboard = [
-                [KeyboardButton("📅 Menú Semanal"), KeyboardButton("📖 Recetas")],
-                [KeyboardButton("🏠 Inventario"), KeyboardButton("🛒 Lista de Compra")],
-                [KeyboardButton("👥 Mi Familia")]
-            ]
-            reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+            await self.storage.members.add(member_data)
+            self.identity_cache.pop(telegram_id)
             
             await update.message.reply_text(
                 f"✅ Familia *{family_name}* creada\n\n🔑 Código: `{invite_code}`\n\n"
                 f"Compártelo con tu familia 👇",
-                reply_markup=reply_markup,
+                reply_markup=MAIN_KEYBOARD,
                 parse_mode='Markdown'
             )
             return ConversationHandler.END
@@ -218,31 +824,23 @@ class FamilyMealBot:
         user = await self.get_or_create_user(telegram_id, username, first_name)
         
         try:
-            family_response = supabase.table("families").select("*").eq("invite_code", invite_code).execute()
-            if not family_response.data:
+            family = await self.storage.users.get_family_by_invite_code(invite_code)
+            if not family:
                 await update.message.reply_text("❌ Código no válido")
                 return JOIN_FAMILY_CODE
             
-            family = family_response.data[0]
-            
             member_data = {
                 "family_id": family['id'],
                 "user_id": user['id'],
                 "role": "member",
                 "joined_at": datetime.now().isoformat()
             }
-            supabase.table("family_members").insert(member_data).execute()
-            
-            keyboard = [
-                [KeyboardButton("📅 Menú Semanal"), KeyboardButton("📖 Recetas")],
-                [KeyboardButton("🏠 Inventario"), KeyboardButton("🛒 Lista de Compra")],
-                [KeyboardButton("👥 Mi Familia")]
-            ]
-            reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+            await self.storage.members.add(member_data)
+            self.identity_cache.pop(telegram_id)
             
             await update.message.reply_text(
                 f"✅ ¡Unido a *{family['name']}*!",
-                reply_markup=reply_markup,
+                reply_markup=MAIN_KEYBOARD,
                 parse_mode='Markdown'
             )
             return ConversationHandler.END
@@ -255,41 +853,49 @@ class FamilyMealBot:
     
     async def show_inventory(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Mostrar inventario"""
-        telegram_id = update.effective_user.id
-        username = update.effective_user.username or update.effective_user.first_name
-        first_name = update.effective_user.first_name
-        
-        user = await self.get_or_create_user(telegram_id, username, first_name)
-        family = await self.get_user_family(user['id'])
+        user, family = await self.get_identity(update)
         
         if not family:
             await update.message.reply_text("❌ No perteneces a ninguna familia")
             return
         
+        text, reply_markup = await self.render_inventory(family)
+        await self.reply_long(update.message, text, reply_markup=reply_markup, parse_mode='Markdown')
+    
+    async def render_inventory(self, family):
+        """Texto y botones del inventario, cacheados hasta que cambie el inventario"""
+        cached = self.renders.get(family['id'], "inventory", ("inventory",))
+        if cached is not None:
+            return cached
+        version = self.renders.version(family['id'], ("inventory",))
+        
+        # Una sola consulta para todo el inventario con stock, repartido por sección
+        items = await self.storage.inventory.list_in_stock(family['id'])
+        
+        items_by_section = {section: [] for section in SECTIONS}
+        for item in items:
+            if item['section'] in items_by_section:
+                items_by_section[item['section']].append(item)
+        
         text = "🏠 *Inventario*\n\n"
         
         for section in SECTIONS:
-            items = supabase.table("inventory")\
-                .select("*")\
-                .eq("family_id", family['id'])\
-                .eq("section", section)\
-                .gt("stock", 0)\
-                .execute()
+            section_items = items_by_section[section]
             
             icon = "📦" if section == "Despensa" else "❄️" if section == "Frigo" else "🧊"
             text += f"{icon} *{section}*\n"
             
-            if items.data:
-                for item in items.data:
+            if section_items:
+                for item in section_items:
                     text += f"  • {item['name']} (stock: {item['stock']})\n"
             else:
                 text += "  _Vacío_\n"
             text += "\n"
         
         keyboard = [[InlineKeyboardButton("➕ Añadir producto", callback_data="add_inventory")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+        rendered = (text, InlineKeyboardMarkup(keyboard))
+        self.renders.set(family['id'], "inventory", version, rendered)
+        return rendered
     
     async def add_inventory_start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Iniciar añadir producto"""
@@ -336,12 +942,7 @@ class FamilyMealBot:
     
     async def save_inventory_item(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Guardar producto en inventario"""
-        telegram_id = update.effective_user.id
-        username = update.effective_user.username or update.effective_user.first_name
-        first_name = update.effective_user.first_name
-        
-        user = await self.get_or_create_user(telegram_id, username, first_name)
-        family = await self.get_user_family(user['id'])
+        user, family = await self.get_identity(update)
         
         try:
             item_data = {
@@ -353,7 +954,9 @@ class FamilyMealBot:
                 "created_at": datetime.now().isoformat()
             }
             
-            supabase.table("inventory").insert(item_data).execute()
+            item = await self.storage.inventory.add(item_data)
+            self.index_product(family['id'], item)
+            await self.changed(family['id'], "inventory")
             
             await update.message.reply_text(
                 f"✅ *{context.user_data['inv_name']}* añadido\n\n"
@@ -368,59 +971,118 @@ class FamilyMealBot:
     # ========== LISTA DE COMPRA ==========
     
     async def show_shopping_list(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Mostrar lista de compra (productos con stock = 0)"""
-        telegram_id = update.effective_user.id
-        username = update.effective_user.username or update.effective_user.first_name
-        first_name = update.effective_user.first_name
-        
-        user = await self.get_or_create_user(telegram_id, username, first_name)
-        family = await self.get_user_family(user['id'])
+        """Mostrar lista de compra (lo que falta para el menú y productos con stock = 0)"""
+        user, family = await self.get_identity(update)
         
         if not family:
             await update.message.reply_text("❌ No perteneces a ninguna familia")
             return
         
-        items = supabase.table("inventory")\
-            .select("*")\
-            .eq("family_id", family['id'])\
-            .eq("stock", 0)\
-            .execute()
+        text, reply_markup = await self.render_shopping_list(family, context)
+        await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+    
+    async def shopping_list_page(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Página anterior/siguiente de la lista de compra"""
+        query = update.callback_query
+        await query.answer()
         
-        if not items.data:
-            await update.message.reply_text("🛒 *Lista de compra*\n\n✅ ¡Todo comprado!", parse_mode='Markdown')
+        user, family = await self.get_identity(update)
+        if not family:
             return
         
-        text = "🛒 *Lista de compra*\n\n"
+        text, reply_markup = await self.render_shopping_list(family, context, query.data.rsplit("_", 1)[1])
+        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+    
+    async def render_menu_needs(self, family):
+        """
+        Lo que falta para el menú de lo que queda de semana: ingredientes de las comidas sin
+        cocinar (una sola consulta) sumados por producto y comparados con el stock.
+        Cacheado hasta que cambie el menú o el inventario.
+        """
+        # La semana mostrada cambia el domingo a mediodía: la clave lleva semana y día
+        today = datetime.now().date()
+        week_dates = get_week_to_display()
+        view = ("shopping_menu", str(week_dates[0]), str(today))
+        entities = ("meal_plans", "inventory")
+        cached = self.renders.get(family['id'], view, entities)
+        if cached is not None:
+            return cached
+        version = self.renders.version(family['id'], entities)
+        
+        ingredients = await self.storage.meal_plans.list_range_ingredients(
+            family['id'], str(max(week_dates[0], today)), str(week_dates[6])
+        )
+        
+        text = ""
         keyboard = []
+        needs = shopping_needs(ingredients)
+        if needs:
+            text = "📅 *Para el menú de la semana*\n"
+            for need in needs:
+                have = f", tienes {need['stock']}" if need['stock'] else ""
+                text += f"⬜ {need['name']}: faltan {need['missing']} (necesitas {need['required']}{have})\n"
+                if need['product_id']:
+                    keyboard.append([InlineKeyboardButton(
+                        f"🛒 {need['name']} (+{need['missing']})",
+                        callback_data=f"buy_{need['product_id']}_{need['required']}"
+                    )])
+            text += "\n"
         
-        for item in items.data:
-            text += f"⬜ {item['name']} ({item['section']})\n"
-            keyboard.append([InlineKeyboardButton(f"✅ {item['name']}", callback_data=f"buy_{item['id']}")])
+        rendered = (text, keyboard)
+        self.renders.set(family['id'], view, version, rendered)
+        return rendered
+    
+    async def render_shopping_list(self, family, context: ContextTypes.DEFAULT_TYPE, direction: str = None):
+        """Texto y botones de una página de la lista de compra: lo que pide el menú y lo que no tiene stock"""
+        needs_text, needs_keyboard = await self.render_menu_needs(family)
+        after = self.page_cursor(context, "shopping", direction)
+        
+        # Se cachean las filas de la página y su texto; solo los botones ⬅️/➡️ dependen del usuario
+        view = ("shopping", after)
+        cached = self.renders.get(family['id'], view, ("inventory",))
+        if cached is None:
+            version = self.renders.version(family['id'], ("inventory",))
+            rows = await self.storage.inventory.page_out_of_stock(family['id'], after, PAGE_SIZE + 1)
+            
+            text = "📦 *Sin stock*\n" if rows else ""
+            keyboard = []
+            for item in rows[:PAGE_SIZE]:
+                text += f"⬜ {item['name']} ({item['section']})\n"
+                keyboard.append([InlineKeyboardButton(f"✅ {item['name']}", callback_data=f"buy_{item['id']}")])
+            
+            cached = (rows, text, keyboard)
+            self.renders.set(family['id'], view, version, cached)
         
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+        rows, text, keyboard = cached
+        items, nav = self.page_rows(context, "shopping", rows, "shop_page")
+        
+        if not items and after:
+            # La página se ha vaciado (productos comprados): volver a la primera
+            return await self.render_shopping_list(family, context)
+        if not items and not needs_text:
+            return "🛒 *Lista de compra*\n\n✅ ¡Todo comprado!", None
+        
+        keyboard = needs_keyboard + keyboard + ([nav] if nav else [])
+        return "🛒 *Lista de compra*\n\n" + needs_text + text, InlineKeyboardMarkup(keyboard)
     
     async def mark_as_bought(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Marcar producto como comprado (stock +1)"""
+        """Marcar producto como comprado (repone su stock)"""
         query = update.callback_query
         await query.answer()
         
-        item_id = query.data.replace("buy_", "")
+        # buy_<id> repone 1 unidad; buy_<id>_<n> (desde el menú) deja el stock en n
+        item_id, _, target = query.data.replace("buy_", "", 1).partition("_")
+        stock = int(target) if target else 1
         
         try:
-            item = supabase.table("inventory").select("*").eq("id", item_id).execute()
-            if not item.data:
+            current_item = await self.storage.inventory.set_stock(item_id, stock)
+            if not current_item:
                 await query.edit_message_text("❌ Producto no encontrado")
                 return
+            self.index_product(current_item['family_id'], current_item)
+            await self.changed(current_item['family_id'], "inventory")
             
-            current_item = item.data[0]
-            
-            supabase.table("inventory")\
-                .update({"stock": 1})\
-                .eq("id", item_id)\
-                .execute()
-            
-            await query.edit_message_text(f"✅ *{current_item['name']}* comprado (stock: 1)", parse_mode='Markdown')
+            await query.edit_message_text(f"✅ *{current_item['name']}* comprado (stock: {current_item['stock']})", parse_mode='Markdown')
         except Exception as e:
             logger.error(f"Error: {e}")
             await query.edit_message_text(f"❌ Error: {e}")
@@ -429,34 +1091,26 @@ class FamilyMealBot:
     
     async def show_recipes(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Mostrar recetas de la familia"""
-        telegram_id = update.effective_user.id
-        username = update.effective_user.username or update.effective_user.first_name
-        first_name = update.effective_user.first_name
-        
-        user = await self.get_or_create_user(telegram_id, username, first_name)
-        family = await self.get_user_family(user['id'])
+        user, family = await self.get_identity(update)
         
         if not family:
             await update.message.reply_text("❌ No perteneces a ninguna familia")
             return
         
-        recipes = supabase.table("recipes")\
-            .select("*")\
-            .eq("family_id", family['id'])\
-            .execute()
+        recipes = await self.get_recipe_catalog(family['id'])
         
-        if not recipes.data:
+        if not recipes:
             text = "📖 *Recetas*\n\n_Aún no hay recetas._\n\n¡Crea la primera!"
         else:
             text = "📖 *Recetas de la familia*\n\n"
-            for recipe in recipes.data:
+            for recipe in recipes.values():
                 icon = "🧊" if recipe.get('needs_defrost') else "✅"
                 text += f"{icon} {recipe['name']}\n"
         
         keyboard = [[InlineKeyboardButton("➕ Crear receta", callback_data="create_recipe")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
-        await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+        await self.reply_long(update.message, text, reply_markup=reply_markup, parse_mode='Markdown')
     
     async def create_recipe_start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Iniciar creación de receta"""
@@ -482,7 +1136,8 @@ class FamilyMealBot:
         keyboard = [
             [InlineKeyboardButton("🧊 Congelador", callback_data="ing_sect_Congelador")],
             [InlineKeyboardButton("❄️ Frigo", callback_data="ing_sect_Frigo")],
-            [InlineKeyboardButton("📦 Despensa", callback_data="ing_sect_Despensa")]
+            [InlineKeyboardButton("📦 Despensa", callback_data="ing_sect_Despensa")],
+            [InlineKeyboardButton("🔍 Buscar producto", callback_data="ing_search")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
@@ -503,21 +1158,11 @@ class FamilyMealBot:
         if section == "Congelador":
             context.user_data['recipe_needs_defrost'] = True
         
-        telegram_id = update.effective_user.id
-        username = update.effective_user.username or update.effective_user.first_name
-        first_name = update.effective_user.first_name
-        
-        user = await self.get_or_create_user(telegram_id, username, first_name)
-        family = await self.get_user_family(user['id'])
+        user, family = await self.get_identity(update)
         
-        products = supabase.table("inventory")\
-            .select("*")\
-            .eq("family_id", family['id'])\
-            .eq("section", section)\
-            .gt("stock", 0)\
-            .execute()
+        reply_markup = await self.render_product_picker(family, section, context)
         
-        if not products.data:
+        if not reply_markup:
             await query.edit_message_text(
                 f"❌ No hay productos en *{section}*\n\n"
                 f"Añade productos al inventario primero.",
@@ -525,23 +1170,80 @@ class FamilyMealBot:
             )
             return ConversationHandler.END
         
+        icon = "🧊" if section == "Congelador" else "❄️" if section == "Frigo" else "📦"
+        await query.edit_message_text(
+            f"{icon} *{section}*\n\nSelecciona producto:",
+            reply_markup=reply_markup,
+            parse_mode='Markdown'
+        )
+        return SELECT_INGREDIENT_PRODUCT
+    
+    async def ingredient_search_start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Buscar el producto por nombre en vez de recorrer una sección"""
+        query = update.callback_query
+        await query.answer()
+        
+        await query.edit_message_text("🔍 Escribe parte del nombre del producto:")
+        return SEARCH_INGREDIENT
+    
+    async def ingredient_search(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Mostrar los productos que casan con el texto"""
+        user, family = await self.get_identity(update)
+        
+        index = await self.get_search_index(family['id'])
+        products = [row for _, row in index.search(update.message.text, kind="product", limit=PAGE_SIZE)]
+        
+        if not products:
+            await update.message.reply_text("❌ Sin resultados. Prueba con otro nombre:")
+            return SEARCH_INGREDIENT
+        
         keyboard = []
-        for product in products.data:
+        for product in products:
             keyboard.append([InlineKeyboardButton(
                 f"{product['name']} (stock: {product['stock']})",
                 callback_data=f"ing_prod_{product['id']}"
             )])
         
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        icon = "🧊" if section == "Congelador" else "❄️" if section == "Frigo" else "📦"
-        await query.edit_message_text(
-            f"{icon} *{section}*\n\nSelecciona producto:",
-            reply_markup=reply_markup,
+        await update.message.reply_text(
+            "🔍 *Resultados*\n\nSelecciona producto:",
+            reply_markup=InlineKeyboardMarkup(keyboard),
             parse_mode='Markdown'
         )
         return SELECT_INGREDIENT_PRODUCT
     
+    async def ingredient_product_page(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Página anterior/siguiente del selector de productos"""
+        query = update.callback_query
+        await query.answer()
+        
+        user, family = await self.get_identity(update)
+        section = context.user_data['current_ing_section']
+        reply_markup = await self.render_product_picker(family, section, context, query.data.rsplit("_", 1)[1])
+        if reply_markup:
+            await query.edit_message_reply_markup(reply_markup=reply_markup)
+        return SELECT_INGREDIENT_PRODUCT
+    
+    async def render_product_picker(self, family, section: str, context: ContextTypes.DEFAULT_TYPE,
+                                    direction: str = None):
+        """Botones de una página de productos con stock de una sección (None si no hay ninguno)"""
+        after = self.page_cursor(context, "ingredients", direction)
+        rows = await self.storage.inventory.page_in_stock(family['id'], section, after, PAGE_SIZE + 1)
+        products, nav = self.page_rows(context, "ingredients", rows, "ing_page")
+        
+        if not products:
+            return None
+        
+        keyboard = []
+        for product in products:
+            keyboard.append([InlineKeyboardButton(
+                f"{product['name']} (stock: {product['stock']})",
+                callback_data=f"ing_prod_{product['id']}"
+            )])
+        if nav:
+            keyboard.append(nav)
+        
+        return InlineKeyboardMarkup(keyboard)
+    
     async def select_ingredient_product(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Producto seleccionado, preguntar cantidad"""
         query = update.callback_query
@@ -549,15 +1251,17 @@ class FamilyMealBot:
         
         product_id = query.data.replace("ing_prod_", "")
         
-        product = supabase.table("inventory").select("*").eq("id", product_id).execute()
-        if not product.data:
+        product = await self.storage.inventory.get(product_id)
+        if not product:
             await query.edit_message_text("❌ Producto no encontrado")
             return ConversationHandler.END
         
-        context.user_data['current_ingredient'] = product.data[0]
+        context.user_data['current_ingredient'] = product
+        if product['section'] == "Congelador":
+            context.user_data['recipe_needs_defrost'] = True
         
         await query.edit_message_text(
-            f"📊 *{product.data[0]['name']}*\n\n¿Cuántas unidades?",
+            f"📊 *{product['name']}*\n\n¿Cuántas unidades?",
             parse_mode='Markdown'
         )
         return ADD_INGREDIENT_QUANTITY
@@ -608,7 +1312,8 @@ class FamilyMealBot:
         keyboard = [
             [InlineKeyboardButton("🧊 Congelador", callback_data="ing_sect_Congelador")],
             [InlineKeyboardButton("❄️ Frigo", callback_data="ing_sect_Frigo")],
-            [InlineKeyboardButton("📦 Despensa", callback_data="ing_sect_Despensa")]
+            [InlineKeyboardButton("📦 Despensa", callback_data="ing_sect_Despensa")],
+            [InlineKeyboardButton("🔍 Buscar producto", callback_data="ing_search")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
@@ -630,7 +1335,7 @@ class FamilyMealBot:
             await query.edit_message_text(
                 "🧊 *Esta receta necesita descongelar*\n\n"
                 "¿A qué hora quieres el recordatorio?\n"
-                "(Formato: HH:MM, ej: 22:00 o 21:30)",
+                "(Formato: HH:MM, ej: 22:00 o 21:45)",
                 parse_mode='Markdown'
             )
             return SET_DEFROST_TIME
@@ -648,20 +1353,14 @@ class FamilyMealBot:
                 raise ValueError
             hour = int(time_parts[0])
             minute = int(time_parts[1])
-            if hour < 0 or hour > 23:
+            if not (0 <= hour <= 23 and 0 <= minute <= 59):
                 raise ValueError
-            if minute not in [0, 30]:
-                await update.message.reply_text(
-                    "❌ Los minutos deben ser :00 o :30\n"
-                    "Ej: 22:00, 21:30, 20:00\n\n"
-                    "Intenta de nuevo:"
-                )
-                return SET_DEFROST_TIME
-        except:
+            reminder_time = f"{hour:02d}:{minute:02d}"
+        except ValueError:
             await update.message.reply_text(
                 "❌ Formato incorrecto.\n"
-                "Usa HH:MM con minutos :00 o :30\n"
-                "Ej: 22:00, 21:30\n\n"
+                "Usa HH:MM\n"
+                "Ej: 22:00, 21:45\n\n"
                 "Intenta de nuevo:"
             )
             return SET_DEFROST_TIME
@@ -671,12 +1370,7 @@ class FamilyMealBot:
     
     async def save_recipe(self, update: Update, context: ContextTypes.DEFAULT_TYPE, query, reminder_time: str):
         """Guardar receta e ingredientes en la BD"""
-        telegram_id = update.effective_user.id
-        username = update.effective_user.username or update.effective_user.first_name
-        first_name = update.effective_user.first_name
-        
-        user = await self.get_or_create_user(telegram_id, username, first_name)
-        family = await self.get_user_family(user['id'])
+        user, family = await self.get_identity(update)
         
         try:
             # Asegurar formato HH:MM:00 para la BD
@@ -692,17 +1386,21 @@ class FamilyMealBot:
                 "created_at": datetime.now().isoformat()
             }
             
-            recipe_response = supabase.table("recipes").insert(recipe_data).execute()
-            recipe_id = recipe_response.data[0]['id']
-            
-            for ingredient in context.user_data['recipe_ingredients']:
-                ingredient_data = {
-                    "recipe_id": recipe_id,
+            ingredients_data = [
+                {
                     "ingredient_name": ingredient['name'],
                     "quantity": str(ingredient['quantity']),
+                    "product_id": ingredient['product_id'],
+                    "section": ingredient['section'],
                     "created_at": datetime.now().isoformat()
                 }
-                supabase.table("recipe_ingredients").insert(ingredient_data).execute()
+                for ingredient in context.user_data['recipe_ingredients']
+            ]
+            
+            # Receta + ingredientes de forma atómica
+            created = await self.storage.recipes.create_with_ingredients(recipe_data, ingredients_data)
+            self.add_to_recipe_catalog(family['id'], created)
+            await self.changed(family['id'], "recipes")
             
             ingredients_text = "\n".join([
                 f"• {ing['name']} ({ing['quantity']} ud)"
@@ -735,19 +1433,34 @@ class FamilyMealBot:
     
     async def show_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Mostrar menú semanal"""
-        telegram_id = update.effective_user.id
-        username = update.effective_user.username or update.effective_user.first_name
-        first_name = update.effective_user.first_name
-        
-        user = await self.get_or_create_user(telegram_id, username, first_name)
-        family = await self.get_user_family(user['id'])
+        user, family = await self.get_identity(update)
         
         if not family:
             await update.message.reply_text("❌ No perteneces a ninguna familia")
             return
         
-        week_dates = get_week_to_display()
+        text, reply_markup = await self.render_menu(family)
+        await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+    
+    async def render_menu(self, family):
+        """Texto y botones del menú semanal, cacheados hasta que cambie el menú, la semana o el día"""
+        # La semana mostrada cambia el domingo a mediodía: la clave lleva semana y día
         today = datetime.now().date()
+        week_dates = get_week_to_display()
+        view = ("menu", str(week_dates[0]), str(today))
+        cached = self.renders.get(family['id'], view, ("meal_plans",))
+        if cached is not None:
+            return cached
+        version = self.renders.version(family['id'], ("meal_plans",))
+        
+        # Una sola consulta por rango para toda la semana (los días pasados no se muestran)
+        meal_plans = await self.storage.meal_plans.list_range(
+            family['id'], str(max(week_dates[0], today)), str(week_dates[6])
+        )
+        
+        plans_by_slot = {}
+        for plan in meal_plans:
+            plans_by_slot.setdefault((plan['date'], plan['meal_type']), plan)
         
         text = "📅 *Menú Semanal*\n\n"
         
@@ -763,19 +1476,13 @@ class FamilyMealBot:
                 text += "_Día pasado_\n"
                 continue
             
-            # Obtener comidas del día
+            # Comidas del día
             for meal_type in MEALS:
-                meal_plan = supabase.table("meal_plans")\
-                    .select("*, recipes(name, needs_defrost)")\
-                    .eq("family_id", family['id'])\
-                    .eq("date", str(date))\
-                    .eq("meal_type", meal_type)\
-                    .execute()
+                plan = plans_by_slot.get((str(date), meal_type))
                 
                 meal_icon = "🍽️" if meal_type == "Comida" else "🌙"
                 
-                if meal_plan.data:
-                    plan = meal_plan.data[0]
+                if plan:
                     if plan.get('recipes'):
                         recipe_name = plan['recipes']['name']
                         defrost_icon = " 🧊" if plan['recipes'].get('needs_defrost') else ""
@@ -790,9 +1497,9 @@ class FamilyMealBot:
             [InlineKeyboardButton("➕ Añadir comida", callback_data="add_meal")],
             [InlineKeyboardButton("🗑️ Limpiar semana", callback_data="clear_week")]
         ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+        rendered = (text, InlineKeyboardMarkup(keyboard))
+        self.renders.set(family['id'], view, version, rendered)
+        return rendered
     
     async def add_meal_start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Iniciar añadir comida al menú"""
@@ -856,47 +1563,99 @@ class FamilyMealBot:
         meal_type = query.data.replace("menu_meal_", "")
         context.user_data['menu_meal_type'] = meal_type
         
-        telegram_id = update.effective_user.id
-        username = update.effective_user.username or update.effective_user.first_name
-        first_name = update.effective_user.first_name
+        user, family = await self.get_identity(update)
         
-        user = await self.get_or_create_user(telegram_id, username, first_name)
-        family = await self.get_user_family(user['id'])
+        reply_markup = await self.render_recipe_picker(family, context)
         
-        recipes = supabase.table("recipes")\
-            .select("*")\
-            .eq("family_id", family['id'])\
-            .execute()
-        
-        if not recipes.data:
+        if not reply_markup:
             await query.edit_message_text(
                 "❌ No hay recetas.\n\nCrea una primero en 📖 Recetas",
                 parse_mode='Markdown'
             )
             return ConversationHandler.END
         
+        await query.edit_message_text(
+            f"📖 *{meal_type}*\n\nSelecciona receta:",
+            reply_markup=reply_markup,
+            parse_mode='Markdown'
+        )
+        return SELECT_MENU_RECIPE
+    
+    async def menu_recipe_page(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Página anterior/siguiente del selector de recetas"""
+        query = update.callback_query
+        await query.answer()
+        
+        user, family = await self.get_identity(update)
+        reply_markup = await self.render_recipe_picker(family, context, query.data.rsplit("_", 1)[1])
+        if reply_markup:
+            await query.edit_message_reply_markup(reply_markup=reply_markup)
+        return SELECT_MENU_RECIPE
+    
+    async def menu_search_start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Buscar la receta por nombre en vez de pasar páginas"""
+        query = update.callback_query
+        await query.answer()
+        
+        await query.edit_message_text("🔍 Escribe parte del nombre de la receta:")
+        return SEARCH_MENU_RECIPE
+    
+    async def menu_search(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Mostrar las recetas que casan con el texto"""
+        user, family = await self.get_identity(update)
+        
+        index = await self.get_search_index(family['id'])
+        recipes = [row for _, row in index.search(update.message.text, kind="recipe", limit=PAGE_SIZE)]
+        
+        if not recipes:
+            await update.message.reply_text("❌ Sin resultados. Prueba con otro nombre:")
+            return SEARCH_MENU_RECIPE
+        
         keyboard = []
-        for recipe in recipes.data:
+        for recipe in recipes:
             icon = "🧊" if recipe.get('needs_defrost') else "✅"
             keyboard.append([InlineKeyboardButton(
                 f"{icon} {recipe['name']}",
                 callback_data=f"menu_recipe_{recipe['id']}"
             )])
         
-        # Añadir opción eliminar
-        keyboard.append([InlineKeyboardButton("❌ Eliminar comida", callback_data="menu_opt_delete")])
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(
-            f"📖 *{meal_type}*\n\nSelecciona receta:",
-            reply_markup=reply_markup,
+        await update.message.reply_text(
+            f"🔍 *Resultados*\n\nSelecciona receta para {context.user_data['menu_meal_type']}:",
+            reply_markup=InlineKeyboardMarkup(keyboard),
             parse_mode='Markdown'
         )
         return SELECT_MENU_RECIPE
     
+    async def render_recipe_picker(self, family, context: ContextTypes.DEFAULT_TYPE, direction: str = None):
+        """Botones de una página del catálogo de recetas (None si no hay ninguna)"""
+        recipes = await self.get_recipe_catalog(family['id'])
+        if not recipes:
+            return None
+        
+        # El catálogo ya está en memoria: se pagina sin consultar la base de datos
+        after = self.page_cursor(context, "menu_recipes", direction)
+        rows = keyset_page(recipes.values(), after, PAGE_SIZE + 1)
+        page, nav = self.page_rows(context, "menu_recipes", rows, "menu_page")
+        
+        keyboard = []
+        for recipe in page:
+            icon = "🧊" if recipe.get('needs_defrost') else "✅"
+            keyboard.append([InlineKeyboardButton(
+                f"{icon} {recipe['name']}",
+                callback_data=f"menu_recipe_{recipe['id']}"
+            )])
+        if nav:
+            keyboard.append(nav)
+        keyboard.append([InlineKeyboardButton("🔍 Buscar receta", callback_data="menu_search")])
+        
+        # Añadir opciones cocinar y eliminar
+        keyboard.append([InlineKeyboardButton("🍳 Marcar como cocinada", callback_data="menu_opt_cooked")])
+        keyboard.append([InlineKeyboardButton("❌ Eliminar comida", callback_data="menu_opt_delete")])
+        
+        return InlineKeyboardMarkup(keyboard)
+    
     async def select_menu_recipe(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Guardar receta seleccionada en el menú O eliminar"""
+        """Guardar receta seleccionada en el menú, marcarla como cocinada O eliminar"""
         query = update.callback_query
         await query.answer()
         
@@ -905,55 +1664,40 @@ class FamilyMealBot:
             await self.delete_meal_plan(update, context, query)
             return ConversationHandler.END
         
-        recipe_id = query.data.replace("menu_recipe_", "")
+        if query.data == "menu_opt_cooked":
+            await self.cook_meal_plan(update, context, query)
+            return ConversationHandler.END
         
-        telegram_id = update.effective_user.id
-        username = update.effective_user.username or update.effective_user.first_name
-        first_name = update.effective_user.first_name
+        recipe_id = query.data.replace("menu_recipe_", "")
         
-        user = await self.get_or_create_user(telegram_id, username, first_name)
-        family = await self.get_user_family(user['id'])
+        user, family = await self.get_identity(update)
         
         try:
-            # Obtener receta
-            recipe = supabase.table("recipes").select("*").eq("id", recipe_id).execute()
-            if not recipe.data:
-                await query.edit_message_text("❌ Receta no encontrada")
-                return ConversationHandler.END
+            # Receta: del catálogo cacheado o, si no está, desde la BD
+            recipe_data = (await self.get_recipe_catalog(family['id'])).get(recipe_id)
+            if recipe_data is None:
+                recipe_data = await self.storage.recipes.get(recipe_id)
+                if not recipe_data:
+                    await query.edit_message_text("❌ Receta no encontrada")
+                    return ConversationHandler.END
             
-            recipe_data = recipe.data[0]
-            
-            # Verificar si ya existe
-            existing = supabase.table("meal_plans")\
-                .select("id")\
-                .eq("family_id", family['id'])\
-                .eq("date", context.user_data['menu_date'])\
-                .eq("meal_type", context.user_data['menu_meal_type'])\
-                .execute()
+            # Un único upsert sobre el hueco (family_id, date, meal_type)
+            meal_plan_data = {
+                "family_id": family['id'],
+                "date": context.user_data['menu_date'],
+                "meal_type": context.user_data['menu_meal_type'],
+                "recipe_id": recipe_id,
+                "meal_text": None,
+                "is_cooked": False,
+                "created_by": user['id'],
+                "defrost_reminder_time": recipe_data.get('defrost_reminder_time') if recipe_data.get('needs_defrost') else None,
+                "created_at": datetime.now().isoformat()
+            }
+            saved = await self.storage.meal_plans.upsert_slot(meal_plan_data)
+            await self.changed(family['id'], "meal_plans")
             
-            if existing.data:
-                # Actualizar
-                supabase.table("meal_plans")\
-                    .update({
-                        "recipe_id": recipe_id,
-                        "meal_text": None,
-                        "is_cooked": False,
-                        "defrost_reminder_time": recipe_data.get('defrost_reminder_time') if recipe_data.get('needs_defrost') else None
-                    })\
-                    .eq("id", existing.data[0]['id'])\
-                    .execute()
-            else:
-                # Crear
-                meal_plan_data = {
-                    "family_id": family['id'],
-                    "date": context.user_data['menu_date'],
-                    "meal_type": context.user_data['menu_meal_type'],
-                    "recipe_id": recipe_id,
-                    "created_by": user['id'],
-                    "defrost_reminder_time": recipe_data.get('defrost_reminder_time') if recipe_data.get('needs_defrost') else None,
-                    "created_at": datetime.now().isoformat()
-                }
-                supabase.table("meal_plans").insert(meal_plan_data).execute()
+            if self.scheduler:
+                await self.scheduler.schedule_plan(saved)
             
             defrost_info = ""
             if recipe_data.get('needs_defrost'):
@@ -974,20 +1718,17 @@ class FamilyMealBot:
     
     async def delete_meal_plan(self, update: Update, context: ContextTypes.DEFAULT_TYPE, query):
         """Eliminar comida del menú"""
-        telegram_id = update.effective_user.id
-        username = update.effective_user.username or update.effective_user.first_name
-        first_name = update.effective_user.first_name
-        
-        user = await self.get_or_create_user(telegram_id, username, first_name)
-        family = await self.get_user_family(user['id'])
+        user, family = await self.get_identity(update)
         
         try:
-            supabase.table("meal_plans")\
-                .delete()\
-                .eq("family_id", family['id'])\
-                .eq("date", context.user_data['menu_date'])\
-                .eq("meal_type", context.user_data['menu_meal_type'])\
-                .execute()
+            deleted = await self.storage.meal_plans.delete_slot(
+                family['id'], context.user_data['menu_date'], context.user_data['menu_meal_type']
+            )
+            await self.changed(family['id'], "meal_plans")
+            
+            if self.scheduler:
+                for plan in deleted:
+                    self.scheduler.unschedule_plan(plan['id'])
             
             await query.edit_message_text(f"✅ Eliminado")
         except Exception as e:
@@ -1008,7 +1749,7 @@ class FamilyMealBot:
         
         await query.edit_message_text(
             "🗑️ *¿Qué quieres hacer con el menú?*\n\n"
-            "✅ *Marcar cocinado:* Guarda que cocinaste todo (sin borrar el menú)\n"
+            "✅ *Marcar cocinado:* Guarda que cocinaste todo y descuenta los ingredientes (sin borrar el menú)\n"
             "🗑️ *Borrar:* Elimina todo directamente",
             reply_markup=reply_markup,
             parse_mode='Markdown'
@@ -1019,31 +1760,22 @@ class FamilyMealBot:
         query = update.callback_query
         await query.answer()
         
-        telegram_id = update.effective_user.id
-        username = update.effective_user.username or update.effective_user.first_name
-        first_name = update.effective_user.first_name
-        
-        user = await self.get_or_create_user(telegram_id, username, first_name)
-        family = await self.get_user_family(user['id'])
+        user, family = await self.get_identity(update)
         
         try:
             week_dates = get_week_to_display()
             monday = str(week_dates[0])
             sunday = str(week_dates[6])
             
-            # Marcar todo como cocinado
-            supabase.table("meal_plans") \
-                .update({
-                    "is_cooked": True,
-                    "cooked_at": datetime.now().isoformat()
-                }) \
-                .eq("family_id", family['id']) \
-                .gte("date", monday) \
-                .lte("date", sunday) \
-                .execute()
+            # Marcar todo como cocinado y descontar los ingredientes del inventario
+            result = await self.storage.meal_plans.cook_range(
+                family['id'], monday, sunday, datetime.now().isoformat()
+            )
+            summary = await self.after_cooking(family['id'], result)
             
             await query.edit_message_text(
                 "✅ *Todo marcado como cocinado*\n\n"
+                f"{summary}"
                 "El menú sigue visible. Usa 'Borrar' si quieres limpiarlo.",
                 parse_mode='Markdown'
             )
@@ -1051,29 +1783,62 @@ class FamilyMealBot:
             logger.error(f"Error: {e}")
             await query.edit_message_text(f"❌ Error: {e}")
     
+    async def cook_meal_plan(self, update: Update, context: ContextTypes.DEFAULT_TYPE, query):
+        """Marcar como cocinada la comida elegida y descontar sus ingredientes"""
+        user, family = await self.get_identity(update)
+        
+        try:
+            date = context.user_data['menu_date']
+            result = await self.storage.meal_plans.cook_range(
+                family['id'], date, date, datetime.now().isoformat(), context.user_data['menu_meal_type']
+            )
+            
+            if not result['cooked']:
+                await query.edit_message_text("ℹ️ No hay comida pendiente de cocinar en ese hueco")
+                return
+            summary = await self.after_cooking(family['id'], result)
+            
+            await query.edit_message_text(
+                f"✅ *{context.user_data['menu_meal_type']} cocinada*\n\n"
+                f"{summary}",
+                parse_mode='Markdown'
+            )
+        except Exception as e:
+            logger.error(f"Error: {e}")
+            await query.edit_message_text(f"❌ Error: {e}")
+    
+    async def after_cooking(self, family_id, result):
+        """Reflejar en cachés e índice el stock descontado y resumirlo para el mensaje"""
+        await self.changed(family_id, "meal_plans", "inventory")
+        for product in result['products']:
+            self.index_product(family_id, product)
+        
+        if not result['products']:
+            return ""
+        text = f"📉 Stock descontado de {len(result['products'])} productos\n"
+        finished = [product['name'] for product in result['products'] if product['stock'] == 0]
+        if finished:
+            text += f"🛒 A la lista de compra: {', '.join(finished)}\n"
+        return text + "\n"
+    
     async def clear_delete(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Borrar todo el menú sin marcar"""
         query = update.callback_query
         await query.answer()
         
-        telegram_id = update.effective_user.id
-        username = update.effective_user.username or update.effective_user.first_name
-        first_name = update.effective_user.first_name
-        
-        user = await self.get_or_create_user(telegram_id, username, first_name)
-        family = await self.get_user_family(user['id'])
+        user, family = await self.get_identity(update)
         
         try:
             week_dates = get_week_to_display()
             monday = str(week_dates[0])
             sunday = str(week_dates[6])
             
-            supabase.table("meal_plans") \
-                .delete() \
-                .eq("family_id", family['id']) \
-                .gte("date", monday) \
-                .lte("date", sunday) \
-                .execute()
+            deleted = await self.storage.meal_plans.delete_range(family['id'], monday, sunday)
+            await self.changed(family['id'], "meal_plans")
+            
+            if self.scheduler:
+                for plan in deleted:
+                    self.scheduler.unschedule_plan(plan['id'])
             
             await query.edit_message_text("✅ *Menú borrado*", parse_mode='Markdown')
         except Exception as e:
@@ -1084,26 +1849,18 @@ class FamilyMealBot:
     
     async def show_family(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Mostrar info de familia"""
-        telegram_id = update.effective_user.id
-        username = update.effective_user.username or update.effective_user.first_name
-        first_name = update.effective_user.first_name
-        
-        user = await self.get_or_create_user(telegram_id, username, first_name)
-        family = await self.get_user_family(user['id'])
+        user, family = await self.get_identity(update)
         
         if not family:
             await update.message.reply_text("❌ No perteneces a ninguna familia")
             return
         
-        members_response = supabase.table("family_members")\
-            .select("users(username), role")\
-            .eq("family_id", family['id'])\
-            .execute()
+        members = await self.storage.members.list_members(family['id'])
         
         members_text = ""
-        for member in members_response.data:
+        for member in members:
             role_emoji = "👑" if member['role'] == 'admin' else "👤"
-            username_display = member['users']['username'] if member.get('users') else "Usuario"
+            username_display = member['username'] or "Usuario"
             members_text += f"{role_emoji} {username_display}\n"
         
         await update.message.reply_text(
@@ -1136,160 +1893,940 @@ class FamilyMealBot:
         return ConversationHandler.END
 
 
+# ========== PROCESAMIENTO CONCURRENTE ==========
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Procesa updates de distintos usuarios en paralelo (hasta el máximo configurado),
+    pero serializa los de un mismo (chat, usuario) para que las transiciones de los
+    ConversationHandler sigan llegando en orden.
+    
+    El semáforo de BaseUpdateProcessor se toma antes de llegar aquí: los updates en cola
+    de un mismo chat ocuparían plazas sin ejecutarse y bloquearían a los demás usuarios.
+    Por eso se deja sin límite y el máximo se aplica después de tomar el lock del chat.
+    """
+    
+    UNBOUNDED = 2 ** 31 - 1
+    
+    def __init__(self, max_concurrent_updates: int):
+        if max_concurrent_updates < 1:
+            raise ValueError("max_concurrent_updates debe ser un entero positivo")
+        super().__init__(self.UNBOUNDED)
+        self.limit = max_concurrent_updates
+        self._running = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._locks = {}
+        self._waiters = {}
+    
+    @staticmethod
+    def update_key(update):
+        """Misma clave que usan los ConversationHandler (per_chat + per_user)"""
+        if not isinstance(update, Update):
+            return None
+        chat_id = update.effective_chat.id if update.effective_chat else None
+        user_id = update.effective_user.id if update.effective_user else None
+        if chat_id is None and user_id is None:
+            return None
+        return chat_id, user_id
+    
+    async def do_process_update(self, update, coroutine):
+        key = self.update_key(update)
+        if key is None:
+            async with self._running:
+                await coroutine
+            return
+        
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            async with lock:
+                async with self._running:
+                    await coroutine
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+                del self._locks[key]
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+
+
+# ========== ENVÍO DE NOTIFICACIONES ==========
+
+def percentile(values, pct):
+    """Percentil (0-100) de una lista de valores, por el método del rango más cercano"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class TokenBucket:
+    """Limitador de ritmo: como máximo `rate` operaciones por segundo, con ráfagas de `capacity`"""
+    
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0
+        self._lock = asyncio.Lock()
+    
+    def pause(self, seconds: float):
+        """Vaciar el cubo y no dar tokens durante `seconds` (p. ej. tras un RetryAfter)"""
+        now = time.monotonic()
+        self._paused_until = max(self._paused_until, now + seconds)
+        self._tokens = 0
+        self._updated_at = self._paused_until
+    
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class DeliveryStats:
+    """Métricas de una ronda de envíos (un tick del scheduler)"""
+    
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.latencies = []
+    
+    def record(self, latency: float, ok: bool):
+        self.latencies.append(latency)
+        if ok:
+            self.sent += 1
+        else:
+            self.failed += 1
+    
+    def summary(self):
+        elapsed = time.monotonic() - self.started_at
+        return (
+            f"{self.sent} enviados, {self.failed} fallidos, {self.retries} reintentos "
+            f"en {elapsed:.2f}s ({self.sent / elapsed if elapsed else 0:.1f} msg/s) · "
+            f"latencia p50 {percentile(self.latencies, 50) * 1000:.0f}ms, "
+            f"p95 {percentile(self.latencies, 95) * 1000:.0f}ms"
+        )
+
+
+class DeliveryEngine:
+    """
+    Envío concurrente de mensajes respetando los límites de Telegram:
+    un token bucket global, un intervalo mínimo por chat y reintentos
+    ante RetryAfter / errores de red.
+    """
+    
+    def __init__(self, bot, rate: float = SEND_GLOBAL_RATE, per_chat_interval: float = SEND_PER_CHAT_INTERVAL,
+                 max_concurrency: int = SEND_MAX_CONCURRENCY, max_retries: int = SEND_MAX_RETRIES):
+        self.bot = bot
+        self.per_chat_interval = per_chat_interval
+        self.max_retries = max_retries
+        self._bucket = TokenBucket(rate)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._chat_locks = {}
+        self._chat_next_send = {}
+        self._in_flight = 0
+    
+    async def send(self, chat_id, text: str, stats: DeliveryStats = None, **kwargs) -> bool:
+        """Enviar un mensaje; devuelve True si se entregó"""
+        started = time.monotonic()
+        self._in_flight += 1
+        try:
+            # Los mensajes a un mismo chat van en orden
+            async with self._chat_locks.setdefault(chat_id, asyncio.Lock()):
+                ok = await self._send_with_retries(chat_id, text, stats, **kwargs)
+        finally:
+            self._in_flight -= 1
+            if not self._in_flight:
+                self._chat_locks.clear()
+                self._chat_next_send.clear()
+        if stats:
+            stats.record(time.monotonic() - started, ok)
+        return ok
+    
+    async def send_many(self, messages, stats: DeliveryStats = None, **kwargs):
+        """Enviar en paralelo una lista de (chat_id, texto); devuelve si se entregó cada uno"""
+        return await asyncio.gather(*(self.send(chat_id, text, stats, **kwargs) for chat_id, text in messages))
+    
+    async def _send_with_retries(self, chat_id, text, stats, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            # El intervalo por chat se espera fuera del semáforo: un chat frenado no ocupa plaza
+            wait = self._chat_next_send.get(chat_id, 0) - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            
+            # El semáforo solo cuenta los envíos activos; las esperas de reintento van fuera
+            async with self._semaphore:
+                await self._bucket.acquire()
+                self._chat_next_send[chat_id] = time.monotonic() + self.per_chat_interval
+                try:
+                    await self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                    return True
+                except RetryAfter as e:
+                    delay = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+                    # Telegram pide parar: frenar todos los envíos, no solo este
+                    self._bucket.pause(delay)
+                except (TimedOut, NetworkError) as e:
+                    delay = 0.5 * 2 ** attempt
+                    logger.warning(f"   Error de red enviando a {chat_id}: {e}")
+                except Exception as e:
+                    logger.error(f"   Error enviando a {chat_id}: {e}")
+                    return False
+            
+            if attempt < self.max_retries:
+                if stats:
+                    stats.retries += 1
+                await asyncio.sleep(delay)
+        
+        logger.error(f"   Reintentos agotados enviando a {chat_id}")
+        return False
+
+
 # ========== NOTIFICATION SCHEDULER ==========
 
+class ReminderSchedule:
+    """
+    Agenda en memoria de recordatorios pendientes: un heap ordenado por hora de
+    disparo más un índice por meal_plan. Las entradas reprogramadas o borradas
+    se descartan perezosamente al salir del heap.
+    """
+    
+    def __init__(self):
+        self._heap = []
+        self._fire_at = {}
+    
+    def upsert(self, plan_id, fire_at: datetime):
+        if self._fire_at.get(plan_id) == fire_at:
+            return
+        self._fire_at[plan_id] = fire_at
+        heapq.heappush(self._heap, (fire_at, plan_id))
+    
+    def remove(self, plan_id):
+        self._fire_at.pop(plan_id, None)
+    
+    def next_fire_at(self):
+        self._discard_stale()
+        return self._heap[0][0] if self._heap else None
+    
+    def pop_due(self, now: datetime):
+        """Sacar de la agenda los meal_plans cuyo recordatorio ya toca"""
+        due = []
+        while self.next_fire_at() is not None and self._heap[0][0] <= now:
+            _, plan_id = heapq.heappop(self._heap)
+            del self._fire_at[plan_id]
+            due.append(plan_id)
+        return due
+    
+    def _discard_stale(self):
+        while self._heap and self._fire_at.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+    
+    def __len__(self):
+        return len(self._fire_at)
+
+
+def reminder_fire_at(plan):
+    """Momento del recordatorio de un meal_plan: la víspera, a su defrost_reminder_time"""
+    if not plan.get('defrost_reminder_time'):
+        return None
+    plan_date = datetime.strptime(str(plan['date']), "%Y-%m-%d").date()
+    reminder_time = datetime.strptime(plan['defrost_reminder_time'][:5], "%H:%M").time()
+    return datetime.combine(plan_date - timedelta(days=1), reminder_time)
+
+
+def outbox_entry(plan, fire_at: datetime):
+    """Fila del outbox para el recordatorio de un meal_plan (clave: meal_plan + hora de disparo)"""
+    due_at = fire_at.isoformat(timespec="seconds")
+    return {
+        "idempotency_key": f"defrost:{plan['id']}:{due_at}",
+        "family_id": plan['family_id'],
+        "meal_plan_id": plan['id'],
+        "due_at": due_at
+    }
+
+
 class NotificationScheduler:
-    """Sistema de notificaciones automáticas"""
+    """
+    Sistema de notificaciones automáticas. Cada recordatorio es una fila del outbox
+    (storage.reminders) con su hora y una clave de idempotencia; la agenda en memoria
+    solo sirve para despertar a la hora exacta (también a la de cada reintento y a la
+    de fin de lease de una fila que no se pudo cerrar). Cada disparo reclama del outbox
+    lo que ya toca, así que los atrasados y los encolados por otras réplicas salen en el
+    siguiente disparo o en el sondeo de rescate. Dos réplicas nunca envían a la vez el
+    mismo recordatorio, pero la entrega es "al menos una vez" (ver close()).
+    """
     
-    def __init__(self, application):
+    def __init__(self, application, storage):
         self.application = application
-        self.scheduler = AsyncIOScheduler()
+        self.storage = storage
+        self.delivery = DeliveryEngine(application.bot)
+        self.schedule = ReminderSchedule()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        REMINDERS_SCHEDULED.set_function(lambda: len(self.schedule))
     
     def start(self):
         """Iniciar el scheduler"""
-        # Ejecutar cada 30 minutos para permitir recordatorios a y media
-        self.scheduler.add_job(
-            self.check_and_send_reminders,
-            trigger=CronTrigger(minute='0,30'),  # Ejecutar a las :00 y :30
-            id='defrost_reminders',
-            replace_existing=True
-        )
-        
-        self.scheduler.start()
+        self._task = asyncio.create_task(self._run())
         logger.info("✅ Scheduler de notificaciones ACTIVADO")
-        logger.info("   - Revisa cada 30 minutos si hay recordatorios pendientes")
+        logger.info("   - Cada recordatorio se dispara a su hora exacta (agenda en memoria)")
+        logger.info(f"   - Outbox con reintentos; recupera los atrasados de las últimas {REMINDER_CATCHUP_HOURS:g}h")
+    
+    async def on_startup(self, application: Application):
+        """post_init: arrancar el scheduler dentro del event loop del bot"""
+        self.start()
+    
+    def stop(self):
+        """Detener el scheduler"""
+        if self._task:
+            self._task.cancel()
+            self._task = None
+    
+    async def schedule_plan(self, plan):
+        """Encolar (o reprogramar) el recordatorio de un meal_plan recién guardado"""
+        fire_at = reminder_fire_at(plan)
+        try:
+            if fire_at and fire_at > datetime.now() - timedelta(hours=REMINDER_CATCHUP_HOURS):
+                await self.storage.reminders.enqueue([outbox_entry(plan, fire_at)])
+                self.schedule.upsert(plan['id'], fire_at)
+            else:
+                await self.storage.reminders.cancel([plan['id']])
+                self.schedule.remove(plan['id'])
+        except Exception as e:
+            logger.error(f"❌ Error programando el recordatorio de {plan['id']}: {e}")
+        self._wakeup.set()
+    
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+    
+    def unschedule_plan(self, plan_id):
+        """Quitar de la agenda un meal_plan borrado (su fila del outbox se borra en cascada)"""
+        self.schedule.remove(plan_id)
+        self._wakeup.set()
+    
+    async def load_schedule(self):
+        """Encolar los recordatorios futuros y los atrasados dentro de la ventana de recuperación"""
+        since = datetime.now() - timedelta(hours=REMINDER_CATCHUP_HOURS)
+        meal_plans = await self.storage.meal_plans.list_with_reminders(str(since.date()))
+        
+        entries = []
+        for plan in meal_plans:
+            fire_at = reminder_fire_at(plan)
+            if fire_at and fire_at > since:
+                entries.append(outbox_entry(plan, fire_at))
+                self.schedule.upsert(plan['id'], fire_at)
+        
+        # Idempotente: las claves ya encoladas (o enviadas) por esta u otra réplica se ignoran
+        for start in range(0, len(entries), REMINDER_BATCH_SIZE):
+            await self.storage.reminders.enqueue(entries[start:start + REMINDER_BATCH_SIZE])
+        logger.info(f"   📋 {len(self.schedule)} recordatorios en agenda")
+    
+    async def _run(self):
+        """Dormir hasta el siguiente recordatorio o el siguiente sondeo de rescate, y disparar"""
+        try:
+            await self.load_schedule()
+        except Exception as e:
+            logger.error(f"❌ Error cargando la agenda de recordatorios: {e}")
+        
+        # Un sondeo al arrancar: recoge lo que dejó a medias una réplica caída
+        poll_at = time.monotonic()
+        while True:
+            next_fire_at = self.schedule.next_fire_at()
+            timeout = poll_at - time.monotonic()
+            if next_fire_at:
+                timeout = min(timeout, (next_fire_at - datetime.now()).total_seconds())
+            if timeout > 0:
+                # Un cambio de agenda solo recalcula la espera; no consulta la BD
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+            await self.check_and_send_reminders()
+            poll_at = time.monotonic() + REMINDER_POLL_INTERVAL
     
-    async def check_and_send_reminders(self):
-        """Revisar y enviar recordatorios de descongelar"""
-        logger.info("🔔 Ejecutando check de recordatorios...")
+    async def check_and_send_reminders(self, now: datetime = None):
+        """Reclamar del outbox, por lotes, los recordatorios que ya tocan y enviarlos"""
+        now = now or datetime.now()
+        self.schedule.pop_due(now)
         
+        started = time.perf_counter()
+        stats = DeliveryStats()
+        claimed = 0
         try:
-            # Hora actual
-            now = datetime.now()
-            # Redondear a :00 o :30
-            if now.minute < 30:
-                current_time = now.strftime("%H:00:00")
+            while True:
+                batch = await self.storage.reminders.claim_due(
+                    now.isoformat(timespec="seconds"), self.lease_until(), REMINDER_BATCH_SIZE
+                )
+                if batch:
+                    claimed += len(batch)
+                    await self.dispatch(batch, now, stats)
+                if len(batch) < REMINDER_BATCH_SIZE:
+                    break
+        except Exception as e:
+            logger.error(f"❌ Error en check_and_send_reminders: {e}")
+        
+        if not claimed:
+            return
+        SCHEDULER_TICK_LATENCY.observe(time.perf_counter() - started)
+        logger.info(f"   📨 Tick {now.strftime('%H:%M')}: {claimed} recordatorios · {stats.summary()}")
+        REMINDERS_SENT.inc(stats.sent, outcome="sent")
+        REMINDERS_SENT.inc(stats.failed, outcome="failed")
+        REMINDERS_SENT.inc(stats.retries, outcome="retried")
+    
+    async def dispatch(self, batch, now: datetime, stats: DeliveryStats):
+        """Enviar un lote reclamado del outbox (una sola consulta de comidas y miembros) y cerrar cada fila"""
+        if REMINDER_MODE == "digest":
+            # Lo que les quede del día a esas familias sale ya, en el mismo mensaje
+            until = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+            batch = batch + await self.storage.reminders.claim_for_families(
+                list({reminder['family_id'] for reminder in batch}), now.isoformat(timespec="seconds"),
+                until.isoformat(timespec="seconds"), self.lease_until()
+            )
+        
+        # Mientras se envía el lote, su lease se renueva: otra réplica no lo reclama aunque tarde
+        renewal = asyncio.create_task(self.renew_lease([reminder['id'] for reminder in batch]))
+        try:
+            await self.deliver_batch(batch, now, stats)
+        finally:
+            renewal.cancel()
+    
+    @staticmethod
+    def lease_until():
+        """Fin del lease de un lote reclamado ahora (con la hora real, no la del tick)"""
+        return (datetime.now() + timedelta(seconds=REMINDER_LEASE)).isoformat(timespec="seconds")
+    
+    async def renew_lease(self, reminder_ids):
+        """Renovar el lease de un lote cada tercio de REMINDER_LEASE hasta que se cancele"""
+        while True:
+            await asyncio.sleep(REMINDER_LEASE / 3)
+            try:
+                await self.storage.reminders.renew_lease(reminder_ids, self.lease_until())
+            except Exception as e:
+                logger.error(f"❌ Error renovando el lease de {len(reminder_ids)} recordatorios: {e}")
+    
+    async def deliver_batch(self, batch, now: datetime, stats: DeliveryStats):
+        """Cargar las comidas del lote, agruparlas por envío y enviarlas"""
+        plan_ids = list({reminder['meal_plan_id'] for reminder in batch})
+        plans = {plan['id']: plan for plan in await self.storage.meal_plans.get_for_reminders(plan_ids)}
+        
+        # Un envío por recordatorio, o por familia y día en modo resumen
+        groups = {}
+        for reminder in batch:
+            if REMINDER_MODE == "digest":
+                plan = plans.get(reminder['meal_plan_id'])
+                key = (reminder['family_id'], plan['date'] if plan else None)
             else:
-                current_time = now.strftime("%H:30:00")
-            
-            tomorrow = (now + timedelta(days=1)).date()
-            
-            # Buscar meal_plans para mañana con recordatorio a esta hora
-            meal_plans = supabase.table("meal_plans")\
-                .select("*, recipes(name, needs_defrost), families(id, name)")\
-                .eq("date", str(tomorrow))\
-                .eq("defrost_reminder_time", current_time)\
-                .execute()
+                key = reminder['id']
+            groups.setdefault(key, []).append(reminder)
+        
+        # Procesar todo el lote en paralelo; el DeliveryEngine limita el ritmo
+        await asyncio.gather(*(self.deliver(reminders, plans, now, stats) for reminders in groups.values()))
+    
+    async def deliver(self, reminders, plans, now: datetime, stats: DeliveryStats):
+        """Enviar en un mensaje unos recordatorios del outbox (uno, o el resumen de una familia) y cerrarlos"""
+        active = []
+        closing = []
+        for reminder in reminders:
+            plan = plans.get(reminder['meal_plan_id'])
+            expires_at = datetime.fromisoformat(reminder['due_at']) + timedelta(hours=REMINDER_CATCHUP_HOURS)
+            if expires_at < now:
+                closing.append(self.close(reminder, "expired", now))
+            elif not plan or not plan.get('recipes') or not plan['recipes'].get('needs_defrost'):
+                closing.append(self.close(reminder, "cancelled", now))
+            else:
+                active.append((reminder, plan))
+        
+        if active:
+            # Un miembro que ya recibió todos estos recordatorios (reintento) no se repite
+            skip = set.intersection(*(set(reminder.get('delivered_to') or []) for reminder, _ in active))
+            try:
+                delivered, failed = await self.send_defrost_reminder([plan for _, plan in active], stats, skip)
+                error = f"{len(failed)} envíos fallidos" if failed else None
+            except Exception as e:
+                logger.error(f"❌ Error en send_defrost_reminder: {e}")
+                delivered, failed, error = [], True, str(e)
             
-            if not meal_plans.data:
-                logger.info(f"   No hay recordatorios para mañana {tomorrow} a las {current_time}")
-                return
+            for reminder, _ in active:
+                delivered_to = list(reminder.get('delivered_to') or [])
+                delivered_to += [chat_id for chat_id in delivered if chat_id not in delivered_to]
+                closing.append(self.close(reminder, "pending" if failed else "sent", now, delivered_to, error))
+        
+        await asyncio.gather(*closing)
+    
+    async def close(self, reminder, status: str, now: datetime, delivered_to: list = None, error: str = None):
+        """Cerrar un intento; los fallidos vuelven a 'pending' con espera exponencial hasta agotar intentos"""
+        next_attempt_at = None
+        if status == "pending":
+            if reminder['attempts'] >= REMINDER_MAX_ATTEMPTS:
+                status = "failed"
+            else:
+                delay = REMINDER_RETRY_DELAY * 2 ** (reminder['attempts'] - 1)
+                next_attempt_at = (now + timedelta(seconds=delay)).isoformat(timespec="seconds")
+        
+        if delivered_to is None:
+            delivered_to = list(reminder.get('delivered_to') or [])
+        try:
+            await self.storage.reminders.finish(reminder['id'], status, delivered_to, next_attempt_at, error)
+            REMINDER_OUTBOX.inc(status=status)
+            if next_attempt_at:
+                self.wake_at(reminder['id'], datetime.fromisoformat(next_attempt_at))
+        except Exception as e:
+            # Queda en 'sending' y se reintentará al caducar el lease. delivered_to solo se guarda
+            # aquí, en finish(): ese reintento vuelve a avisar a los chats que ya lo recibieron
+            # (entrega "al menos una vez")
+            logger.error(f"❌ Error cerrando el recordatorio {reminder['id']}: {e}")
+            self.wake_at(reminder['id'], datetime.now() + timedelta(seconds=REMINDER_LEASE))
+    
+    def wake_at(self, reminder_id, when: datetime):
+        """Despertar el scheduler a `when` para reclamar de nuevo una fila del outbox"""
+        # Clave propia: no pisa la hora de disparo del meal_plan si se reprograma entretanto
+        self.schedule.upsert(("retry", reminder_id), when)
+        self._wakeup.set()
+    
+    async def send_defrost_reminder(self, meal_plans, stats: DeliveryStats = None, skip=()):
+        """
+        Enviar un recordatorio con las comidas de una familia para un mismo día a sus
+        miembros (salvo los chats de `skip`). Devuelve (chats entregados, chats fallidos)
+        """
+        family_name = meal_plans[0]['families']['name']
+        date = datetime.strptime(str(meal_plans[0]['date']), "%Y-%m-%d").date()
+        meal_order = {meal_type: i for i, meal_type in enumerate(MEALS)}
+        meal_plans = sorted(meal_plans, key=lambda plan: meal_order.get(plan['meal_type'], len(MEALS)))
+        
+        sections = []
+        for meal_plan in meal_plans:
+            recipe_name = meal_plan['recipes']['name']
             
-            logger.info(f"   Encontrados {len(meal_plans.data)} recordatorios")
+            # Ingredientes del congelador: vienen embebidos en la consulta del tick
+            ingredients = meal_plan['recipes'].get('recipe_ingredients')
+            if ingredients is None:
+                ingredients = await self.storage.recipes.list_ingredients(meal_plan['recipe_id'])
             
-            # Procesar cada meal_plan
-            for plan in meal_plans.data:
-                if not plan.get('recipes'):
-                    continue
+            freezer_items = [
+                f"• {ing['ingredient_name']} ({ing['quantity']} ud)"
+                for ing in ingredients
+                if ingredient_section(ing) == "Congelador"
+            ]
+            if freezer_items:
+                sections.append(f"🍽️ {meal_plan['meal_type']}: *{recipe_name}*\n" + "\n".join(freezer_items))
+            else:
+                logger.info(f"   No hay ingredientes de congelador para {recipe_name}")
+        
+        if not sections:
+            return [], []
+        
+        # Miembros de la familia: vienen embebidos en la consulta del tick
+        chat_ids = [
+            chat_id for chat_id in meal_plans[0]['families'].get('members') or []
+            if chat_id and chat_id not in skip
+        ]
+        if not chat_ids:
+            logger.info(f"   No hay miembros pendientes en familia {family_name}")
+            return [], []
+        
+        # Formato de fecha (un recordatorio recuperado tarde puede ser ya para hoy)
+        day_name = DAYS[date.weekday()]
+        date_formatted = date.strftime("%d/%m")
+        when = "hoy" if date <= datetime.now().date() else "mañana"
+        
+        # Crear mensaje
+        sections_text = "\n\n".join(sections)
+        message = (
+            f"🧊 *Recordatorio de descongelar*\n\n"
+            f"Para {when} ({day_name} {date_formatted}) necesitas sacar del congelador:\n\n"
+            f"{sections_text}\n\n"
+            f"¡No olvides descongelarlo {'cuanto antes' if when == 'hoy' else 'esta noche'}!"
+        )
+        
+        # Enviar a todos los miembros pendientes a la vez
+        results = await self.delivery.send_many(
+            [(chat_id, message) for chat_id in chat_ids], stats, parse_mode='Markdown'
+        )
+        delivered = [chat_id for chat_id, ok in zip(chat_ids, results) if ok]
+        failed = [chat_id for chat_id, ok in zip(chat_ids, results) if not ok]
+        
+        logger.info(
+            f"   ✅ Recordatorio de {len(sections)} comidas enviado a {len(delivered)} miembros de {family_name}"
+        )
+        return delivered, failed
+
+
+# ========== ARRANQUE EN CALIENTE ==========
+
+class CacheSnapshot:
+    """
+    Volcado a disco (pickle) de las cachés calientes del bot: identidades y catálogos de
+    recetas. Se guarda al parar y cada `interval` segundos, y se recarga al arrancar si no
+    es más viejo que `max_age` (mientras el bot estaba parado otros pudieron escribir).
+    """
+    
+    VERSION = 1
+    
+    def __init__(self, bot: FamilyMealBot, path: str, interval: float, max_age: float):
+        self.bot = bot
+        self.path = path
+        self.interval = interval
+        self.max_age = max_age
+        self._task = None
+    
+    def dump(self):
+        """Foto de las cachés; en el bucle de eventos, que es quien las modifica"""
+        return {
+            "version": self.VERSION,
+            "saved_at": time.time(),
+            "identity": self.bot.identity_cache.dump(),
+            "recipe_catalog": self.bot.recipe_catalog.dump(),
+        }
+    
+    def write(self, payload: bytes):
+        """Escribir el volcado (a un temporal y renombrando, para no dejarlo a medias)"""
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(payload)
+        os.replace(tmp_path, self.path)
+    
+    def save(self):
+        data = self.dump()
+        self.write(pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL))
+        return len(data["identity"]), len(data["recipe_catalog"])
+    
+    def load(self):
+        """Restaurar las cachés; devuelve las familias restauradas (para precargarlas)"""
+        try:
+            with open(self.path, "rb") as f:
+                data = pickle.load(f)
+        except FileNotFoundError:
+            return []
+        except Exception as e:
+            logger.error(f"❌ Volcado de cachés no válido ({self.path}): {e}")
+            return []
+        
+        age = time.time() - data.get("saved_at", 0)
+        if data.get("version") != self.VERSION or age > self.max_age:
+            logger.info(f"🧊 Volcado de cachés descartado (antigüedad {age:.0f}s)")
+            return []
+        
+        # La vida restante de cada entrada se cuenta desde que se guardó. Los catálogos no
+        # ven las escrituras de otras réplicas mientras el bot estaba parado (el bus no las
+        # repite): duran como mucho max_age desde el volcado
+        def aged(entries, cap=None):
+            restored = []
+            for key, value, remaining in entries:
+                if cap is not None:
+                    remaining = cap if remaining is None else min(remaining, cap)
+                restored.append((key, value, None if remaining is None else remaining - age))
+            return restored
+        
+        self.bot.identity_cache.load(aged(data["identity"]))
+        self.bot.recipe_catalog.load(aged(data["recipe_catalog"], self.max_age))
+        
+        families = {}
+        for _, (user, family), _ in reversed(self.bot.identity_cache.dump()):
+            families.setdefault(family['id'], family)
+        logger.info(
+            f"🔥 Cachés restauradas: {len(self.bot.identity_cache)} usuarios, "
+            f"{len(self.bot.recipe_catalog)} catálogos de recetas"
+        )
+        return list(families.values())
+    
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                # Serializar aquí: en otro hilo las cachés cambiarían mientras se recorren
+                payload = pickle.dumps(self.dump(), protocol=pickle.HIGHEST_PROTOCOL)
+                await asyncio.to_thread(self.write, payload)
+            except Exception as e:
+                logger.error(f"❌ Error guardando el volcado de cachés: {e}")
+    
+    def stop(self):
+        """Parar el guardado periódico y guardar por última vez"""
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        try:
+            users, catalogs = self.save()
+            logger.info(f"💾 Cachés guardadas: {users} usuarios, {catalogs} catálogos de recetas")
+        except Exception as e:
+            logger.error(f"❌ Error guardando el volcado de cachés: {e}")
+
+
+# ========== SERVIDOR HTTP ==========
+
+class HTTPRequest:
+    """Petición HTTP ya parseada"""
+    
+    def __init__(self, method: str, path: str, headers: dict, body: bytes):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.body = body
+
+
+class HTTPServer:
+    """
+    Servidor HTTP/1.1 mínimo sobre asyncio, con keep-alive.
+    Cada ruta es una corrutina que recibe un HTTPRequest y devuelve (status, content_type, body).
+    Es público: cierra las conexiones que tardan en mandar la petición o se quedan ociosas,
+    para que clientes lentos (slowloris) no acaparen descriptores.
+    """
+    
+    MAX_BODY_SIZE = 1024 * 1024
+    MAX_HEADERS = 100
+    # Segundos para recibir una petición entera (cabeceras y cuerpo) una vez empezada
+    REQUEST_TIMEOUT = 10
+    # Segundos que una conexión keep-alive puede esperar a la siguiente petición
+    IDLE_TIMEOUT = 60
+    REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+               405: "Method Not Allowed", 413: "Payload Too Large", 431: "Request Header Fields Too Large",
+               500: "Internal Server Error", 503: "Service Unavailable"}
+    
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.routes = {}
+        self._server = None
+    
+    def route(self, method: str, path: str, handler):
+        self.routes[(method, path)] = handler
+    
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        logger.info(f"🌐 Servidor HTTP escuchando en {self.host}:{self.port}")
+    
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+    
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        wait = self.REQUEST_TIMEOUT
+        try:
+            while True:
+                request_line = await asyncio.wait_for(reader.readline(), wait)
+                if not request_line:
+                    break
+                wait = self.IDLE_TIMEOUT
+                method, path, version = request_line.decode("latin-1").split()
                 
-                if not plan['recipes'].get('needs_defrost'):
-                    continue
+                try:
+                    status, request = await asyncio.wait_for(self._read_request(reader, method, path), self.REQUEST_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if request is None:
+                    await self._respond(writer, status, "text/plain", b"", keep_alive=False)
+                    break
                 
-                await self.send_defrost_reminder(plan, tomorrow)
-        
+                status, content_type, payload = await self._dispatch(request)
+                keep_alive = version == "HTTP/1.1" and request.headers.get("connection", "").lower() != "close"
+                await self._respond(writer, status, content_type, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+    
+    async def _read_request(self, reader: asyncio.StreamReader, method: str, path: str):
+        """Cabeceras y cuerpo de la petición: (status, HTTPRequest), o (status de error, None)"""
+        headers = {}
+        lines = 0
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            lines += 1
+            if lines > self.MAX_HEADERS:
+                return 431, None
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        
+        length = int(headers.get("content-length", 0))
+        if length > self.MAX_BODY_SIZE:
+            return 413, None
+        body = await reader.readexactly(length) if length else b""
+        return 200, HTTPRequest(method, path.split("?")[0], headers, body)
+    
+    async def _dispatch(self, request: HTTPRequest):
+        handler = self.routes.get((request.method, request.path))
+        if handler is None:
+            known_path = any(path == request.path for _, path in self.routes)
+            return (405 if known_path else 404), "text/plain", b""
+        try:
+            return await handler(request)
         except Exception as e:
-            logger.error(f"❌ Error en check_and_send_reminders: {e}")
+            logger.error(f"❌ Error en {request.method} {request.path}: {e}")
+            return 500, "text/plain", b""
+    
+    async def _respond(self, writer, status, content_type, payload: bytes, keep_alive: bool):
+        head = (
+            f"HTTP/1.1 {status} {self.REASONS.get(status, '')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode("latin-1") + payload)
+        await writer.drain()
+
+
+class WebhookHandler:
+    """Recibe updates de Telegram por POST y los encola en la Application"""
     
-    async def send_defrost_reminder(self, meal_plan, date):
-        """Enviar recordatorio a todos los miembros de la familia"""
+    def __init__(self, application: Application, secret_token: str):
+        if not secret_token:
+            raise ValueError("El webhook necesita un secret token")
+        self.application = application
+        self.secret_token = secret_token
+    
+    async def __call__(self, request: HTTPRequest):
+        received = request.headers.get("x-telegram-bot-api-secret-token", "")
+        if not hmac.compare_digest(received, self.secret_token):
+            logger.warning("⚠️ Webhook con secret token incorrecto")
+            return 403, "text/plain", b""
         try:
-            family_id = meal_plan['families']['id']
-            family_name = meal_plan['families']['name']
-            recipe_name = meal_plan['recipes']['name']
-            meal_type = meal_plan['meal_type']
-            
-            # Obtener ingredientes del congelador
-            recipe_id = meal_plan['recipe_id']
-            ingredients = supabase.table("recipe_ingredients")\
-                .select("ingredient_name, quantity")\
-                .eq("recipe_id", recipe_id)\
-                .execute()
-            
-            # Filtrar solo ingredientes del congelador
-            freezer_items = []
-            if ingredients.data:
-                for ing in ingredients.data:
-                    # Buscar si el ingrediente está en el congelador
-                    inv_item = supabase.table("inventory")\
-                        .select("name, section")\
-                        .eq("family_id", family_id)\
-                        .eq("section", "Congelador")\
-                        .ilike("name", f"%{ing['ingredient_name']}%")\
-                        .execute()
-                    
-                    if inv_item.data:
-                        freezer_items.append(f"• {ing['ingredient_name']} ({ing['quantity']} ud)")
-            
-            if not freezer_items:
-                logger.info(f"   No hay ingredientes de congelador para {recipe_name}")
-                return
-            
-            # Obtener miembros de la familia
-            members = supabase.table("family_members")\
-                .select("users(telegram_id)")\
-                .eq("family_id", family_id)\
-                .execute()
-            
-            if not members.data:
-                logger.info(f"   No hay miembros en familia {family_name}")
-                return
-            
-            # Formato de fecha
-            day_name = DAYS[date.weekday()]
-            date_formatted = date.strftime("%d/%m")
-            
-            # Crear mensaje
-            items_text = "\n".join(freezer_items)
-            message = (
-                f"🧊 *Recordatorio de descongelar*\n\n"
-                f"Para mañana ({day_name} {date_formatted}) necesitas sacar del congelador:\n\n"
-                f"{items_text}\n\n"
-                f"📖 Receta: *{recipe_name}*\n"
-                f"🍽️ {meal_type}\n\n"
-                f"¡No olvides descongelarlo esta noche!"
+            update = Update.de_json(json.loads(request.body), self.application.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            logger.warning(f"⚠️ Update no válido en el webhook: {e}")
+            return 400, "text/plain", b""
+        
+        await self.application.update_queue.put(update)
+        return 200, "text/plain", b""
+
+
+async def metrics_endpoint(request: HTTPRequest):
+    """GET /metrics: métricas en formato Prometheus"""
+    return 200, METRICS_CONTENT_TYPE, REGISTRY.render().encode()
+
+
+class HealthHandler:
+    """GET /healthz: 200 si el bot y el scheduler están en marcha, 503 si no"""
+    
+    def __init__(self, application: Application, scheduler: NotificationScheduler):
+        self.application = application
+        self.scheduler = scheduler
+        self.started_at = time.monotonic()
+    
+    async def __call__(self, request: HTTPRequest):
+        healthy = self.application.running and self.scheduler.running
+        body = {
+            "status": "ok" if healthy else "unavailable",
+            "bot": self.application.running,
+            "scheduler": self.scheduler.running,
+            "reminders_scheduled": len(self.scheduler.schedule),
+            "uptime_seconds": round(time.monotonic() - self.started_at),
+        }
+        return (200 if healthy else 503), "application/json", json.dumps(body).encode()
+
+
+def create_http_server(port: int, application: Application, scheduler: NotificationScheduler):
+    """Servidor HTTP con /metrics y /healthz"""
+    server = HTTPServer(WEBHOOK_LISTEN, port)
+    server.route("GET", "/metrics", metrics_endpoint)
+    server.route("GET", "/healthz", HealthHandler(application, scheduler))
+    return server
+
+
+async def run_webhook(application: Application, scheduler: NotificationScheduler):
+    """Servir el bot por webhook, con el scheduler en el mismo event loop"""
+    # El endpoint es público: sin secret token cualquiera podría inyectar updates falsos
+    secret_token = WEBHOOK_SECRET
+    if not secret_token:
+        secret_token = secrets.token_urlsafe(32)
+        logger.info("🔐 WEBHOOK_SECRET no definido: se usa uno aleatorio (defínelo para probar con curl)")
+    
+    server = create_http_server(PORT, application, scheduler)
+    server.route("POST", f"/{WEBHOOK_PATH}", WebhookHandler(application, secret_token))
+    
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    
+    async with application:
+        # Como run_polling: cachés y bus listos antes de aceptar el primer update
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                secret_token=secret_token,
+                allowed_updates=ALLOWED_UPDATES
             )
-            
-            # Enviar a cada miembro
-            sent_count = 0
-            for member in members.data:
-                if member.get('users') and member['users'].get('telegram_id'):
-                    telegram_id = member['users']['telegram_id']
-                    try:
-                        await self.application.bot.send_message(
-                            chat_id=telegram_id,
-                            text=message,
-                            parse_mode='Markdown'
-                        )
-                        sent_count += 1
-                    except Exception as e:
-                        logger.error(f"   Error enviando a {telegram_id}: {e}")
-            
-            logger.info(f"   ✅ Recordatorio enviado a {sent_count} miembros: {recipe_name} ({meal_type})")
+            logger.info(f"🔗 Webhook registrado en {WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}")
+        else:
+            logger.info("🔗 WEBHOOK_URL no definida: no se registra el webhook en Telegram (modo local)")
         
-        except Exception as e:
-            logger.error(f"❌ Error en send_defrost_reminder: {e}")
+        await server.start()
+        try:
+            await stop_event.wait()
+        finally:
+            await server.stop()
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+    await close_storage(scheduler.storage)
 
 
 # ========== MAIN ==========
 
+async def close_storage(storage):
+    """Cerrar las conexiones con la base de datos"""
+    await storage.close()
+    logger.info("🔌 Conexiones con la base de datos cerradas")
+
+
 def main():
     TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
     if not TOKEN:
         logger.error("❌ No TELEGRAM_BOT_TOKEN")
         return
     
-    bot = FamilyMealBot()
-    application = Application.builder().token(TOKEN).build()
+    # Con varias réplicas un secret aleatorio por proceso no serviría: cada una registraría el suyo
+    if BOT_MODE == "webhook" and WEBHOOK_URL and not WEBHOOK_SECRET:
+        logger.error("❌ BOT_MODE=webhook con WEBHOOK_URL necesita WEBHOOK_SECRET")
+        return
+    
+    # La conexión con la base de datos se abre con la primera consulta, no antes de arrancar
+    storage = instrument_storage(LazyStorage(create_storage))
+    bot = instrument_handlers(FamilyMealBot(storage, create_bus()))
+    snapshot = CacheSnapshot(bot, CACHE_SNAPSHOT_PATH, CACHE_SNAPSHOT_INTERVAL, CACHE_SNAPSHOT_MAX_AGE)
+    
+    # Conversaciones a medias y user_data sobreviven a un redespliegue
+    persistence = PicklePersistence(
+        filepath=STATE_PATH,
+        store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+        update_interval=STATE_FLUSH_INTERVAL
+    )
+    application = Application.builder()\
+        .token(TOKEN)\
+        .request(MeteredRequest(connection_pool_size=256))\
+        .persistence(persistence)\
+        .concurrent_updates(PerChatUpdateProcessor(MAX_CONCURRENT_UPDATES))\
+        .post_shutdown(lambda application: close_storage(storage))\
+        .build()
     
     # /start
     application.add_handler(CommandHandler("start", bot.start))
@@ -1305,7 +2842,9 @@ def main():
             JOIN_FAMILY_CODE: [MessageHandler(filters.TEXT & ~filters.COMMAND, bot.join_family_code)]
         },
         fallbacks=[CommandHandler("cancel", bot.cancel)],
-        allow_reentry=True
+        allow_reentry=True,
+        name="family_conv",
+        persistent=True
     )
     application.add_handler(family_conv)
     
@@ -1318,7 +2857,9 @@ def main():
             ADD_INVENTORY_STOCK: [MessageHandler(filters.TEXT & ~filters.COMMAND, bot.add_inventory_stock)]
         },
         fallbacks=[CommandHandler("cancel", bot.cancel)],
-        allow_reentry=True
+        allow_reentry=True,
+        name="inventory_conv",
+        persistent=True
     )
     application.add_handler(inventory_conv)
     
@@ -1330,14 +2871,21 @@ def main():
             SELECT_INGREDIENT_SECTION: [
                 CallbackQueryHandler(bot.select_ingredient_section, pattern="^ing_sect_"),
                 CallbackQueryHandler(bot.add_another_ingredient, pattern="^add_another_ing$"),
-                CallbackQueryHandler(bot.finish_recipe, pattern="^finish_recipe$")
+                CallbackQueryHandler(bot.finish_recipe, pattern="^finish_recipe$"),
+                CallbackQueryHandler(bot.ingredient_search_start, pattern="^ing_search$")
+            ],
+            SEARCH_INGREDIENT: [MessageHandler(filters.TEXT & ~filters.COMMAND, bot.ingredient_search)],
+            SELECT_INGREDIENT_PRODUCT: [
+                CallbackQueryHandler(bot.select_ingredient_product, pattern="^ing_prod_"),
+                CallbackQueryHandler(bot.ingredient_product_page, pattern="^ing_page_(next|prev)$")
             ],
-            SELECT_INGREDIENT_PRODUCT: [CallbackQueryHandler(bot.select_ingredient_product, pattern="^ing_prod_")],
             ADD_INGREDIENT_QUANTITY: [MessageHandler(filters.TEXT & ~filters.COMMAND, bot.add_ingredient_quantity)],
             SET_DEFROST_TIME: [MessageHandler(filters.TEXT & ~filters.COMMAND, bot.set_defrost_time)]
         },
         fallbacks=[CommandHandler("cancel", bot.cancel)],
-        allow_reentry=True
+        allow_reentry=True,
+        name="recipe_conv",
+        persistent=True
     )
     application.add_handler(recipe_conv)
     
@@ -1349,11 +2897,16 @@ def main():
             SELECT_MENU_MEAL: [CallbackQueryHandler(bot.select_menu_meal, pattern="^menu_meal_")],
             SELECT_MENU_RECIPE: [
                 CallbackQueryHandler(bot.select_menu_recipe, pattern="^menu_recipe_"),
-                CallbackQueryHandler(bot.select_menu_recipe, pattern="^menu_opt_delete$")
-            ]
+                CallbackQueryHandler(bot.select_menu_recipe, pattern="^menu_opt_(delete|cooked)$"),
+                CallbackQueryHandler(bot.menu_recipe_page, pattern="^menu_page_(next|prev)$"),
+                CallbackQueryHandler(bot.menu_search_start, pattern="^menu_search$")
+            ],
+            SEARCH_MENU_RECIPE: [MessageHandler(filters.TEXT & ~filters.COMMAND, bot.menu_search)]
         },
         fallbacks=[CommandHandler("cancel", bot.cancel)],
-        allow_reentry=True
+        allow_reentry=True,
+        name="menu_conv",
+        persistent=True
     )
     application.add_handler(menu_conv)
     
@@ -1365,6 +2918,10 @@ def main():
     
     # Marcar como comprado
     application.add_handler(CallbackQueryHandler(bot.mark_as_bought, pattern="^buy_"))
+    application.add_handler(CallbackQueryHandler(bot.shopping_list_page, pattern="^shop_page_(next|prev)$"))
+    
+    # Búsqueda inline (@bot texto)
+    application.add_handler(InlineQueryHandler(bot.inline_search))
     
     # Botones del menú
     application.add_handler(MessageHandler(
@@ -1372,12 +2929,42 @@ def main():
         bot.menu_button_handler
     ))
     
-    # Iniciar scheduler de notificaciones
-    scheduler = NotificationScheduler(application)
-    scheduler.start()
-    
-    logger.info("🤖 Bot iniciado - NOTIFICACIONES ACTIVAS ✅")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    # Scheduler de notificaciones (arranca en el event loop del bot)
+    scheduler = NotificationScheduler(application, storage)
+    bot.scheduler = scheduler
+    
+    # En modo polling /metrics y /healthz solo se sirven si hay METRICS_PORT
+    metrics_server = None
+    if BOT_MODE != "webhook" and METRICS_PORT:
+        metrics_server = create_http_server(METRICS_PORT, application, scheduler)
+    
+    async def on_startup(application: Application):
+        """Arrancar dentro del event loop del bot: cachés, bus de invalidación, scheduler y métricas"""
+        families = snapshot.load()
+        await bot.bus.start(bot.on_remote_change)
+        await scheduler.on_startup(application)
+        if metrics_server:
+            await metrics_server.start()
+        snapshot.start()
+        if families:
+            application.create_task(bot.warm_up(families))
+    
+    async def on_stop(application: Application):
+        scheduler.stop()
+        snapshot.stop()
+        await bot.bus.close()
+        if metrics_server:
+            await metrics_server.stop()
+    
+    application.post_init = on_startup
+    application.post_stop = on_stop
+    
+    if BOT_MODE == "webhook":
+        logger.info("🤖 Bot iniciado (webhook) - NOTIFICACIONES ACTIVAS ✅")
+        asyncio.run(run_webhook(application, scheduler))
+    else:
+        logger.info("🤖 Bot iniciado - NOTIFICACIONES ACTIVAS ✅")
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 
 if __name__ == "__main__":
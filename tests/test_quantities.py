@@ -0,0 +1,73 @@
+"""Cantidades de ingredientes: la misma regla en Python, en SQLite y en migrations/005"""
+
+import os
+import re
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from storage import QUANTITY_PATTERN, create_sqlite_storage, parse_quantity  # noqa: E402
+
+QUANTITIES = {
+    "3": 3, " 3": 3, "3 ": 3, "\t2\n": 2, "1,5": 1, "1.5": 1, "2,99": 2, "0": 0, "007": 7,
+    "2 kg": 1, "-2": 1, "+3": 1, "1e2": 1, "1_000": 1, "1.": 1, ",5": 1, "": 1, "al gusto": 1, None: 1,
+}
+
+
+class ParseQuantityTest(unittest.TestCase):
+
+    def test_parse_quantity(self):
+        for quantity, units in QUANTITIES.items():
+            with self.subTest(quantity=quantity):
+                self.assertEqual(parse_quantity(quantity), units)
+
+    def test_migration_uses_the_same_pattern(self):
+        with open(os.path.join(ROOT, "migrations", "005_cook_meal_plans.sql")) as f:
+            sql = f.read()
+        [pattern] = re.findall(r"ri\.quantity::text ~ '([^']*)'", sql)
+        self.assertEqual(pattern, QUANTITY_PATTERN.pattern)
+
+
+class CookRangeQuantityTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.storage = create_sqlite_storage(":memory:")
+        self.user = await self.storage.users.create({"telegram_id": 1, "username": "test"})
+        self.family = await self.storage.users.create_family({
+            "name": "F", "invite_code": "Q1", "created_by": self.user['id']
+        })
+
+    async def asyncTearDown(self):
+        await self.storage.close()
+
+    async def test_cook_range_deducts_like_parse_quantity(self):
+        products = {}
+        for i, quantity in enumerate(QUANTITIES):
+            product = await self.storage.inventory.add({
+                "family_id": self.family['id'], "section": "Despensa", "name": f"P{i}", "quantity": "100", "stock": 100
+            })
+            products[product['id']] = quantity
+        recipe = await self.storage.recipes.create_with_ingredients({
+            "family_id": self.family['id'], "name": "Todo", "created_by": self.user['id'], "needs_defrost": False,
+        }, [
+            {"ingredient_name": f"I{i}", "quantity": quantity, "product_id": product_id, "section": "Despensa"}
+            for i, (product_id, quantity) in enumerate(products.items())
+        ])
+        await self.storage.meal_plans.upsert_slot({
+            "family_id": self.family['id'], "date": "2030-01-07", "meal_type": "Comida",
+            "recipe_id": recipe['id'], "created_by": self.user['id'],
+        })
+
+        result = await self.storage.meal_plans.cook_range(
+            self.family['id'], "2030-01-07", "2030-01-07", "2030-01-07T14:00:00"
+        )
+        stocks = {product['id']: product['stock'] for product in result['products']}
+        for product_id, quantity in products.items():
+            with self.subTest(quantity=quantity):
+                self.assertEqual(stocks[product_id], 100 - parse_quantity(quantity))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+"""Outbox de recordatorios sobre SQLite: reprogramar, cancelar y volver a asignar"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import create_sqlite_storage  # noqa: E402
+
+DUE_AT = "2030-01-06T22:00:00"
+
+
+class ReminderOutboxTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.storage = create_sqlite_storage(":memory:")
+        user = await self.storage.users.create({"telegram_id": 1, "username": "test"})
+        self.family = await self.storage.users.create_family({"name": "F", "invite_code": "T1", "created_by": user['id']})
+        self.plan = await self.storage.meal_plans.upsert_slot({
+            "family_id": self.family['id'], "date": "2030-01-07", "meal_type": "Comida",
+            "defrost_reminder_time": "22:00:00",
+        })
+
+    async def asyncTearDown(self):
+        await self.storage.close()
+
+    def entry(self, due_at=DUE_AT):
+        return {
+            "idempotency_key": f"defrost:{self.plan['id']}:{due_at}",
+            "family_id": self.family['id'],
+            "meal_plan_id": self.plan['id'],
+            "due_at": due_at,
+        }
+
+    async def rows(self):
+        return await self.storage.reminders.db.run(
+            lambda conn: [dict(row) for row in conn.execute("select * from reminder_outbox order by due_at")]
+        )
+
+    async def test_reassigned_slot_rearms_cancelled_reminder(self):
+        # Receta con descongelar → receta sin descongelar → otra vez la primera
+        await self.storage.reminders.enqueue([self.entry()])
+        await self.storage.reminders.cancel([self.plan['id']])
+        await self.storage.reminders.enqueue([self.entry()])
+
+        rows = await self.rows()
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['status'], "pending")
+        self.assertEqual(rows[0]['attempts'], 0)
+
+        claimed = await self.storage.reminders.claim_due("2030-01-06T22:00:30", "2030-01-06T22:05:30")
+        self.assertEqual([row['idempotency_key'] for row in claimed], [self.entry()['idempotency_key']])
+
+    async def test_sent_reminder_is_not_rearmed(self):
+        await self.storage.reminders.enqueue([self.entry()])
+        [claimed] = await self.storage.reminders.claim_due("2030-01-06T22:00:30", "2030-01-06T22:05:30")
+        await self.storage.reminders.finish(claimed['id'], "sent", [1])
+
+        await self.storage.reminders.enqueue([self.entry()])
+        rows = await self.rows()
+        self.assertEqual([row['status'] for row in rows], ["sent"])
+        self.assertEqual(await self.storage.reminders.claim_due("2030-01-06T23:00:00", "2030-01-06T23:05:00"), [])
+
+    async def test_rescheduled_plan_cancels_old_pending_row(self):
+        await self.storage.reminders.enqueue([self.entry()])
+        await self.storage.reminders.enqueue([self.entry("2030-01-06T21:30:00")])
+
+        rows = await self.rows()
+        self.assertEqual([(row['due_at'], row['status']) for row in rows], [
+            ("2030-01-06T21:30:00", "pending"),
+            (DUE_AT, "cancelled"),
+        ])
+
+    async def test_family_claim_respects_retry_backoff(self):
+        await self.storage.reminders.enqueue([self.entry()])
+        [claimed] = await self.storage.reminders.claim_due("2030-01-06T22:00:30", "2030-01-06T22:05:30")
+        await self.storage.reminders.finish(claimed['id'], "pending", [], "2030-01-06T22:01:30", "error")
+
+        # El resumen de otra comida de la familia no se adelanta al reintento
+        claimed = await self.storage.reminders.claim_for_families(
+            [self.family['id']], "2030-01-06T22:01:00", "2030-01-07T00:00:00", "2030-01-06T22:06:00"
+        )
+        self.assertEqual(claimed, [])
+
+        claimed = await self.storage.reminders.claim_for_families(
+            [self.family['id']], "2030-01-06T22:01:30", "2030-01-07T00:00:00", "2030-01-06T22:06:30"
+        )
+        self.assertEqual(len(claimed), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()